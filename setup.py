@@ -49,6 +49,10 @@ setup(
     package_dir={"grlc": grlc_base},
     scripts=["bin/grlc-server"],
     install_requires=install_requires,
+    extras_require={
+        # cooperative workers for grlc-server --async
+        "async": ["gevent"],
+    },
     setup_requires=[
         # dependency for `python setup.py test`
         "pytest-runner",
@@ -0,0 +1,376 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+# cache.py: in-process caches used by grlc
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+import grlc.glogging as glogging
+
+glogger = glogging.getGrlcLogger(__name__)
+
+
+def sizeof(value):
+    """Rough estimate of the number of bytes held by a cached value."""
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+# Longest wait (in seconds) between two attempts to take a busy file lock
+LOCK_POLL_MAX = 0.05
+# Age (in seconds) after which files left in a lock directory (e.g. by a
+# process that died while holding a lock) are removed
+STALE_LOCK_AGE = 3600
+
+
+@contextmanager
+def file_lock(path, remove=False):
+    """Holds an exclusive file lock on path (if file locks are supported). A
+    busy lock is polled, sleeping in between, rather than waited for, so under
+    the gevent worker other greenlets keep running (time.sleep is cooperative
+    once patched, a blocking flock is not). If `remove` is set, the lock file
+    is deleted on release, and processes waiting for it lock a new one."""
+    while True:
+        lock_file = open(path, "a")
+        if not fcntl:
+            break
+        delay = 0.001
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(delay)
+                delay = min(delay * 2, LOCK_POLL_MAX)
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        # The file was removed by the previous holder of the lock
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    try:
+        yield
+    finally:
+        if remove:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+class CacheEntry:
+    """A value stored in an LRUCache, with its size and lifetime."""
+
+    def __init__(self, value, size, ttl):
+        self.value = value
+        self.size = size
+        self.created = time.time()
+        self.expires = self.created + ttl if ttl else None
+
+    def expired(self, now=None):
+        return self.expires is not None and (now or time.time()) >= self.expires
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a byte budget and a time to
+    live per entry. Hits, misses and evictions are counted for reporting."""
+
+    def __init__(self, max_bytes=0, ttl=0, max_items=None, on_evict=None):
+        """Create a new LRUCache.
+
+        Keyword arguments:
+        max_bytes -- Total (estimated) size of the cached values. A cache with
+                     no budget stores nothing (default: 0).
+        ttl -- Default lifetime of entries in seconds, 0 for no expiry (default: 0).
+        max_items -- Maximum number of entries, regardless of their size (default: None).
+        on_evict -- Function called with the key and value of entries which are
+                    evicted or expire (default: None).
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_items = max_items
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get_entry(self, key):
+        """Returns the CacheEntry stored for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expired():
+                if entry is not None:
+                    self._remove(key)
+                    self._evicted(key, entry)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default if missing or expired."""
+        entry = self.get_entry(key)
+        return entry.value if entry is not None else default
+
+    def set(self, key, value, size=None, ttl=None):
+        """Store value under key, evicting least recently used entries as needed.
+        Values larger than the whole budget are not stored."""
+        if not self.enabled:
+            return
+        size = sizeof(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = CacheEntry(
+                value, size, self.ttl if ttl is None else ttl
+            )
+            self._bytes += size
+            while self._bytes > self.max_bytes or (
+                self.max_items and len(self._entries) > self.max_items
+            ):
+                oldest = next(iter(self._entries))
+                self._evicted(oldest, self._remove(oldest))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        return entry
+
+    def _evicted(self, key, entry):
+        if self.on_evict is not None:
+            self.on_evict(key, entry.value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not entry.expired()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns usage statistics for this cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+            }
+
+
+class DiskCache:
+    """Values pickled to files in a directory, which outlive the process and are
+    shared by all processes using the same directory. Entries older than `ttl`
+    seconds (0 for no expiry) are ignored."""
+
+    def __init__(self, directory, ttl=0):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        )
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default if missing or expired."""
+        path = self._path(key)
+        try:
+            if self.ttl and time.time() - os.path.getmtime(path) >= self.ttl:
+                raise OSError("Expired cache entry")
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store value under key. Entries are replaced atomically, so readers in
+        other processes never see a partially written value."""
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp, path)
+        except (OSError, pickle.PickleError, TypeError) as e:
+            glogger.debug("Could not store cache entry on disk: {}".format(e))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self):
+        """Returns usage statistics for this cache."""
+        return {"directory": self.directory, "hits": self.hits, "misses": self.misses}
+
+
+class _Flight:
+    """A call in progress, shared by the leader and its followers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first caller (the
+    leader) runs the call, and callers arriving while it runs wait for it and
+    share its result. Across threads this happens in memory. If `lock_dir` is
+    given, leaders of different processes (e.g. gunicorn workers) also take a
+    file lock per key, and results are shared through that directory for
+    `share_ttl` seconds."""
+
+    def __init__(self, lock_dir=None, share_ttl=1):
+        self.lock_dir = lock_dir if (lock_dir and fcntl) else None
+        self.share_ttl = share_ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._swept = 0
+        self.calls = 0
+        self.shared = 0
+        if lock_dir and not fcntl:
+            glogger.warning(
+                "File locks not supported, not sharing calls across processes"
+            )
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def do(self, key, fn):
+        """Returns the result of calling fn(), or of the identical call already in flight."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self.shared += 1
+
+        if not leader:
+            glogger.debug("Waiting for identical call in flight")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            self.calls += 1
+            if self.lock_dir:
+                flight.result = self._do_shared(key, fn)
+            else:
+                flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _do_shared(self, key, fn):
+        """Run fn() holding a file lock for key, unless another process has
+        just stored the result of the same call."""
+        base = os.path.join(
+            self.lock_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        )
+        with file_lock(base + ".lock", remove=True):
+            try:
+                if time.time() - os.path.getmtime(base) < self.share_ttl:
+                    with open(base, "rb") as f:
+                        self.shared += 1
+                        return pickle.load(f)
+            except (OSError, EOFError, pickle.PickleError):
+                pass
+
+            result = fn()
+            try:
+                with open(base + ".tmp", "wb") as f:
+                    pickle.dump(result, f)
+                os.replace(base + ".tmp", base)
+            except (OSError, pickle.PickleError, TypeError) as e:
+                glogger.debug("Could not share call result: {}".format(e))
+        self._sweep()
+        return result
+
+    def _sweep(self):
+        """Removes (at most once a minute) the shared results which expired,
+        and the files left behind by processes which died holding a lock."""
+        now = time.time()
+        if now - self._swept < 60:
+            return
+        self._swept = now
+        try:
+            names = os.listdir(self.lock_dir)
+        except OSError:
+            return
+        for name in names:
+            filename = os.path.join(self.lock_dir, name)
+            max_age = self.share_ttl if "." not in name else STALE_LOCK_AGE
+            try:
+                if now - os.path.getmtime(filename) >= max_age:
+                    os.remove(filename)
+            except OSError:
+                pass
+
+    def stats(self):
+        """Returns the number of calls executed and the number answered by a shared call."""
+        return {"calls": self.calls, "shared": self.shared}
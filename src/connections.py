@@ -0,0 +1,466 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+# connections.py: pooled keep-alive HTTP sessions for upstream requests
+
+import os
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import grlc.static as static
+import grlc.glogging as glogging
+
+glogger = glogging.getGrlcLogger(__name__)
+
+_sessions = {}
+_breakers = {}
+_replicas = {}
+_hedge_executor = None
+_sessions_lock = threading.Lock()
+_sessions_pid = os.getpid()
+
+# Time (as returned by time.monotonic) by which the current grlc request must finish
+_deadline = contextvars.ContextVar("grlc_deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised when requests to an endpoint are refused by its circuit breaker."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the current grlc request has run out of time."""
+
+
+def _origin(url):
+    """Returns the (scheme, host) pair used to identify the pool of the given URL."""
+    parts = urlparse(url)
+    return parts.scheme, parts.netloc
+
+
+def get_endpoint_config(url):
+    """Returns the HTTP settings for the given endpoint URL. Values from the
+    [http] section of `config.ini` can be overridden per endpoint host in a
+    [endpoint:<host>] section."""
+    _, host = _origin(url)
+    overrides = static.ENDPOINT_HTTP_CONFIG.get(host, {})
+    if not overrides:
+        overrides = static.ENDPOINT_HTTP_CONFIG.get(host.split(":")[0], {})
+
+    return {
+        "pool_maxsize": int(overrides.get("pool_maxsize", static.HTTP_POOL_MAXSIZE)),
+        "max_retries": int(overrides.get("max_retries", static.HTTP_MAX_RETRIES)),
+        "retry_backoff": float(
+            overrides.get("retry_backoff", static.HTTP_RETRY_BACKOFF)
+        ),
+        "keep_alive": str(overrides.get("keep_alive", static.HTTP_KEEP_ALIVE)).lower()
+        in ["true", "yes", "on", "1"],
+        "connect_timeout": float(
+            overrides.get("connect_timeout", static.HTTP_CONNECT_TIMEOUT)
+        ),
+        "read_timeout": float(overrides.get("read_timeout", static.HTTP_READ_TIMEOUT)),
+        "breaker_failures": int(
+            overrides.get("breaker_failures", static.HTTP_BREAKER_FAILURES)
+        ),
+        "breaker_latency": float(
+            overrides.get("breaker_latency", static.HTTP_BREAKER_LATENCY)
+        ),
+        "breaker_cooldown": float(
+            overrides.get("breaker_cooldown", static.HTTP_BREAKER_COOLDOWN)
+        ),
+    }
+
+
+def _build_session(url):
+    """Create a new session with a connection pool configured for the given endpoint."""
+    conf = get_endpoint_config(url)
+    retries = Retry(
+        total=conf["max_retries"],
+        backoff_factor=conf["retry_backoff"],
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=static.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=conf["pool_maxsize"],
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not conf["keep_alive"]:
+        session.headers["Connection"] = "close"
+    glogger.debug("Created HTTP session for {} with {}".format(_origin(url), conf))
+    return session
+
+
+def get_session(url):
+    """Returns the shared session for the endpoint of the given URL. Sessions are
+    kept per process: pools inherited from a parent process (e.g. when gunicorn
+    forks its workers) are discarded, so sockets are never shared across workers."""
+    global _sessions_pid
+
+    key = _origin(url)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _breakers.clear()
+            _replicas.clear()
+            _sessions_pid = os.getpid()
+        if key not in _sessions:
+            _sessions[key] = _build_session(url)
+        return _sessions[key]
+
+
+def set_deadline(seconds):
+    """Limit the time the current grlc request may spend on upstream requests.
+    A value of 0 or None removes the limit."""
+    _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def remaining_time():
+    """Returns the seconds left before the deadline of the current grlc request,
+    or None if it has no deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current grlc request has run out of time."""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+def get_timeout(url):
+    """Returns the (connect, read) timeout for a request to the given URL, capped
+    by the time left before the deadline of the current grlc request."""
+    conf = get_endpoint_config(url)
+    connect_timeout, read_timeout = conf["connect_timeout"], conf["read_timeout"]
+    remaining = remaining_time()
+    if remaining is not None:
+        check_deadline()
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    return connect_timeout, read_timeout
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures of an endpoint. After too many, the circuit
+    opens and requests fail fast; after a cool-down one trial request is let
+    through (half-open) and its outcome closes or re-opens the circuit."""
+
+    def __init__(self, failures, latency, cooldown):
+        self.max_failures = failures
+        self.max_latency = latency
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def before_request(self):
+        """Raise CircuitOpenError if a request may not be sent now."""
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_running):
+                raise CircuitOpenError("Endpoint unavailable, circuit breaker is open")
+            if state == "half-open":
+                self.trial_running = True
+
+    def record(self, success, latency):
+        with self._lock:
+            self.trial_running = False
+            if self.max_latency and latency > self.max_latency:
+                success = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.max_failures and (
+                self.failures >= self.max_failures or self.opened_at is not None
+            ):
+                if self.opened_at is None:
+                    glogger.warning(
+                        "Opening circuit after {} failures".format(self.failures)
+                    )
+                self.opened_at = time.monotonic()
+
+
+# Statuses of responses which count as failures of the endpoint (its gateway
+# or server being down or overloaded)
+BREAKER_STATUSES = {502, 503, 504}
+
+
+def get_breaker(url):
+    """Returns the circuit breaker of the endpoint of the given URL."""
+    key = _origin(url)
+    with _sessions_lock:
+        if key not in _breakers:
+            conf = get_endpoint_config(url)
+            _breakers[key] = CircuitBreaker(
+                conf["breaker_failures"],
+                conf["breaker_latency"],
+                conf["breaker_cooldown"],
+            )
+        return _breakers[key]
+
+
+def request(method, url, **kwargs):
+    """Sends a request through the pooled session of the given URL, with the
+    configured timeouts and the endpoint's circuit breaker."""
+    kwargs.setdefault("timeout", get_timeout(url))
+    breaker = get_breaker(url)
+    breaker.before_request()
+
+    start = time.monotonic()
+    try:
+        send = getattr(get_session(url), method.lower())
+        response = send(url, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        breaker.record(False, time.monotonic() - start)
+        raise
+    except Exception:
+        breaker.record(True, time.monotonic() - start)
+        raise
+    # Other errors (e.g. a 500 for a query timeout) come from a working
+    # endpoint, and may be specific to a query
+    breaker.record(
+        response.status_code not in BREAKER_STATUSES, time.monotonic() - start
+    )
+    return response
+
+
+def get(url, **kwargs):
+    """Sends a GET request through the pooled session of the given URL."""
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Sends a POST request through the pooled session of the given URL."""
+    return request("POST", url, **kwargs)
+
+
+class ReplicaStats:
+    """Requests in flight and response time (exponentially weighted moving
+    average) of one endpoint URL, used to choose among replicas."""
+
+    def __init__(self, decay):
+        self.decay = decay
+        self.outstanding = 0
+        self.latency = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def finish(self, latency, success):
+        with self._lock:
+            self.outstanding -= 1
+            if not success:
+                # Failures make a replica look slow, so it is tried less often
+                latency = max(latency, self.latency or 0, 1) * 2
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.decay * (latency - self.latency)
+
+    def cost(self):
+        """Expected time to serve one more request: unknown replicas cost nothing,
+        so every replica gets measured."""
+        return (self.latency or 0) * (self.outstanding + 1)
+
+
+def get_replica_stats(url):
+    """Returns the load statistics of the given endpoint URL."""
+    with _sessions_lock:
+        if url not in _replicas:
+            _replicas[url] = ReplicaStats(static.HTTP_BALANCE_DECAY)
+        return _replicas[url]
+
+
+def rank_endpoints(urls):
+    """Returns the given replicas of an endpoint in the order they should be
+    tried, according to the `balance` strategy of the [http] configuration:
+    - least_outstanding: fewest requests in flight first
+    - ewma: lowest expected response time first
+    - first: in the given order (failover only)
+    Replicas with an open circuit breaker always come last."""
+    strategy = static.HTTP_BALANCE
+
+    def key(url):
+        stats = get_replica_stats(url)
+        if strategy == "ewma":
+            load = stats.cost()
+        elif strategy == "least_outstanding":
+            load = stats.outstanding
+        else:
+            load = 0
+        # Random tie-break spreads requests over equally loaded replicas
+        tie = random.random() if strategy != "first" else 0
+        return get_breaker(url).state == "open", load, tie
+
+    return sorted(urls, key=key)
+
+
+def _send(method, url, **kwargs):
+    """Sends a request to one replica, keeping track of its load."""
+    stats = get_replica_stats(url)
+    stats.start()
+    start = time.monotonic()
+    try:
+        response = request(method, url, **kwargs)
+    except Exception:
+        stats.finish(time.monotonic() - start, False)
+        raise
+    stats.finish(time.monotonic() - start, response.status_code < 500)
+    return response
+
+
+def _failover(method, urls, **kwargs):
+    """Sends the request to each replica in turn until one answers without a
+    server error. The last error (or response) is returned if all fail."""
+    for i, url in enumerate(urls):
+        last = i == len(urls) - 1
+        try:
+            response = _send(method, url, **kwargs)
+        except DeadlineExceeded:
+            raise
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            if last:
+                raise
+            glogger.warning("Endpoint {} failed ({}), failing over".format(url, e))
+            continue
+        if response.status_code < 500 or last:
+            return response
+        glogger.warning(
+            "Endpoint {} returned {}, failing over".format(url, response.status_code)
+        )
+        response.close()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+
+    with _sessions_lock:
+        if _hedge_executor is None or _sessions_pid != os.getpid():
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=static.HTTP_POOL_MAXSIZE,
+                thread_name_prefix="grlc-hedge",
+            )
+        return _hedge_executor
+
+
+def _discard(future):
+    """Close the response of a request that lost a hedging race."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _hedged(method, urls, hedge_after, **kwargs):
+    """Sends the request to the first replica, and if it has not answered after
+    `hedge_after` seconds, also to the others. The first good answer wins."""
+    executor = _get_hedge_executor()
+    primary = executor.submit(
+        contextvars.copy_context().run, _send, method, urls[0], **kwargs
+    )
+    done, _ = wait([primary], timeout=hedge_after)
+    if not done:
+        glogger.debug("Hedging slow request to {}".format(urls[0]))
+        secondary = executor.submit(
+            contextvars.copy_context().run, _failover, method, urls[1:], **kwargs
+        )
+        pending = {primary, secondary}
+        failed = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result().status_code < 500:
+                    for other in pending:
+                        other.add_done_callback(_discard)
+                    for other in failed:
+                        _discard(other)
+                    return future.result()
+                failed.append(future)
+        # No replica answered well: report the outcome of the hedged replicas
+        if primary.exception() is None:
+            primary.result().close()
+        return secondary.result()
+
+    try:
+        response = primary.result()
+    except DeadlineExceeded:
+        raise
+    except (requests.exceptions.RequestException, CircuitOpenError):
+        return _failover(method, urls[1:], **kwargs)
+    if response.status_code < 500:
+        return response
+    response.close()
+    return _failover(method, urls[1:], **kwargs)
+
+
+def balanced_request(method, urls, **kwargs):
+    """Sends a request to one of several replicas of an endpoint, chosen by the
+    configured balancing strategy, failing over to the others on errors. With
+    `hedge_after` (in seconds) configured, requests that are slow to answer are
+    also sent to a second replica. `urls` may also be a single URL."""
+    if isinstance(urls, str):
+        urls = [urls]
+    if len(urls) == 1:
+        return request(method, urls[0], **kwargs)
+
+    ranked = rank_endpoints(urls)
+    if static.HTTP_HEDGE_AFTER > 0:
+        return _hedged(method, ranked, static.HTTP_HEDGE_AFTER, **kwargs)
+    return _failover(method, ranked, **kwargs)
+
+
+def pool_stats():
+    """Returns connection pool utilisation for every endpoint contacted by this process."""
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for (scheme, host), session in sessions:
+        adapter = session.get_adapter(scheme + "://" + host)
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            stats["{}://{}".format(scheme, host)] = {
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+                "idle": pool.pool.qsize() if pool.pool else 0,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+    return stats
+
+
+def reset():
+    """Close all sessions of this process and drop their pools and breakers."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _breakers.clear()
+        _replicas.clear()
@@ -0,0 +1,194 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+# dumpstore.py: RDF dumps converted once into on-disk stores, which all worker
+# processes query without loading the dump in memory
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from rdflib import Graph, URIRef, plugin
+from rdflib.store import Store
+
+import grlc.static as static
+import grlc.cache as cache
+import grlc.connections as connections
+import grlc.glogging as glogging
+
+glogger = glogging.getGrlcLogger(__name__)
+
+_available = {}
+_stats = {
+    "conversions": 0,
+    "conversion_seconds": 0.0,
+    "revalidations": 0,
+    "unchanged": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def enabled():
+    """Returns True if dumps are to be converted to on-disk stores, that is, if
+    a store directory is configured and the configured rdflib store is usable."""
+    if not static.DUMP_STORE_DIR:
+        return False
+    name = static.DUMP_STORE
+    if name not in _available:
+        try:
+            plugin.get(name, Store)()
+            _available[name] = True
+        except Exception as e:
+            glogger.warning(
+                "RDF store {} not available, keeping dumps in memory: {}".format(
+                    name, e
+                )
+            )
+            _available[name] = False
+    return _available[name]
+
+
+def _base(endpoint, mime_type):
+    """Path (without extension) of the files of the store of a dump."""
+    key = repr((endpoint, mime_type)).encode("utf-8")
+    return os.path.join(static.DUMP_STORE_DIR, hashlib.sha1(key).hexdigest())
+
+
+def _read_current(base):
+    """Returns the store currently in use for a dump (its directory and the
+    validators of the dump it was converted from), or None."""
+    try:
+        with open(base + ".json") as f:
+            current = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.isdir(os.path.join(static.DUMP_STORE_DIR, current["store"])):
+        return None
+    return current
+
+
+def _write_current(base, current):
+    with open(base + ".json.tmp", "w") as f:
+        json.dump(current, f)
+    os.replace(base + ".json.tmp", base + ".json")
+
+
+def open_graph(path, endpoint):
+    """Opens (read only) the graph stored in the given directory."""
+    g = Graph(store=static.DUMP_STORE, identifier=URIRef(endpoint))
+    g.open(path, create=False)
+    return g
+
+
+def _convert(base, response, mime_type, endpoint):
+    """Downloads a dump to a temporary file and converts it into a new store.
+    Returns the name of the store directory."""
+    name = "{}-{}".format(os.path.basename(base), uuid.uuid4().hex)
+    path = os.path.join(static.DUMP_STORE_DIR, name)
+    start = time.monotonic()
+    with tempfile.NamedTemporaryFile(dir=static.DUMP_STORE_DIR, suffix=".dump") as f:
+        for chunk in response.iter_content(static.HTTP_STREAM_CHUNK_SIZE):
+            f.write(chunk)
+        f.flush()
+        g = Graph(store=static.DUMP_STORE, identifier=URIRef(endpoint))
+        g.open(path, create=True)
+        try:
+            g.parse(source=f.name, format=mime_type, publicID=endpoint)
+        except Exception:
+            g.close()
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        g.close()
+    elapsed = time.monotonic() - start
+    glogger.info("Dump {} converted to a store in {:.2f}s".format(endpoint, elapsed))
+    with _stats_lock:
+        _stats["conversions"] += 1
+        _stats["conversion_seconds"] += elapsed
+    return name
+
+
+def _prune(base, current):
+    """Deletes the stores a dump was converted to before its current one, once
+    they were replaced more than dump_store_grace seconds ago. Until then,
+    processes which still have them open keep reading them."""
+    retired = []
+    for name, replaced in current.get("retired", []):
+        if time.time() - replaced < static.DUMP_STORE_GRACE:
+            retired.append([name, replaced])
+        else:
+            glogger.debug("Removing replaced store {}".format(name))
+            shutil.rmtree(os.path.join(static.DUMP_STORE_DIR, name), ignore_errors=True)
+    if retired != current.get("retired", []):
+        current["retired"] = retired
+        _write_current(base, current)
+
+
+def update(endpoint, mime_type):
+    """Returns the directory of the store of the dump at endpoint. The dump is
+    revalidated with a conditional GET, and converted into a new store only if
+    it changed. This happens under a file lock, so when several processes find
+    a dump changed, only the first one converts it."""
+    os.makedirs(static.DUMP_STORE_DIR, exist_ok=True)
+    base = _base(endpoint, mime_type)
+    with cache.file_lock(base + ".lock"):
+        current = _read_current(base)
+        headers = {"User-Agent": static.USER_AGENT}
+        if current is not None:
+            _prune(base, current)
+            with _stats_lock:
+                _stats["revalidations"] += 1
+            if current["etag"]:
+                headers["If-None-Match"] = current["etag"]
+            if current["last_modified"]:
+                headers["If-Modified-Since"] = current["last_modified"]
+
+        try:
+            response = connections.get(endpoint, headers=headers, stream=True)
+        except Exception as e:
+            if current is None:
+                raise
+            glogger.warning("Could not revalidate dump {}: {}".format(endpoint, e))
+            return os.path.join(static.DUMP_STORE_DIR, current["store"])
+
+        try:
+            if current is not None and response.status_code == 304:
+                glogger.debug(
+                    "Dump {} not modified, reusing its store".format(endpoint)
+                )
+                with _stats_lock:
+                    _stats["unchanged"] += 1
+                return os.path.join(static.DUMP_STORE_DIR, current["store"])
+            response.raise_for_status()
+            name = _convert(base, response, mime_type, endpoint)
+        finally:
+            response.close()
+
+        # Processes which still have the previous store open keep reading it
+        # until they revalidate the dump, so it is only removed (by _prune)
+        # once they had time to do so
+        retired = []
+        if current is not None:
+            retired = current.get("retired", []) + [[current["store"], time.time()]]
+        _write_current(
+            base,
+            {
+                "store": name,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "retired": retired,
+            },
+        )
+        return os.path.join(static.DUMP_STORE_DIR, name)
+
+
+def stats():
+    """Returns the number of dumps converted (and the time spent converting
+    them) and revalidated by this process."""
+    with _stats_lock:
+        return dict(_stats)
@@ -3,10 +3,19 @@
 # SPDX-License-Identifier: MIT
 
 import grlc.static as static
+import grlc.connections as connections
+import grlc.cache as cache
 from grlc.queryTypes import qType, guessQueryType
 import grlc.glogging as glogging
 
+import os
+import re
 import json
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
 import gitlab
 import requests
 import yaml
@@ -23,6 +32,110 @@ from urllib.parse import urljoin
 # util variables
 glogger = glogging.getGrlcLogger(__name__)
 
+# A full (not abbreviated) git commit hash, which always names the same content
+_FULL_SHA = re.compile("^[0-9a-f]{40}$")
+
+# Commits following a given one (which never change once found), per repo
+_next_commits = cache.LRUCache(2**20, static.SPEC_CACHE_TTL)
+
+# Commits at the head of branches (and other refs) of each repo, resolved at
+# most once per head_cache_ttl seconds rather than on every lookup
+_heads = cache.LRUCache(2**20, static.HEAD_CACHE_TTL)
+
+# Manifests of the repos read recently, per commit (see RepoManifest)
+_manifests = cache.LRUCache(
+    static.MANIFEST_CACHE_SIZE,
+    static.SPEC_CACHE_TTL,
+    max_items=static.MANIFEST_CACHE_SIZE,
+)
+_manifest_flights = cache.SingleFlight()
+
+
+def _resolveRef(key, resolve):
+    """Returns the commit hash the given ref (keyed on repo and ref) points to,
+    calling resolve() (an API call) only if it was not resolved recently."""
+    sha = _heads.get(key)
+    if sha is None:
+        sha = resolve()
+        _heads.set(key, sha)
+    return sha
+
+
+def dropHeads():
+    """Forget the resolved heads of all repos, so they are resolved again on
+    the next lookup (e.g. after a push)."""
+    _heads.clear()
+
+
+def _pruneSnapshots(directory, keep):
+    """Remove all but the `keep` most recently used snapshots (the commit
+    directories) of a repo, so snapshots of busy repos do not fill the disk."""
+    if keep <= 0:
+        return
+    try:
+        snapshots = [
+            path.join(directory, name)
+            for name in os.listdir(directory)
+            if not name.startswith(".")
+        ]
+        snapshots.sort(key=path.getmtime, reverse=True)
+    except OSError as e:
+        glogger.debug("Could not list snapshots in {}: {}".format(directory, e))
+        return
+    for snapshot in snapshots[keep:]:
+        glogger.debug("Removing snapshot {}".format(snapshot))
+        shutil.rmtree(snapshot, ignore_errors=True)
+
+
+def _snapshotPath(snapshot, *parts):
+    """Returns the path of a file (or directory) of a snapshot, or None if it
+    would be outside the snapshot (e.g. a subdir with ../ in it)."""
+    root = path.realpath(snapshot)
+    filename = path.realpath(path.join(root, *parts))
+    if filename != root and not filename.startswith(root + os.sep):
+        glogger.warning("Path outside of snapshot refused: {}".format(parts))
+        return None
+    return filename
+
+
+def _gitBlobSha(content):
+    """Returns the git object id of a file with the given (bytes) content."""
+    header = "blob {}\0".format(len(content)).encode("utf-8")
+    return hashlib.sha1(header + content).hexdigest()
+
+
+class RepoManifest:
+    """Index of the files of a repo (or of its subdirectory) at one commit,
+    with the contents of its endpoint.txt and the URL of its licence. It is
+    built with a single listing of the files (two, if the licence is only found
+    in the root of the repo), and answers file lookups without further calls.
+    File contents are read when first needed, and kept in the index."""
+
+    def __init__(self, loader):
+        self.files = {f["name"]: f for f in loader.fetchFiles()}
+        self.endpoint = self.getText(loader, "endpoint.txt")
+        self.licence_url = self._findLicence(self.files.values())
+        if self.licence_url is None and loader.subdir:
+            glogger.debug("FileLoader -- No Subdir...")
+            try:
+                self.licence_url = self._findLicence(loader._fetchFilesFromPath(""))
+            except Exception:
+                pass
+
+    @staticmethod
+    def _findLicence(files):
+        for f in files:
+            if f["name"].lower() == "license" or f["name"].lower() == "licence":
+                return f["download_url"]
+        return None
+
+    def getText(self, loader, name):
+        """Returns the content of the named file, or None if it does not exist."""
+        item = self.files.get(name)
+        if item is None:
+            return None
+        return loader._readItem(item)
+
 
 class BaseLoader:
     """Base class for File Loaders"""
@@ -45,6 +158,10 @@ class BaseLoader:
     def getLicenceURL(self):
         """Returns the URL of the license file in this repository if one exists.
         Default implementation for loaders that support subdirectories."""
+        manifest = self.getManifest()
+        if manifest is not None:
+            return manifest.licence_url
+
         # Check subdirectory first (if subdir is set)
         if hasattr(self, "subdir") and self.subdir:
             licence_url = self._getLicenseFileFromPath(self.subdir.strip("/"))
@@ -73,8 +190,12 @@ class BaseLoader:
         ]
         candidates = [(name, guessQueryType(name)) for name in candidateNames]
 
+        manifest = self.getManifest()
         for queryFullName, queryType in candidates:
-            queryText = self._getText(queryFullName)
+            if manifest is not None:
+                queryText = manifest.getText(self, queryFullName)
+            else:
+                queryText = self._getText(queryFullName)
             if queryText:
                 if queryType == qType["JSON"]:
                     queryText = json.loads(queryText)
@@ -93,6 +214,77 @@ class BaseLoader:
         """To be implemented by sub-classes"""
         raise NotImplementedError("Subclasses must override fetchFiles()!")
 
+    def getNeighbourCommits(self, sha=None):
+        """Returns the given commit (or the latest one, if none is given), and
+        the commits before and after it (None if there are none). Default
+        implementation for loaders with a short commit list."""
+        commit_list = self.getCommitList()
+        version = sha if sha else commit_list[0]
+        if version not in commit_list:
+            return version, None, None
+        index = commit_list.index(version)
+        prev_commit = commit_list[index + 1] if index < len(commit_list) - 1 else None
+        next_commit = commit_list[index - 1] if index > 0 else None
+        return version, prev_commit, next_commit
+
+    def _findNextCommit(self, sha, commits, parentsOf):
+        """Returns the first commit in `commits` (newest first) whose parents
+        include `sha`, looking at no more than `neighbour_scan_limit` commits.
+        Found commits are cached, as they do not change."""
+        key = (self.getRepoURI(), sha)
+        next_commit = _next_commits.get(key)
+        if next_commit is not None:
+            return next_commit
+
+        for i, commit in enumerate(commits):
+            if i >= static.NEIGHBOUR_SCAN_LIMIT:
+                glogger.debug("No commit found after {} within limit".format(sha))
+                break
+            commit_sha, parents = parentsOf(commit)
+            if sha in parents:
+                next_commit = commit_sha
+                break
+        if next_commit is not None:
+            _next_commits.set(key, next_commit)
+        return next_commit
+
+    def getCommitSha(self):
+        """Returns an identifier of the version of the files this loader reads
+        from (e.g. the full commit hash), or None if their content can change
+        without notice. Sub-classes override this for versioned sources."""
+        return None
+
+    def getManifest(self):
+        """Returns the RepoManifest of the files this loader reads from, or None
+        if files are read one by one. Loaders of remote repos override this
+        (see _getManifest)."""
+        return None
+
+    def _getManifest(self):
+        """Returns the RepoManifest of the commit this loader reads from, built
+        once per commit (and subdirectory) and shared by all loaders reading
+        it. If it cannot be built, files are read one by one (returns None)."""
+        try:
+            sha = self.getCommitSha()
+            key = (self.getRepoURI(), sha, self.subdir)
+        except Exception as e:
+            glogger.debug("No manifest for this repo: {}".format(e))
+            return None
+        manifest = _manifests.get(key)
+        if manifest is None:
+
+            def build():
+                manifest = RepoManifest(self)
+                _manifests.set(key, manifest, size=1)
+                return manifest
+
+            try:
+                manifest = _manifest_flights.do(key, build)
+            except Exception as e:
+                glogger.debug("No manifest for this repo: {}".format(e))
+                return None
+        return manifest
+
 
 class GithubLoader(BaseLoader):
     """Github based File Loader. Retrieves information from specified Github
@@ -112,7 +304,13 @@ class GithubLoader(BaseLoader):
         self.subdir = (subdir + "/") if subdir else ""
         self.sha = sha if sha else NotSet
         self.prov = prov
-        gh = Github(auth=Auth.Token(static.GITHUB_ACCESS_TOKEN))
+        # Snapshot of the repo on disk (see _getSnapshot), shared by copies
+        self._snapshot = {}
+        self._snapshot_lock = threading.Lock()
+        gh = Github(
+            auth=Auth.Token(static.GITHUB_ACCESS_TOKEN),
+            timeout=int(static.HTTP_READ_TIMEOUT),
+        )
         try:
             self.gh_repo = gh.get_repo(user + "/" + repo, lazy=False)
         except BadCredentialsException:
@@ -126,18 +324,102 @@ class GithubLoader(BaseLoader):
         """Returns a list of file items contained on the github repo."""
         return self._fetchFilesFromPath(self.subdir)
 
+    def _getSnapshot(self):
+        """Returns the commit hash and local directory of the snapshot of the
+        repo this loader reads from. The first time, the archive of the commit
+        is downloaded with a single request and unpacked in the snapshot
+        directory, where it is reused by all loaders (and processes) reading
+        the same commit. A loader of the default branch keeps reading the
+        commit it took its snapshot from."""
+        with self._snapshot_lock:
+            if self._snapshot and not path.isdir(self._snapshot["path"]):
+                # Evicted meanwhile (see _pruneSnapshots), so it is fetched again
+                self._snapshot.clear()
+            if not self._snapshot:
+                sha = self._resolveCommitSha()
+                target = path.join(static.SNAPSHOT_DIR, self.user, self.repo, sha)
+                if path.isdir(target):
+                    # Snapshots in use are kept when older ones are evicted
+                    os.utime(target)
+                else:
+                    self._downloadSnapshot(sha, target)
+                    _pruneSnapshots(path.dirname(target), static.SNAPSHOT_KEEP)
+                self._snapshot.update(sha=sha, path=target)
+            return self._snapshot["sha"], self._snapshot["path"]
+
+    def _downloadSnapshot(self, sha, target):
+        """Download the archive of the given commit and unpack it as target."""
+        glogger.info(
+            "Downloading snapshot of {}/{} at {}".format(self.user, self.repo, sha)
+        )
+        url = self.gh_repo.get_archive_link("tarball", ref=sha)
+        response = connections.get(
+            url, headers={"User-Agent": static.USER_AGENT}, stream=True
+        )
+        response.raise_for_status()
+
+        parent = path.dirname(target)
+        os.makedirs(parent, exist_ok=True)
+        unpacked = tempfile.mkdtemp(dir=parent, prefix=".download-")
+        try:
+            with tarfile.open(fileobj=response.raw, mode="r|gz") as archive:
+                archive.extractall(unpacked, filter="data")
+            # The archive holds a single top level directory (user-repo-sha)
+            (root,) = os.listdir(unpacked)
+            try:
+                os.rename(path.join(unpacked, root), target)
+            except OSError:
+                # Another process has unpacked the same snapshot meanwhile
+                if not path.isdir(target):
+                    raise
+        finally:
+            response.close()
+            shutil.rmtree(unpacked, ignore_errors=True)
+
     def _fetchFilesFromPath(self, filepath):
         """Returns a list of file items from the specified path in the github repo."""
         filepath = filepath.strip("/")
+        if static.GITHUB_SNAPSHOTS:
+            return self._fetchFilesFromSnapshot(filepath)
         contents = self.gh_repo.get_contents(filepath, ref=self.sha)
         files = []
         for content_file in contents:
             if content_file.type == "file":
+                # Contents are only downloaded when read, so files whose blob
+                # is already known (see `sha`) cost no further API calls
                 files.append(
                     {
                         "download_url": content_file.download_url,
                         "name": content_file.name,
-                        "decoded_content": content_file.decoded_content,
+                        "sha": getattr(content_file, "sha", None),
+                        "content_file": content_file,
+                    }
+                )
+        return files
+
+    def _fetchFilesFromSnapshot(self, filepath):
+        """Returns a list of file items from the specified path in the snapshot."""
+        sha, snapshot = self._getSnapshot()
+        directory = _snapshotPath(snapshot, filepath)
+        if directory is None or not path.isdir(directory):
+            return []
+        files = []
+        for name in sorted(os.listdir(directory)):
+            filename = path.join(directory, name)
+            if path.isfile(filename):
+                with open(filename, "rb") as f:
+                    content = f.read()
+                files.append(
+                    {
+                        "download_url": "{}{}/{}/{}".format(
+                            static.GITHUB_RAW_BASE_URL,
+                            self.gh_repo.full_name,
+                            sha,
+                            path.join(filepath, name).lstrip("/"),
+                        ),
+                        "name": name,
+                        "sha": _gitBlobSha(content),
+                        "decoded_content": content,
                     }
                 )
         return files
@@ -159,11 +441,24 @@ class GithubLoader(BaseLoader):
         # Add query URI as used entity by the logged activity
         if self.prov is not None:
             self.prov.add_used_entity(raw_query_uri)
+        return self._readItem(fileItem)
+
+    def _readItem(self, fileItem):
+        """Returns the contents of the given file item, fetched once."""
+        if "decoded_content" not in fileItem:
+            fileItem["decoded_content"] = fileItem["content_file"].decoded_content
         return str(fileItem["decoded_content"], "utf-8")
 
     def _getText(self, query_name):
         """Return the content of the specified file contained in the github repo.
         Returns None if the file does not exist."""
+        if static.GITHUB_SNAPSHOTS:
+            _, snapshot = self._getSnapshot()
+            filename = _snapshotPath(snapshot, self.subdir, query_name)
+            if filename is None or not path.isfile(filename):
+                return None
+            with open(filename, "rb") as f:
+                return str(f.read(), "utf-8")
         try:
             c = self.gh_repo.get_contents(self.subdir + query_name)
             return str(c.decoded_content, "utf-8")
@@ -186,6 +481,40 @@ class GithubLoader(BaseLoader):
         """Return a list of commits on the github repo."""
         return [c.sha for c in self.gh_repo.get_commits()]
 
+    def getNeighbourCommits(self, sha=None):
+        """Returns the given commit (or the latest one, if none is given), and
+        the commits before (its first parent) and after it (a commit of the
+        default branch whose parent it is, searched among the commits made
+        since)."""
+        commit = self.gh_repo.get_commit(sha if sha else self.getCommitSha())
+        version = sha if sha else commit.sha
+        prev_commit = commit.parents[0].sha if commit.parents else None
+        next_commit = self._findNextCommit(
+            commit.sha,
+            self.gh_repo.get_commits(since=commit.commit.committer.date),
+            lambda c: (c.sha, [p.sha for p in c.parents]),
+        )
+        return version, prev_commit, next_commit
+
+    def getCommitSha(self):
+        """Return the full hash of the commit (or of the head of the default
+        branch, if none was given) the loader reads from."""
+        if self.sha is not NotSet and _FULL_SHA.match(self.sha):
+            return self.sha
+        if static.GITHUB_SNAPSHOTS:
+            sha, _ = self._getSnapshot()
+            return sha
+        return self._resolveCommitSha()
+
+    def _resolveCommitSha(self):
+        if self.sha is not NotSet and _FULL_SHA.match(self.sha):
+            return self.sha
+        ref = self.gh_repo.default_branch if self.sha is NotSet else self.sha
+        return _resolveRef(
+            (static.TYPE_GITHUB, self.gh_repo.full_name, ref),
+            lambda: self.gh_repo.get_commit(ref).sha,
+        )
+
     def getFullName(self):
         """Return the full name of the github repo (user/repo)."""
         return self.gh_repo.full_name
@@ -196,8 +525,14 @@ class GithubLoader(BaseLoader):
 
     def getEndpointText(self):
         """Return content of endpoint file (endpoint.txt)"""
+        manifest = self.getManifest()
+        if manifest is not None:
+            return manifest.endpoint
         return self._getText("endpoint.txt")
 
+    def getManifest(self):
+        return self._getManifest()
+
     def getRepoDescription(self):
         """Return the description of the repository"""
         return self.gh_repo.description
@@ -222,7 +557,9 @@ class GitlabLoader(BaseLoader):
         self.sha = sha if sha else None
         self.prov = prov
         gl = gitlab.Gitlab(
-            url=static.GITLAB_URL, private_token=static.GITLAB_ACCESS_TOKEN
+            url=static.GITLAB_URL,
+            private_token=static.GITLAB_ACCESS_TOKEN,
+            timeout=static.HTTP_READ_TIMEOUT,
         )
         try:
             self.gl_repo = gl.projects.get(user + "/" + repo)
@@ -249,13 +586,12 @@ class GitlabLoader(BaseLoader):
         for gitlab_file in gitlab_files:
             if gitlab_file["type"] == "blob":
                 name = gitlab_file["name"]
+                # Contents are only downloaded when read (see getTextFor)
                 files.append(
                     {
                         "download_url": path.join(self.getRawRepoUri(), filepath, name),
                         "name": name,
-                        "decoded_content": str.encode(
-                            self._getText(gitlab_file["name"])
-                        ),
+                        "sha": gitlab_file.get("id"),
                     }
                 )
         return files
@@ -273,6 +609,12 @@ class GitlabLoader(BaseLoader):
         # Add query URI as used entity by the logged activity
         if self.prov is not None:
             self.prov.add_used_entity(raw_query_uri)
+        return self._readItem(fileItem)
+
+    def _readItem(self, fileItem):
+        """Returns the contents of the given file item, fetched once."""
+        if "decoded_content" not in fileItem:
+            fileItem["decoded_content"] = str.encode(self._getText(fileItem["name"]))
         return str(fileItem["decoded_content"], "utf-8")
 
     def _getText(self, query_name):
@@ -302,6 +644,33 @@ class GitlabLoader(BaseLoader):
         """Return a list of commits on the gitlab repo."""
         return [c.id for c in self.gl_repo.commits.list()]
 
+    def getNeighbourCommits(self, sha=None):
+        """Returns the given commit (or the latest one, if none is given), and
+        the commits before (its first parent) and after it (a commit of the
+        branch whose parent it is, searched among the commits made since)."""
+        commit = self.gl_repo.commits.get(sha if sha else self.branch)
+        version = sha if sha else commit.id
+        prev_commit = commit.parent_ids[0] if commit.parent_ids else None
+        next_commit = self._findNextCommit(
+            commit.id,
+            self.gl_repo.commits.list(
+                ref_name=self.branch, since=commit.committed_date, iterator=True
+            ),
+            lambda c: (c.id, c.parent_ids),
+        )
+        return version, prev_commit, next_commit
+
+    def getCommitSha(self):
+        """Return the full hash of the commit (or of the head of the branch, if
+        none was given) the loader reads from."""
+        if self.sha and _FULL_SHA.match(self.sha):
+            return self.sha
+        ref = self.sha or self.branch
+        return _resolveRef(
+            (static.TYPE_GITLAB, self.gl_repo.path_with_namespace, ref),
+            lambda: self.gl_repo.commits.get(ref).id,
+        )
+
     def getFullName(self):
         """Return the full name of the gitlab repo (user/repo)."""
         return self.gl_repo.path_with_namespace
@@ -312,8 +681,14 @@ class GitlabLoader(BaseLoader):
 
     def getEndpointText(self):
         """Return content of endpoint file (endpoint.txt)"""
+        manifest = self.getManifest()
+        if manifest is not None:
+            return manifest.endpoint
         return self._getText("endpoint.txt")
 
+    def getManifest(self):
+        return self._getManifest()
+
     def getRepoDescription(self):
         """Return the description of the repository"""
         return self.gl_repo.description
@@ -394,6 +769,17 @@ class LocalLoader(BaseLoader):
         """Return a list of commits (always a single commit) on the local repo."""
         return ["local"]
 
+    def getCommitSha(self):
+        """Return a fingerprint of the names, sizes and modification times of
+        the files in the local repo, which changes whenever one of them does."""
+        fingerprint = hashlib.sha1()
+        for f in sorted(glob(path.join(self.baseDir, "*"))):
+            stat = os.stat(f)
+            fingerprint.update(
+                "{}:{}:{};".format(f, stat.st_size, stat.st_mtime_ns).encode("utf-8")
+            )
+        return fingerprint.hexdigest()
+
     def getFullName(self):
         """Return the user/repo equivalent for the local repo."""
         return "local/"
@@ -425,7 +811,9 @@ class URLLoader(BaseLoader):
         spec_url -- URL where the specification YAML file is located.  User-agent header required by wikidata
         """
         headers = {"Accept": "text/yaml", "User-Agent": static.USER_AGENT}
-        resp = requests.get(spec_url, headers=headers)
+        resp = requests.get(
+            spec_url, headers=headers, timeout=connections.get_timeout(spec_url)
+        )
         if resp.status_code == 200:
             self.spec = yaml.safe_load(resp.text)
             self.spec["url"] = spec_url
@@ -488,7 +876,9 @@ class URLLoader(BaseLoader):
             itemUrl = urljoin(
                 self.spec["url"], itemUrl
             )  # Join with base URL if relative URL
-            resp = requests.get(itemUrl, headers=headers)
+            resp = requests.get(
+                itemUrl, headers=headers, timeout=connections.get_timeout(itemUrl)
+            )
             if resp.status_code == 200:
                 return resp.text
             else:
@@ -6,20 +6,41 @@
 
 # gquery.py: functions that deal with / transform SPARQL queries in grlc
 
+import io
+import os
+import copy
+import base64
+import time
+import hashlib
 import yaml
 import json
-from rdflib.plugins.sparql.parser import Query, UpdateUnit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from rdflib import URIRef, Literal, Variable
+from rdflib.query import Result
+from rdflib.plugins.sparql.parser import (
+    Query,
+    UpdateUnit,
+    Prologue,
+    SelectClause,
+    DatasetClause,
+)
+from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.plugins.sparql.processor import translateQuery
 from flask import request, has_request_context
-from pyparsing import ParseException
+from pyparsing import ParseException, Located, rest_of_line
 from pprint import pformat
 import traceback
 import re
-import requests
 import SPARQLTransformer
 
 # grlc modules
 import grlc.static as static
+import grlc.connections as connections
+import grlc.cache as cache
 import grlc.glogging as glogging
 
 
@@ -27,14 +48,43 @@ glogger = glogging.getGrlcLogger(__name__)
 
 XSD_PREFIX = "PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>"
 
-
-def guess_endpoint_uri(rq, loader):
+# Values of enumerated parameters, keyed on endpoint and enumeration query, with
+# the time they were fetched. Identical enumerations which are not cached yet
+# are fetched once (by all worker processes, if singleflight_dir is set).
+enumeration_cache = cache.LRUCache(static.ENUMERATION_CACHE_SIZE)
+enumeration_flights = cache.SingleFlight(
+    static.SINGLEFLIGHT_DIR, static.ENUMERATION_CACHE_TTL
+)
+_enumeration_refresher = None
+_enumeration_refreshing = set()
+_enumeration_lock = threading.Lock()
+
+# Counts of the results of paginated queries, keyed on endpoint and query
+count_cache = cache.LRUCache(static.COUNT_CACHE_SIZE, static.COUNT_CACHE_TTL)
+count_flights = cache.SingleFlight()
+COUNT_VARIABLE = "grlc_count"
+
+# Decorators and metadata of the queries executed recently, keyed on a hash of
+# their text, so API calls do not parse the same query over and over
+decorator_cache = cache.LRUCache(static.QUERY_CACHE_SIZE, static.QUERY_CACHE_TTL)
+query_cache = cache.LRUCache(static.QUERY_CACHE_SIZE, static.QUERY_CACHE_TTL)
+
+
+def _split_endpoints(value):
+    """Returns the list of endpoint URIs given as a YAML list, or as a string
+    with one or more URIs separated by white space."""
+    if isinstance(value, list):
+        return [str(e).strip() for e in value if str(e).strip()]
+    return str(value).split()
+
+
+def guess_endpoint_uris(rq, loader):
     """
-    Guesses the endpoint URI from (in this order):
+    Guesses the endpoint URIs (one or more replicas) from (in this order):
     - An endpoint parameter in URL
-    - An #+endpoint decorator
-    - A endpoint.txt file in the repo
-    Otherwise assigns a default one
+    - An #+endpoint decorator (a URI or a list of URIs)
+    - A endpoint.txt file in the repo (one URI per line)
+    Otherwise assigns the default ones
     """
     auth = (static.DEFAULT_ENDPOINT_USER, static.DEFAULT_ENDPOINT_PASSWORD)
     if auth == ("none", "none"):
@@ -43,60 +93,142 @@ def guess_endpoint_uri(rq, loader):
     if has_request_context() and "endpoint" in request.args:
         endpoint = request.args["endpoint"]
         glogger.debug("Endpoint provided in request: " + endpoint)
-        return endpoint, auth
+        return [endpoint], auth
 
     # Decorator
     try:
         decorators = get_yaml_decorators(rq)
-        endpoint = decorators["endpoint"]
+        endpoints = _split_endpoints(decorators["endpoint"])
         auth = None
-        glogger.debug("Decorator guessed endpoint: " + endpoint)
+        glogger.debug("Decorator guessed endpoints: {}".format(endpoints))
     except (TypeError, KeyError):
         # File
         try:
             endpoint_content = loader.getEndpointText()
-            endpoint = endpoint_content.strip().splitlines()[0]
+            endpoints = _split_endpoints(endpoint_content)
+            if not endpoints:
+                raise ValueError("No endpoint in endpoint.txt")
             auth = None
-            glogger.debug("File guessed endpoint: " + endpoint)
+            glogger.debug("File guessed endpoints: {}".format(endpoints))
         # TODO: except all is really ugly
         except Exception:
             # Default
-            endpoint = static.DEFAULT_ENDPOINT
+            endpoints = _split_endpoints(static.DEFAULT_ENDPOINT) or [""]
             auth = (static.DEFAULT_ENDPOINT_USER, static.DEFAULT_ENDPOINT_PASSWORD)
             if auth == ("none", "none"):
                 auth = None
-            glogger.info("No endpoint specified, using default ({})".format(endpoint))
+            glogger.info("No endpoint specified, using default ({})".format(endpoints))
 
-    return endpoint, auth
+    return endpoints, auth
 
 
-def count_query_results(query, endpoint):
+def guess_endpoint_uri(rq, loader):
     """
-    Returns the total number of results that query 'query' will generate
-    WARNING: This is too expensive just for providing a number of result pages
-             Providing a dummy count for now
+    Guesses the endpoint URI, as guess_endpoint_uris. If several replicas are
+    given, the first one is returned.
     """
+    endpoints, auth = guess_endpoint_uris(rq, loader)
+    return (endpoints[0] if endpoints else ""), auth
 
-    # number_results_query, repl = re.subn("SELECT.*FROM", "SELECT COUNT (*) FROM", query)
-    # if not repl:
-    #     number_results_query = re.sub("SELECT.*{", "SELECT COUNT(*) {", query)
-    # number_results_query = re.sub("GROUP\s+BY\s+[\?\_\(\)a-zA-Z0-9]+", "", number_results_query)
-    # number_results_query = re.sub("ORDER\s+BY\s+[\?\_\(\)a-zA-Z0-9]+", "", number_results_query)
-    # number_results_query = re.sub("LIMIT\s+[0-9]+", "", number_results_query)
-    # number_results_query = re.sub("OFFSET\s+[0-9]+", "", number_results_query)
-    #
-    # glogger.debug("Query for result count: " + number_results_query)
-    #
-    # # Preapre HTTP request
-    # headers = { 'Accept' : 'application/json' }
-    # data = { 'query' : number_results_query }
-    # count_json = requests.get(endpoint, params=data, headers=headers).json()
-    # count = int(count_json['results']['bindings'][0]['callret-0']['value'])
-    # glogger.info("Paginated query has {} results in total".format(count))
-    #
-    # return count
-
-    return 1000
+
+def count_query(query):
+    """
+    Returns a query counting the results of SELECT query 'query': the query
+    itself, as a subquery of a COUNT, after its prologue (PREFIX and BASE
+    declarations). Its dataset (FROM and FROM NAMED clauses), which subqueries
+    cannot have, is moved to the COUNT. Returns None if the result is not a
+    valid SELECT query.
+    """
+    try:
+        with _parse_lock:
+            end = _prologue.parse_string(query)["locn_end"]
+            select_end = end + _select_clause.parse_string(query[end:])["locn_end"]
+            dataset, dataset_end = _dataset(query, select_end)
+    except ParseException as pe:
+        glogger.debug("Cannot count results of query: {}".format(pe))
+        return None
+    counting_query = "{}\nSELECT (COUNT(*) AS ?{}){} WHERE {{\n{}{}\n}}".format(
+        query[:end],
+        COUNT_VARIABLE,
+        "".join("\n" + clause for clause in dataset),
+        query[end:select_end],
+        query[dataset_end:],
+    )
+    try:
+        parsed = enable_custom_function_prefix(counting_query, "bif")
+        parsed = enable_custom_function_prefix(parsed, "sql")
+        query_type, variables = parse_query(parsed)
+    except ParseException as pe:
+        glogger.debug("Cannot count results of query: {}".format(pe))
+        return None
+    if query_type != "SelectQuery":
+        return None
+    return counting_query
+
+
+def _dataset(query, start):
+    """Returns the FROM / FROM NAMED clauses of a query found at 'start' (right
+    after its SELECT clause), and where they end."""
+    clauses = []
+    while True:
+        try:
+            located = _dataset_clause.parse_string(query[start:])
+        except ParseException:
+            return clauses, start
+        clause_start = start + located["locn_start"]
+        start += located["locn_end"]
+        clauses.append(query[clause_start:start])
+
+
+def _fetch_count(query, endpoints, auth, method):
+    """Sends the COUNT query of 'query' to one of the endpoints."""
+    counting_query = count_query(query)
+    if counting_query is None:
+        return None
+    glogger.debug("Query for result count: " + counting_query)
+    headers = {"Accept": static.mimetypes["json"], "User-Agent": static.USER_AGENT}
+    if method == "GET":
+        response = connections.balanced_request(
+            "GET",
+            endpoints,
+            params={"query": counting_query},
+            headers=headers,
+            auth=auth,
+        )
+    else:
+        headers["Content-Type"] = "application/sparql-query"
+        response = connections.balanced_request(
+            "POST", endpoints, data=counting_query, headers=headers, auth=auth
+        )
+    response.raise_for_status()
+    bindings = response.json()["results"]["bindings"]
+    return int(bindings[0][COUNT_VARIABLE]["value"])
+
+
+def count_query_results(query, endpoints, auth=None, method="GET"):
+    """
+    Returns the total number of results that query 'query' will generate
+    (ignoring its LIMIT and OFFSET), or None if they cannot be counted.
+    Counts are cached per endpoint and query, so following pages of the same
+    query are not counted again.
+    """
+    if isinstance(endpoints, str):
+        endpoints = [endpoints]
+    query = _strip_limit(query)
+    key = (tuple(endpoints), query)
+    count = count_cache.get(key)
+    if count is None:
+        try:
+            count = count_flights.do(
+                key, lambda: _fetch_count(query, endpoints, auth, method)
+            )
+        except Exception as e:
+            glogger.warning("Could not count query results: {}".format(e))
+            return None
+        if count is not None:
+            count_cache.set(key, count, size=len(query))
+    glogger.info("Paginated query has {} results in total".format(count))
+    return count
 
 
 def _getDictWithKey(key, dict_list):
@@ -236,26 +368,104 @@ def get_enumeration_sparql(rq, v, endpoint, auth=None):
                 rq,
                 flags=re.DOTALL,
             )
+        if static.ENUMERATION_MAX_VALUES:
+            codes_subquery += " LIMIT {}".format(static.ENUMERATION_MAX_VALUES)
         glogger.debug("Codes subquery: {}".format(codes_subquery))
         glogger.debug(endpoint)
-        codes_json = requests.get(
-            endpoint,
-            params={"query": codes_subquery},
-            headers={
-                "Accept": static.mimetypes["json"],
-                "Authorization": "token {}".format(static.SPARQL_ACCESS_TOKEN),
-                "User-Agent": static.USER_AGENT,
-            },
-            auth=auth,
-        ).json()
-        for code in codes_json["results"]["bindings"]:
-            vcodes.append(list(code.values())[0]["value"])
+        vcodes = get_enumeration_values(endpoint, codes_subquery, auth)
     else:
         glogger.debug("No match between variable name and query.")
 
     return vcodes
 
 
+def _fetch_enumeration_values(endpoint, codes_subquery, auth):
+    """Sends an enumeration query to the endpoint, returning the values found."""
+    codes_json = connections.get(
+        endpoint,
+        params={"query": codes_subquery},
+        headers={
+            "Accept": static.mimetypes["json"],
+            "Authorization": "token {}".format(static.SPARQL_ACCESS_TOKEN),
+            "User-Agent": static.USER_AGENT,
+        },
+        auth=auth,
+    ).json()
+    vcodes = []
+    for code in codes_json["results"]["bindings"]:
+        vcodes.append(list(code.values())[0]["value"])
+    return vcodes
+
+
+def get_enumeration_values(endpoint, codes_subquery, auth=None):
+    """
+    Returns the values of the given enumeration query. Cached values are
+    returned even once they are older than `enumeration_cache_ttl`: they are
+    then refreshed in the background, so only the first spec built for an
+    enumeration waits for its query.
+    """
+    key = (endpoint, codes_subquery, auth)
+    if not enumeration_cache.enabled:
+        return _fetch_enumeration_values(endpoint, codes_subquery, auth)
+
+    entry = enumeration_cache.get(key)
+    if entry is None:
+        vcodes = enumeration_flights.do(
+            key, lambda: _fetch_enumeration_values(endpoint, codes_subquery, auth)
+        )
+        enumeration_cache.set(key, (time.time(), vcodes))
+        return vcodes
+
+    fetched, vcodes = entry
+    if (
+        static.ENUMERATION_CACHE_TTL
+        and time.time() - fetched >= static.ENUMERATION_CACHE_TTL
+    ):
+        _refresh_enumeration(key)
+    return vcodes
+
+
+def _get_enumeration_refresher():
+    global _enumeration_refresher
+
+    with _enumeration_lock:
+        if _enumeration_refresher is None:
+            _enumeration_refresher = ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="grlc-enum"
+            )
+        return _enumeration_refresher
+
+
+def _refresh_enumeration(key):
+    """Schedule a refresh of the cached enumeration, unless one is running."""
+    with _enumeration_lock:
+        if key in _enumeration_refreshing:
+            return
+        _enumeration_refreshing.add(key)
+    glogger.debug("Refreshing enumeration for {}".format(key[0]))
+    _get_enumeration_refresher().submit(_do_refresh_enumeration, key)
+
+
+def _do_refresh_enumeration(key):
+    try:
+        vcodes = _fetch_enumeration_values(*key)
+        enumeration_cache.set(key, (time.time(), vcodes))
+    except Exception as e:
+        glogger.warning(
+            "Could not refresh enumeration, keeping old values: {}".format(e)
+        )
+    finally:
+        with _enumeration_lock:
+            _enumeration_refreshing.discard(key)
+
+
+def _query_hash(rq):
+    """Returns a hash of the text of a query (or of a JSON query)."""
+    if isinstance(rq, dict):
+        rq = json.dumps(rq, sort_keys=True)
+    return hashlib.sha1(rq.encode("utf-8")).hexdigest()
+
+
 def get_yaml_decorators(rq):
     """
     Returns the yaml decorator metadata only (this is needed by triple pattern fragments)
@@ -264,6 +474,17 @@ def get_yaml_decorators(rq):
     if not rq:
         return None
 
+    key = _query_hash(rq)
+    query_metadata = decorator_cache.get(key)
+    if query_metadata is None:
+        query_metadata = _parse_yaml_decorators(rq)
+        decorator_cache.set(key, copy.deepcopy(query_metadata))
+    # Callers add their own keys to the decorators
+    return copy.deepcopy(query_metadata)
+
+
+def _parse_yaml_decorators(rq):
+
     yaml_string = ""
     query_string = ""
     query_metadata = None
@@ -271,7 +492,8 @@ def get_yaml_decorators(rq):
         if "grlc" in rq:
             yaml_string = rq["grlc"]
             query_string = rq
-            query_metadata = yaml_string
+            # A copy, so the query itself is left unchanged
+            query_metadata = dict(yaml_string)
 
     else:  # classic query
         yaml_string = "\n".join(
@@ -312,6 +534,88 @@ def enable_custom_function_prefix(rq, prefix):
     return rq
 
 
+_parse_executor = None
+_parse_executor_pid = None
+_parse_executor_lock = threading.Lock()
+# pyparsing (used by rdflib) is not thread safe, so queries are parsed one at a
+# time in each process
+_parse_lock = threading.Lock()
+# The PREFIX and BASE declarations at the start of a query, with their end
+_prologue = Located(Prologue).ignore("#" + rest_of_line)
+# The SELECT clause of a query, and each of its FROM / FROM NAMED clauses
+_select_clause = Located(SelectClause).ignore("#" + rest_of_line)
+_dataset_clause = Located(DatasetClause).ignore("#" + rest_of_line)
+
+
+def _translate_query(rq):
+    """Parses a SELECT, CONSTRUCT, DESCRIBE or ASK query. Returns the type of
+    its algebra and its projection variables (None if it has none)."""
+    try:
+        with _parse_lock:
+            parsed_query = translateQuery(Query.parse_string(rq, parse_all=True))
+    except ParseException as pe:
+        # Parse errors do not survive pickling, so their message is returned
+        return None, None, str(pe)
+    return parsed_query.algebra.name, parsed_query.algebra.get("PV"), None
+
+
+def _get_parse_executor():
+    global _parse_executor, _parse_executor_pid
+
+    with _parse_executor_lock:
+        if _parse_executor is None or _parse_executor_pid != os.getpid():
+            # Workers are not forked from this (multithreaded) process, where
+            # another thread may hold _parse_lock, which they would inherit locked
+            method = (
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+            _parse_executor = ProcessPoolExecutor(
+                max_workers=static.SPEC_BUILD_PROCESSES,
+                mp_context=multiprocessing.get_context(method),
+            )
+            _parse_executor_pid = os.getpid()
+        return _parse_executor
+
+
+def _drop_parse_executor(executor):
+    """Stop using a pool of parsing processes which stopped working."""
+    global _parse_executor
+
+    with _parse_executor_lock:
+        if _parse_executor is executor:
+            _parse_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_query(rq):
+    """Parses a SELECT, CONSTRUCT, DESCRIBE or ASK query, returning the type of
+    its algebra and its projection variables. If `spec_build_processes` is
+    set, parsing (which is CPU bound) runs in a pool of worker processes, so
+    several queries can be parsed at the same time. Queries the pool does not
+    parse within `spec_parse_timeout` seconds are parsed in this process.
+    Raises ParseException if the query cannot be parsed."""
+    result = None
+    if static.SPEC_BUILD_PROCESSES > 0:
+        executor = _get_parse_executor()
+        try:
+            result = executor.submit(_translate_query, rq).result(
+                timeout=static.SPEC_PARSE_TIMEOUT
+            )
+        except FutureTimeoutError:
+            glogger.warning("Query parsing process timed out, parsing in process")
+        except BrokenProcessPool as e:
+            glogger.warning("Query parsing processes failed ({}), restarting".format(e))
+            _drop_parse_executor(executor)
+    if result is None:
+        result = _translate_query(rq)
+    query_type, variables, error = result
+    if error is not None:
+        raise ParseException(rq, 0, error)
+    return query_type, variables
+
+
 def get_metadata(rq, endpoint):
     """
     Returns the metadata 'exp' parsed from the raw query file 'rq'
@@ -334,16 +638,33 @@ def get_metadata(rq, endpoint):
     try:
         # THE PARSING
         # select, describe, construct, ask
-        parsed_query = translateQuery(Query.parse_string(rq, parse_all=True))
-        query_metadata["type"] = parsed_query.algebra.name
+        query_metadata["type"], variables = parse_query(rq)
         if query_metadata["type"] == "SelectQuery":
             # Projection variables
-            query_metadata["variables"] = parsed_query.algebra["PV"]
+            query_metadata["variables"] = variables
             # Parameters
             query_metadata["parameters"] = get_parameters(rq, endpoint, query_metadata)
         elif query_metadata["type"] == "ConstructQuery":
             # Parameters
             query_metadata["parameters"] = get_parameters(rq, endpoint, query_metadata)
+        if (
+            query_metadata["type"] == "SelectQuery"
+            and "pagination" in query_metadata
+            and query_metadata.get("pagination_mode") == "keyset"
+        ):
+            # Key of keyset pagination
+            query_metadata["pagination_key"] = get_pagination_key(rq)
+            if query_metadata["pagination_key"] is None:
+                glogger.warning(
+                    "Query cannot be paged on a key, using LIMIT/OFFSET pagination"
+                )
+        if "parameters" in query_metadata and isinstance(
+            query_metadata["original_query"], str
+        ):
+            # Where request arguments go in the query
+            query_metadata["rewrite_template"] = compile_rewrite_template(
+                query_metadata["original_query"], query_metadata["parameters"]
+            )
         else:
             glogger.warning(
                 "Query type {} is currently unsupported and no metadata was parsed!".format(
@@ -366,7 +687,8 @@ def get_metadata(rq, endpoint):
         try:
             # update query
             glogger.debug("Trying to parse UPDATE query")
-            parsed_query = UpdateUnit.parse_string(rq, parse_all=True)
+            with _parse_lock:
+                parsed_query = UpdateUnit.parse_string(rq, parse_all=True)
             glogger.debug(parsed_query)
             query_metadata["type"] = parsed_query[0]["request"][0].name
             if query_metadata["type"] == "InsertData":
@@ -407,6 +729,27 @@ def get_metadata(rq, endpoint):
     return query_metadata
 
 
+def compile_query(rq, endpoint):
+    """
+    Returns the metadata of the raw query file 'rq' (see get_metadata) which
+    API calls need: its decorators, type and parameters. Queries are parsed
+    once, and reused by further calls while they are cached.
+    """
+    key = (_query_hash(rq), endpoint)
+    query_metadata = query_cache.get(key)
+    if query_metadata is None:
+        query_metadata = get_metadata(rq, endpoint)
+        query_cache.set(key, query_metadata)
+    else:
+        glogger.debug("Using compiled query from cache")
+    return copy.deepcopy(query_metadata)
+
+
+def _strip_limit(query):
+    """Removes the LIMIT and OFFSET of a query."""
+    return re.sub(r"((LIMIT|OFFSET)\s+[0-9]+)*", "", query)
+
+
 def paginate_query(query, results_per_page, get_args):
     """Modify the given query so that it can be paginated. The paginated query will
     split display a maximum of `results_per_page`."""
@@ -420,7 +763,7 @@ def paginate_query(query, results_per_page, get_args):
 
     # If contains LIMIT or OFFSET, remove them
     glogger.debug("Original query: " + query)
-    no_limit_query = re.sub(r"((LIMIT|OFFSET)\s+[0-9]+)*", "", query)
+    no_limit_query = _strip_limit(query)
     glogger.debug("No limit query: " + no_limit_query)
 
     # Append LIMIT results_per_page OFFSET (page-1)*results_per_page
@@ -432,8 +775,289 @@ def paginate_query(query, results_per_page, get_args):
     return paginated_query
 
 
-def rewrite_query(query, parameters, get_args):
-    """Rewrite query to replace query parameters for given values."""
+# Algebra nodes which can be above the ORDER BY of a SELECT query
+_ORDER_BY_PARENTS = ["SelectQuery", "Slice", "Distinct", "Reduced", "Project", "Extend"]
+
+
+def get_pagination_key(rq):
+    """
+    Returns the key on which SELECT query 'rq' is paged in keyset pagination
+    mode: the variables of its ORDER BY conditions followed, to break ties, by
+    the rest of its projected variables. The key is a dict with the variables
+    (and whether each is in descending order) and the projected variables.
+    Returns None if the query cannot be paged on a key (e.g. it is ordered by
+    an expression, or by a variable it does not project).
+    """
+    rq = enable_custom_function_prefix(rq, "bif")
+    rq = enable_custom_function_prefix(rq, "sql")
+    try:
+        with _parse_lock:
+            parsed_query = Query.parse_string(rq, parse_all=True)
+            algebra = translateQuery(parsed_query).algebra
+            prologue_end = _prologue.parse_string(rq)["locn_end"]
+    except ParseException:
+        return None
+
+    projection = [str(v) for v in algebra.get("PV") or []]
+    if not projection:
+        return None
+    if "projection" not in parsed_query[1]:
+        # The variables of SELECT * are in no particular order (which differs
+        # between processes), so they are taken in the order of the query text
+        body = rq[prologue_end:]
+        projection.sort(key=lambda v: _first_occurrence(body, v))
+
+    variables, descending = [], []
+    node = algebra
+    while isinstance(node, CompValue) and node.name in _ORDER_BY_PARENTS:
+        node = node.get("p")
+    if isinstance(node, CompValue) and node.name == "OrderBy":
+        for condition in node.expr:
+            variable = condition
+            if isinstance(condition, CompValue):
+                variable = condition.get("expr")
+            if not isinstance(variable, Variable) or str(variable) not in projection:
+                return None
+            if str(variable) not in variables:
+                variables.append(str(variable))
+                descending.append(
+                    isinstance(condition, CompValue)
+                    and condition.get("order") == "DESC"
+                )
+    for variable in projection:
+        if variable not in variables:
+            variables.append(variable)
+            descending.append(False)
+    return {"variables": variables, "descending": descending, "projection": projection}
+
+
+def _first_occurrence(query, variable):
+    """Returns where variable first appears in query (its length if nowhere)."""
+    match = re.search(r"[?$]{}(?![A-Za-z0-9_])".format(re.escape(variable)), query)
+    return match.start() if match else len(query)
+
+
+def encode_cursor(terms, variables, seen=1):
+    """Returns an opaque cursor for the values (SPARQL JSON result terms, or
+    None if unbound) of the key variables of a query, and the number of rows
+    with these values which were already returned."""
+    data = json.dumps({"key": variables, "values": terms, "seen": seen}, sort_keys=True)
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, variables):
+    """Returns the key values of a cursor made by encode_cursor for the given
+    key variables, and the number of rows with these values already returned.
+    Raises ValueError if the cursor is not valid, or was made
+    for another key (e.g. by a previous version of the query)."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(data.decode("utf-8"))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid pagination cursor")
+    if not isinstance(data, dict) or data.get("key") != variables:
+        raise ValueError("Pagination cursor does not belong to this query")
+    terms, seen = data.get("values"), data.get("seen")
+    if (
+        not isinstance(terms, list)
+        or len(terms) != len(variables)
+        or not isinstance(seen, int)
+        or seen < 1
+    ):
+        raise ValueError("Invalid pagination cursor")
+    for term in terms:
+        if term is not None and (
+            not isinstance(term, dict)
+            or term.get("type") not in ["uri", "literal"]
+            or not isinstance(term.get("value"), str)
+            or not re.fullmatch(
+                r"([a-zA-Z]+(-[a-zA-Z0-9]+)*)?", term.get("xml:lang", "")
+            )
+            or not isinstance(term.get("datatype", ""), str)
+        ):
+            raise ValueError("Invalid pagination cursor")
+    return terms, seen
+
+
+def _render_term(term):
+    """Returns the SPARQL syntax of a (validated) key value."""
+    if term["type"] == "uri":
+        return "<{}>".format(_escape_iri(term["value"]))
+    literal = '"{}"'.format(_escape_literal(term["value"]))
+    if term.get("xml:lang"):
+        return "{}@{}".format(literal, term["xml:lang"])
+    if term.get("datatype"):
+        return "{}^^<{}>".format(literal, _escape_iri(term["datatype"]))
+    return literal
+
+
+def _follows(variable, term, descending):
+    """Returns a condition on which values of variable follow term in the
+    ORDER BY order: unbound values first, then blank nodes, IRIs (in the
+    order of their text) and literals."""
+    if term is None:
+        condition = "false" if descending else "BOUND(?{0})"
+    elif term["type"] == "uri" and descending:
+        condition = "(!BOUND(?{0}) || isBlank(?{0}) || isIRI(?{0}) && STR(?{0}) < {1})"
+    elif term["type"] == "uri":
+        condition = "(isLiteral(?{0}) || isIRI(?{0}) && STR(?{0}) > {1})"
+    elif descending:
+        condition = "(!BOUND(?{0}) || !isLiteral(?{0}) || ?{0} < {2})"
+    else:
+        condition = "?{0} > {2}"
+    if term is None:
+        return condition.format(variable)
+    text = '"{}"'.format(_escape_literal(term["value"]))
+    return condition.format(variable, text, _render_term(term))
+
+
+def _equals(variable, term):
+    """Returns a condition on which values of variable are equal to term."""
+    if term is None:
+        return "!BOUND(?{})".format(variable)
+    if term["type"] == "uri":
+        return "sameTerm(?{}, {})".format(variable, _render_term(term))
+    return "?{} = {}".format(variable, _render_term(term))
+
+
+def paginate_query_keyset(query, results_per_page, key, cursor=None):
+    """Modify the given query so that it returns the `results_per_page` results
+    following the key values in `cursor` (or the first results, if no cursor
+    is given), in the order of the pagination key. Unlike OFFSET, this does
+    not make the endpoint skip the results of the previous pages.
+    The query becomes a subquery, so that the key can also be the result of
+    an aggregate or of an expression of its SELECT clause. Its dataset (FROM
+    and FROM NAMED clauses), which subqueries cannot have, is moved out.
+    Raises ValueError if the cursor is not valid."""
+    query = _strip_limit(query)
+    variables = key["variables"]
+    condition = ""
+    seen = 0
+    if cursor:
+        terms, seen = decode_cursor(cursor, variables)
+        # Rows from the cursor on: equal on the first variables of the key and
+        # following it on the next one, or equal on all of them. The key is
+        # all projected variables, so rows equal on all of them are duplicates,
+        # of which those already returned are skipped.
+        alternatives = []
+        for i, variable in enumerate(variables):
+            alternatives.append(
+                " && ".join(
+                    [_equals(v, t) for v, t in zip(variables[:i], terms)]
+                    + [_follows(variable, terms[i], key["descending"][i])]
+                )
+            )
+        alternatives.append(
+            " && ".join(_equals(v, t) for v, t in zip(variables, terms))
+        )
+        condition = "FILTER(\n  ({})\n)\n".format(")\n  || (".join(alternatives))
+    try:
+        with _parse_lock:
+            end = _prologue.parse_string(query)["locn_end"]
+            select_end = end + _select_clause.parse_string(query[end:])["locn_end"]
+            dataset, dataset_end = _dataset(query, select_end)
+    except ParseException:
+        raise ValueError("Query cannot be paginated")
+    order = [
+        "DESC(?{})".format(v) if desc else "?" + v
+        for v, desc in zip(variables, key["descending"])
+    ]
+    paginated_query = "{}\nSELECT {}{} WHERE {{\n{{\n{}{}\n}}\n{}}}".format(
+        query[:end],
+        " ".join("?" + v for v in key["projection"]),
+        "".join("\n" + clause for clause in dataset),
+        query[end:select_end],
+        query[dataset_end:],
+        condition,
+    )
+    paginated_query += "\nORDER BY {}\nLIMIT {}".format(
+        " ".join(order), results_per_page
+    )
+    if seen:
+        paginated_query += " OFFSET {}".format(seen)
+    glogger.debug("Paginated query: " + paginated_query)
+    return paginated_query
+
+
+# Result formats from which the key of the last result of a page can be read
+_RESULT_FORMATS = {
+    "application/sparql-results+json": "json",
+    "application/json": "json",
+    "application/sparql-results+xml": "xml",
+    "application/xml": "xml",
+    "text/tab-separated-values": "tsv",
+    "text/csv": "csv",
+}
+
+
+def get_next_cursor(resp, content_type, key, results_per_page, cursor=None):
+    """
+    Returns the cursor of the page following the results in 'resp' (the page
+    at 'cursor'), or None if they are the last page (or the key of their last
+    result cannot be read from their format, or is a blank node).
+    """
+    result_format = _RESULT_FORMATS.get((content_type or "").split(";")[0].strip())
+    if result_format is None or not isinstance(resp, (str, bytes)):
+        return None
+    if isinstance(resp, str):
+        resp = resp.encode("utf-8")
+    try:
+        bindings = Result.parse(io.BytesIO(resp), format=result_format).bindings
+    except Exception as e:
+        glogger.debug("Could not read the results of the page: {}".format(e))
+        return None
+    if len(bindings) < results_per_page:
+        return None
+
+    rows = []
+    for binding in bindings:
+        terms = _key_terms(binding, key["variables"], result_format)
+        if terms is None:
+            return None
+        rows.append(terms)
+    # Rows with the same key as the last one, which the next page skips
+    seen = 0
+    while seen < len(rows) and rows[-1 - seen] == rows[-1]:
+        seen += 1
+    if cursor:
+        terms, previously_seen = decode_cursor(cursor, key["variables"])
+        if terms == rows[-1]:
+            seen += previously_seen
+    return encode_cursor(rows[-1], key["variables"], seen)
+
+
+def _key_terms(binding, variables, result_format):
+    """Returns the values of the key variables in a result (as SPARQL JSON
+    result terms, or None if unbound), or None if one is a blank node."""
+    terms = []
+    for variable in variables:
+        value = binding.get(Variable(variable))
+        if value is None:
+            terms.append(None)
+        elif isinstance(value, URIRef):
+            terms.append({"type": "uri", "value": str(value)})
+        elif isinstance(value, Literal):
+            term = {"type": "literal", "value": str(value)}
+            if value.language:
+                term["xml:lang"] = value.language
+            elif value.datatype:
+                term["datatype"] = str(value.datatype)
+            elif result_format == "csv" and _number_matcher.fullmatch(str(value)):
+                # CSV results have no datatypes
+                term["datatype"] = "http://www.w3.org/2001/XMLSchema#decimal"
+            terms.append(term)
+        else:
+            glogger.warning(
+                "Cannot page on blank node {} of ?{}".format(value, variable)
+            )
+            return None
+    return terms
+
+
+def rewrite_query(query, parameters, get_args, template=None):
+    """Rewrite query to replace query parameters for given values. The
+    `template` of a (non JSON) query, as built by compile_rewrite_template,
+    can be given to avoid compiling it again."""
     glogger.debug("Query parameters")
     glogger.debug(parameters)
 
@@ -454,7 +1078,7 @@ def rewrite_query(query, parameters, get_args):
     if isinstance(query, dict):  # json query (sparql transformer)
         query = rewrite_query_json(query, parameters, get_args)
     else:
-        query = rewrite_query_standard(query, parameters, get_args)
+        query = rewrite_query_standard(query, parameters, get_args, template)
 
     glogger.debug("Query rewritten as: " + query)
 
@@ -462,6 +1086,8 @@ def rewrite_query(query, parameters, get_args):
 
 
 def rewrite_query_json(query, parameters, get_args):
+    # Values are added to a copy, so the given (possibly cached) query is kept
+    query = copy.deepcopy(query)
     for pname, p in parameters.items():
         # Get the parameter value from the GET request
         v = get_args.get(pname, None)
@@ -485,34 +1111,82 @@ def rewrite_query_json(query, parameters, get_args):
     return query
 
 
-def rewrite_query_standard(query, parameters, get_args):
+def compile_rewrite_template(query, parameters):
+    """Splits query into a template for rewrite_query_standard: a list whose
+    even items are query text, and odd items the original parameter variables
+    (e.g. ?_name_iri) found between them. Longer variables are matched first,
+    and only as whole variables (so ?_id is not found inside ?_identifier)."""
+    originals = sorted(
+        set(p["original"] for p in parameters.values()), key=len, reverse=True
+    )
+    if not originals:
+        return [query]
+    matcher = re.compile(
+        "({})(?![A-Za-z0-9])".format("|".join(re.escape(o) for o in originals))
+    )
+    return matcher.split(query)
+
+
+def _escape_literal(v):
+    """Escapes a value for use in a quoted SPARQL literal."""
+    return (
+        v.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _escape_iri(v):
+    """Percent-encodes the characters which are not allowed in a SPARQL IRI."""
+    return "".join(
+        "%{:02X}".format(ord(c)) if c in '<>"{}|^`\\' or ord(c) <= 0x20 else c
+        for c in v
+    )
+
+
+_number_matcher = re.compile(r"[+-]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?")
+
+
+def _render_parameter(p, v):
+    """Returns the SPARQL term for value v of parameter p."""
+    # Number (without a datatype)
+    if p["type"] == "number" and _number_matcher.fullmatch(v):
+        return v
+    # If it's a iri
+    if "format" in p and p["format"] == "iri":
+        return "<{}>".format(_escape_iri(v))
+    # If there is a language tag
+    if "lang" in p and p["lang"]:
+        return '"{}"@{}'.format(_escape_literal(v), p["lang"])
+    if "datatype" in p and p["datatype"]:
+        return '"{}"^^{}'.format(_escape_literal(v), p["datatype"])
+    return '"{}"'.format(_escape_literal(v))
+
+
+def rewrite_query_standard(query, parameters, get_args, template=None):
+    """Replaces the parameter variables of query with the values given in
+    get_args, in a single pass over the query template."""
+    if template is None:
+        template = compile_rewrite_template(query, parameters)
+
     requireXSD = False
+    values = {}
     for pname, p in parameters.items():
         # Get the parameter value from the GET request
         v = get_args.get(pname, None)
         # If the parameter has a value
-        if not v:
+        if not v or p["type"] not in ["number", "literal", "string"]:
             continue
+        values[p["original"]] = _render_parameter(p, v)
+        if p.get("datatype") and "xsd" in p["datatype"]:
+            requireXSD = True
+
+    segments = list(template)
+    for i in range(1, len(segments), 2):
+        segments[i] = values.get(segments[i], segments[i])
+    query = "".join(segments)
 
-        # Number (without a datatype)
-        if p["type"] == "number":
-            query = query.replace(p["original"], v)
-        # Literal
-        elif p["type"] == "literal" or p["type"] == "string":
-            # If it's a iri
-            if "format" in p and p["format"] == "iri":
-                query = query.replace(p["original"], "{}{}{}".format("<", v, ">"))
-            # If there is a language tag
-            if "lang" in p and p["lang"]:
-                query = query.replace(p["original"], '"{}"@{}'.format(v, p["lang"]))
-            elif "datatype" in p and p["datatype"]:
-                query = query.replace(
-                    p["original"], '"{}"^^{}'.format(v, p["datatype"])
-                )
-                if "xsd" in p["datatype"]:
-                    requireXSD = True
-            else:
-                query = query.replace(p["original"], '"{}"'.format(v))
     if requireXSD and XSD_PREFIX not in query:
-        query = query.replace("SELECT", XSD_PREFIX + "\n\nSELECT")
+        query = query.replace("SELECT", XSD_PREFIX + "\n\nSELECT", 1)
     return query
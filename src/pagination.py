@@ -2,6 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+import math
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, ParseResult
 
 
@@ -18,37 +19,60 @@ def getSwaggerPaginationDef(resultsPerPage):
 
 
 def buildPaginationHeader(resultCount, resultsPerPage, pageArg, url):
-    """Build link header for result pagination"""
-    lastPage = resultCount / resultsPerPage
+    """Build link header for result pagination. If the number of results is
+    unknown (None), the header has no link to the last page."""
+    lastPage = None
+    if resultCount is not None:
+        lastPage = max(1, int(math.ceil(float(resultCount) / int(resultsPerPage))))
 
     url_parts = urlparse(url)
     query = dict(
         parse_qsl(url_parts.query)
     )  # Use dict parse_qsl instead of parse_qs to ensure 'page' is unique
 
-    first_url = _buildNewUrlWithPage(url_parts, query, page=1)
-    last_url = _buildNewUrlWithPage(url_parts, query, page=lastPage)
+    page = int(pageArg) if pageArg else 1
+    links = []
+    if lastPage is None or page < lastPage:
+        links.append((_buildNewUrlWithPage(url_parts, query, page + 1), "next"))
+    if page > 1:
+        links.append((_buildNewUrlWithPage(url_parts, query, page - 1), "prev"))
+        links.append((_buildNewUrlWithPage(url_parts, query, 1), "first"))
+    if lastPage is not None and page < lastPage:
+        links.append((_buildNewUrlWithPage(url_parts, query, lastPage), "last"))
+    return ", ".join("<{}>; rel={}".format(link, rel) for link, rel in links)
 
-    if not pageArg:
-        next_url = _buildNewUrlWithPage(url_parts, query, page=1)
-        prev_url = ""
-        headerLink = "<{}>; rel=next, <{}>; rel=last".format(next_url, last_url)
-    else:
-        page = int(pageArg)
-        next_url = _buildNewUrlWithPage(url_parts, query, page + 1)
-        prev_url = _buildNewUrlWithPage(url_parts, query, page - 1)
 
-        if page == lastPage:
-            headerLink = "<{}>; rel=prev, <{}>; rel=first".format(prev_url, first_url)
-        else:
-            headerLink = "<{}>; rel=next, <{}>; rel=prev, <{}>; rel=first, <{}>; rel=last".format(
-                next_url, prev_url, first_url, last_url
-            )
-    return headerLink
+def getSwaggerCursorDef(resultsPerPage):
+    """Build swagger spec section for keyset (cursor) pagination"""
+    return {
+        "name": "cursor",
+        "type": "string",
+        "in": "query",
+        "description": "Where this paginated query continues ({} results per "
+        "page), as given in the next link of the previous page".format(resultsPerPage),
+    }
+
+
+def buildCursorPaginationHeader(cursor, url):
+    """Build link header for keyset pagination. Pages are only linked to the
+    next one (if there is one, `cursor` is its cursor) and to the first one."""
+    url_parts = urlparse(url)
+    query = dict(parse_qsl(url_parts.query))
+    query.pop("cursor", None)
+    query.pop("page", None)
+    links = []
+    if cursor:
+        links.append((_buildNewUrl(url_parts, dict(query, cursor=cursor)), "next"))
+    links.append((_buildNewUrl(url_parts, query), "first"))
+    return ", ".join("<{}>; rel={}".format(link, rel) for link, rel in links)
 
 
 def _buildNewUrlWithPage(url_parts, query, page):
     query["page"] = page
+    return _buildNewUrl(url_parts, query)
+
+
+def _buildNewUrl(url_parts, query):
     new_query = urlencode(query)
     newParsedUrl = ParseResult(
         scheme=url_parts.scheme,
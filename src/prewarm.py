@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+# prewarm.py: building API specs ahead of the requests that need them
+
+import os
+import hmac
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import grlc.static as static
+import grlc.utils as utils
+import grlc.cache as cache
+import grlc.glogging as glogging
+
+glogger = glogging.getGrlcLogger(__name__)
+
+# A spec to build: the latest commit of a repo (or of a branch, on GitLab), or a
+# fixed commit
+Target = namedtuple("Target", "git_type user repo subdir sha branch")
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_started_pid = None
+# Worker processes build the same spec one after the other, so (with a spec
+# cache directory) only the first one does the work
+_flights = cache.SingleFlight(static.SINGLEFLIGHT_DIR, share_ttl=0)
+
+
+def parse_target(value):
+    """Parses a repo given as <github|gitlab>:<user>/<repo>[/<subdir>][@<ref>].
+    The ref is a commit for GitHub repos and a branch for GitLab repos."""
+    git_type, _, location = value.partition(":")
+    if git_type not in [static.TYPE_GITHUB, static.TYPE_GITLAB] or not location:
+        raise ValueError("Invalid repo to prewarm: {}".format(value))
+    location, _, ref = location.partition("@")
+    parts = location.strip("/").split("/", 2)
+    if len(parts) < 2:
+        raise ValueError("Invalid repo to prewarm: {}".format(value))
+    user, repo = parts[0], parts[1]
+    subdir = parts[2] if len(parts) > 2 else None
+    if git_type == static.TYPE_GITHUB:
+        return Target(git_type, user, repo, subdir, ref or None, None)
+    return Target(git_type, user, repo, subdir, None, ref or None)
+
+
+def parse_targets(value):
+    """Parses a list of repos separated by white space (see parse_target)."""
+    targets = []
+    for item in value.split():
+        try:
+            targets.append(parse_target(item))
+        except ValueError as e:
+            glogger.warning(e)
+    return targets
+
+
+def build(target):
+    """Build (and so cache) the spec of the given target. Specs of the latest
+    commit are built with a new loader, so they see the latest push."""
+    glogger.info("Prewarming spec of {}".format(target))
+    if not target.sha:
+        utils.dropLoader(
+            target.user,
+            target.repo,
+            target.subdir,
+            git_type=target.git_type,
+            branch=target.branch,
+        )
+
+    def build_spec():
+        utils.build_swagger_spec(
+            target.user,
+            target.repo,
+            target.subdir,
+            None,
+            target.sha,
+            static.SERVER_NAME,
+            target.git_type,
+            target.branch,
+        )
+
+    try:
+        _flights.do(("prewarm",) + tuple(target), build_spec)
+    except Exception as e:
+        glogger.error("Could not prewarm spec of {}: {}".format(target, e))
+
+
+def _get_executor():
+    """Returns the thread building specs in the background in this process
+    (threads of a parent process do not survive a fork)."""
+    global _executor, _executor_pid
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="grlc-prewarm"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def schedule(targets):
+    """Build the specs of the given targets in the background, one at a time."""
+    executor = _get_executor()
+    return [executor.submit(build, target) for target in targets]
+
+
+def start():
+    """Build the specs of the repos listed in the [prewarm] configuration, once
+    per process. Specs are cached in memory by the process that builds them, so
+    this is called in each worker process (e.g. after gunicorn forks it, or on
+    its first request), not in a parent process which only forks workers."""
+    global _started_pid
+
+    with _executor_lock:
+        if _started_pid == os.getpid():
+            return []
+        _started_pid = os.getpid()
+    targets = parse_targets(static.PREWARM_REPOS)
+    if targets:
+        glogger.info("Prewarming {} API specs".format(len(targets)))
+    return schedule(targets)
+
+
+def verify_webhook(headers, body):
+    """Returns True if a webhook request is signed (GitHub) or authenticated
+    (GitLab) with the configured webhook secret."""
+    secret = static.PREWARM_WEBHOOK_SECRET
+    if not secret:
+        return False
+    signature = headers.get("X-Hub-Signature-256")
+    if signature:
+        expected = (
+            "sha256="
+            + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        )
+        return hmac.compare_digest(signature, expected)
+    token = headers.get("X-Gitlab-Token")
+    return token is not None and hmac.compare_digest(token, secret)
+
+
+def targets_for_push(git_type, full_name, branch, default_branch):
+    """Returns the targets whose spec changes with a push to the given branch
+    of a repo: the configured targets following that branch or, if none is
+    configured, the spec of the latest commit of the repo."""
+    user, _, repo = full_name.partition("/")
+    targets = [
+        t
+        for t in parse_targets(static.PREWARM_REPOS)
+        if (t.git_type, t.user, t.repo) == (git_type, user, repo)
+    ]
+    if not targets:
+        targets = [Target(git_type, user, repo, None, None, None)]
+    return [t for t in targets if not t.sha and (t.branch or default_branch) == branch]
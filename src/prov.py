@@ -8,6 +8,7 @@
 
 from rdflib import Graph, URIRef, Namespace, RDF, Literal
 from datetime import datetime
+from threading import Lock
 from subprocess import check_output
 
 # grlc modules
@@ -39,6 +40,8 @@ class grlcPROV:
             "http://{}/api/{}/{}/spec".format(static.SERVER_NAME, self.user, self.repo)
         )
         self.activity = URIRef(self.entity_d + "-activity")
+        # Entities may be added from several threads while building a spec
+        self._lock = Lock()
 
         self.init_prov_graph()
 
@@ -90,8 +93,9 @@ class grlcPROV:
         Add the provided URI as a used entity by the logged activity
         """
         entity_o = URIRef(entity_uri)
-        self.prov_g.add((entity_o, RDF.type, self.prov.Entity))
-        self.prov_g.add((self.activity, self.prov.used, entity_o))
+        with self._lock:
+            self.prov_g.add((entity_o, RDF.type, self.prov.Entity))
+            self.prov_g.add((self.activity, self.prov.used, entity_o))
 
     def end_prov_graph(self):
         """
@@ -8,10 +8,19 @@
 
 from flask import Flask, request, jsonify, render_template, make_response
 from flask_cors import CORS
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # grlc modules
 import grlc.static as static
 import grlc.utils as utils
+import grlc.connections as connections
+import grlc.prewarm as prewarm
 import grlc.glogging as glogging
 
 glogger = glogging.getGrlcLogger(__name__)
@@ -94,6 +103,7 @@ def query(
     requestUrl = request.url
     formData = request.form
     method = request.method
+    acceptEncoding = request.headers.get("Accept-Encoding", "")
 
     query_response, status, headers = utils.dispatch_query(
         user,
@@ -110,11 +120,130 @@ def query(
         method=method,
         git_type=git_type,
         branch=branch,
+        acceptEncoding=acceptEncoding,
     )
     if isinstance(query_response, list) or isinstance(query_response, dict):
         query_response = jsonify(query_response)
 
-    return make_response(query_response, status, headers)
+    response = make_response(query_response, status, headers)
+    if status == 200 and not response.is_streamed:
+        # Answer 304 Not Modified if the client already has this result
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+@app.before_request
+def start_prewarm():
+    """Start building the specs of the configured repos in this worker process,
+    unless it started when the worker was forked (see bin/grlc-server)."""
+    prewarm.start()
+
+
+@app.before_request
+def set_request_deadline():
+    """Limit the time each request may spend on loaders, counts and queries."""
+    connections.set_deadline(static.HTTP_REQUEST_DEADLINE)
+
+
+@app.errorhandler(connections.CircuitOpenError)
+def endpoint_unavailable(e):
+    """Fail fast while an upstream endpoint is known to be failing."""
+    return make_response(jsonify({"error": str(e)}), 503)
+
+
+@app.errorhandler(connections.DeadlineExceeded)
+def deadline_exceeded(e):
+    return make_response(jsonify({"error": str(e)}), 504)
+
+
+def batch(
+    user, repo, subdir=None, spec_url=None, sha=None, git_type=None, branch=None
+):
+    """Execute several call names of a grlc-generated API in a single request.
+    The request body is a JSON list of {"call_name", "params", "format"} objects;
+    results are returned as JSON lines, in the same order."""
+    calls = request.get_json(silent=True)
+    if not isinstance(calls, list) or not all(isinstance(c, dict) for c in calls):
+        return make_response(
+            jsonify({"error": "Batch requests must be a JSON list of calls"}), 400
+        )
+    if len(calls) > static.BATCH_MAX_CALLS:
+        return make_response(
+            jsonify(
+                {"error": "At most {} calls per batch".format(static.BATCH_MAX_CALLS)}
+            ),
+            400,
+        )
+    glogger.info(
+        "-----> Executing batch of {} calls at /{}/{} ({})/{} on commit {}".format(
+            len(calls), user, repo, git_type, subdir, sha
+        )
+    )
+
+    results = utils.dispatch_batch(
+        user,
+        repo,
+        calls,
+        subdir,
+        spec_url,
+        sha=sha,
+        acceptHeader=request.headers.get("Accept", "application/json"),
+        baseUrl=request.base_url[: -len("_batch")],
+        git_type=git_type,
+        branch=branch,
+    )
+    body = "".join(json.dumps(result, default=str) + "\n" for result in results)
+    return make_response(body, 200, {"Content-Type": "application/x-ndjson"})
+
+
+def _compressible(mimetype):
+    return mimetype.startswith("text/") or any(
+        t in mimetype for t in ["json", "xml", "javascript", "turtle"]
+    )
+
+
+@app.after_request
+def compress_response(response):
+    """Compress large text responses (query results, swagger specs) for clients
+    that accept gzip or brotli encoded content."""
+    if response.is_streamed or "Content-Encoding" in response.headers:
+        # Streamed results are passed through compressed by the endpoint, or
+        # not, depending on the Accept-Encoding of the request
+        response.vary.add("Accept-Encoding")
+    if (
+        not static.COMPRESS_RESPONSES
+        or response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or not _compressible(response.mimetype or "")
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    if brotli and accepted.quality("br") > 0:
+        encoding = "br"
+    elif accepted.quality("gzip") > 0:
+        encoding = "gzip"
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < static.COMPRESS_MIN_SIZE:
+        return response
+    if encoding == "br":
+        response.set_data(brotli.compress(data))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = encoding
+
+    # The compressed body is a different representation of the same content
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
 
 # Server routes
@@ -164,6 +293,13 @@ def query_local(query_name, content=None):
     return query(user=None, repo=None, query_name=query_name, content=content)
 
 
+# Batch execution
+@app.route("/api-local/_batch", methods=["POST"])
+def batch_local():
+    """Batch execution of call names for local routes."""
+    return batch(user=None, repo=None)
+
+
 # Routes for URL HTTP APIs
 
 
@@ -198,6 +334,14 @@ def query_param(query_name, content=None):
     )
 
 
+# Batch execution
+@app.route("/api-url/_batch", methods=["POST"])
+def batch_param():
+    """Batch execution of call names for specifications loaded via http."""
+    spec_url = request.args["specUrl"]
+    return batch(user=None, repo=None, spec_url=spec_url)
+
+
 # Routes for GitHub APIs
 
 
@@ -324,6 +468,19 @@ def query_git(user, repo, query_name, subdir=None, sha=None, content=None):
     )
 
 
+# Batch execution
+@app.route("/api-git/<user>/<repo>/_batch", methods=["POST"])
+@app.route("/api-git/<user>/<repo>/subdir/<path:subdir>/_batch", methods=["POST"])
+@app.route("/api-git/<user>/<repo>/commit/<sha>/_batch", methods=["POST"])
+@app.route(
+    "/api-git/<user>/<repo>/subdir/<path:subdir>/commit/<sha>/_batch",
+    methods=["POST"],
+)
+def batch_git(user, repo, subdir=None, sha=None):
+    """Batch execution of call names for specifications loaded from a Github repo."""
+    return batch(user, repo, subdir=subdir, sha=sha, git_type=static.TYPE_GITHUB)
+
+
 # Routes for GitLab APIs
 
 
@@ -425,6 +582,75 @@ def query_gitlab(
     )
 
 
+# Batch execution
+@app.route("/api-gitlab/<user>/<repo>/query/_batch", methods=["POST"])
+@app.route("/api-gitlab/<user>/<repo>/query/branch/<branch>/_batch", methods=["POST"])
+@app.route(
+    "/api-gitlab/<user>/<repo>/query/subdir/<path:subdir>/_batch", methods=["POST"]
+)
+@app.route(
+    "/api-gitlab/<user>/<repo>/query/branch/<branch>/subdir/<path:subdir>/_batch",
+    methods=["POST"],
+)
+@app.route("/api-gitlab/<user>/<repo>/query/commit/<sha>/_batch", methods=["POST"])
+@app.route(
+    "/api-gitlab/<user>/<repo>/query/subdir/<path:subdir>/commit/<sha>/_batch",
+    methods=["POST"],
+)
+def batch_gitlab(user, repo, subdir=None, sha=None, branch=None):
+    """Batch execution of call names for specifications loaded from a Gitlab repo."""
+    return batch(
+        user,
+        repo,
+        subdir=subdir,
+        sha=sha,
+        git_type=static.TYPE_GITLAB,
+        branch=branch,
+    )
+
+
+# Spec pre-warming
+@app.route("/webhook/push", methods=["POST"])
+def webhook_push():
+    """Rebuild the API specs of a repo in the background after a push. Accepts
+    GitHub and GitLab push events, signed with the configured webhook secret.
+    Only the worker process receiving the push rebuilds the specs, so other
+    workers only get them through a shared spec_cache_dir."""
+    if not static.PREWARM_WEBHOOK_SECRET:
+        return make_response(jsonify({"error": "Webhook not configured"}), 404)
+    if not prewarm.verify_webhook(request.headers, request.get_data()):
+        return make_response(jsonify({"error": "Invalid webhook signature"}), 403)
+
+    event = request.get_json(silent=True) or {}
+    if "project" in event:
+        git_type = static.TYPE_GITLAB
+        repository = event["project"]
+        full_name = repository.get("path_with_namespace", "")
+    else:
+        git_type = static.TYPE_GITHUB
+        repository = event.get("repository") or {}
+        full_name = repository.get("full_name", "")
+    ref = event.get("ref") or ""
+    if not full_name or not ref.startswith("refs/heads/"):
+        # Not a branch push (e.g. a ping or a tag)
+        return make_response(jsonify({"rebuilding": []}), 200)
+
+    targets = prewarm.targets_for_push(
+        git_type,
+        full_name,
+        ref.partition("refs/heads/")[2],
+        repository.get("default_branch"),
+    )
+    prewarm.schedule(targets)
+    rebuilding = [
+        "{}:{}/{}{}".format(
+            t.git_type, t.user, t.repo, "/" + t.subdir if t.subdir else ""
+        )
+        for t in targets
+    ]
+    return make_response(jsonify({"rebuilding": rebuilding}), 202)
+
+
 # Main thread
 if __name__ == "__main__":
     app.run(host=static.DEFAULT_HOST, port=static.DEFAULT_PORT, debug=True)
@@ -6,6 +6,7 @@
 
 # static.py: static values for the grlc Server
 import os
+import tempfile
 from configparser import ConfigParser
 from grlc import __version__ as grlc_version
 
@@ -94,6 +95,61 @@ config_fallbacks = {
     "product": "grlc",
     "version": grlc_version,
     "comment": "https://github.com/CLARIAH/grlc",
+    "pool_connections": "10",
+    "pool_maxsize": "20",
+    "max_retries": "0",
+    "retry_backoff": "0",
+    "keep_alive": "True",
+    "connect_timeout": "10",
+    "read_timeout": "60",
+    "request_deadline": "0",
+    "breaker_failures": "0",
+    "breaker_latency": "0",
+    "breaker_cooldown": "30",
+    "balance": "least_outstanding",
+    "balance_decay": "0.3",
+    "hedge_after": "0",
+    "compress_responses": "True",
+    "compress_min_size": "1024",
+    "stream_results": "False",
+    "stream_chunk_size": "65536",
+    "result_cache_size": "0",
+    "result_cache_ttl": "60",
+    "spec_cache_size": "33554432",
+    "spec_cache_ttl": "3600",
+    "spec_cache_dir": "",
+    "item_cache_size": "16777216",
+    "item_cache_ttl": "3600",
+    "enumeration_cache_size": "8388608",
+    "enumeration_cache_ttl": "3600",
+    "enumeration_max_values": "1000",
+    "query_cache_size": "8388608",
+    "count_cache_size": "1048576",
+    "count_cache_ttl": "300",
+    "query_cache_ttl": "300",
+    "loader_registry_size": "128",
+    "manifest_cache_size": "256",
+    "head_cache_ttl": "30",
+    "dump_cache_size": "268435456",
+    "dump_cache_ttl": "60",
+    "dump_store": "BerkeleyDB",
+    "dump_store_dir": "",
+    "dump_store_grace": "600",
+    "github_snapshots": "False",
+    "snapshot_dir": "",
+    "snapshot_keep": "5",
+    "loader_registry_ttl": "300",
+    "spec_build_threads": "8",
+    "spec_build_processes": "0",
+    "spec_parse_timeout": "30",
+    "neighbour_scan_limit": "300",
+    "batch_max_workers": "8",
+    "batch_max_calls": "50",
+    "prewarm_repos": "",
+    "webhook_secret": "",
+    "singleflight": "True",
+    "singleflight_dir": "",
+    "singleflight_share_ttl": "1",
 }
 config = ConfigParser(config_fallbacks)
 config.add_section("auth")
@@ -101,6 +157,11 @@ config.add_section("defaults")
 config.add_section("local")
 config.add_section("api_gitlab")
 config.add_section("user_agent")
+config.add_section("http")
+config.add_section("cache")
+config.add_section("spec")
+config.add_section("batch")
+config.add_section("prewarm")
 
 config_filename = os.path.join(os.getcwd(), "config.ini")
 print("Reading config file: ", config_filename)
@@ -134,6 +195,144 @@ USER_AGENT = "{}/{} ({})".format(
     config.get("user_agent", "comment"),
 )
 
+# Connection pools for upstream (SPARQL / TPF) HTTP requests
+HTTP_POOL_CONNECTIONS = config.getint("http", "pool_connections")
+HTTP_POOL_MAXSIZE = config.getint("http", "pool_maxsize")
+HTTP_MAX_RETRIES = config.getint("http", "max_retries")
+HTTP_RETRY_BACKOFF = config.getfloat("http", "retry_backoff")
+HTTP_KEEP_ALIVE = config.getboolean("http", "keep_alive")
+
+# Timeouts (in seconds) for upstream requests, and the maximum time (0 for no
+# limit) a grlc request may spend on all its upstream requests together
+HTTP_CONNECT_TIMEOUT = config.getfloat("http", "connect_timeout")
+HTTP_READ_TIMEOUT = config.getfloat("http", "read_timeout")
+HTTP_REQUEST_DEADLINE = config.getfloat("http", "request_deadline")
+
+# Circuit breaker: stop calling an endpoint for `cooldown` seconds after
+# `failures` consecutive connection errors, timeouts or 502/503/504 responses
+# (or responses slower than `latency` seconds). Disabled by default.
+HTTP_BREAKER_FAILURES = config.getint("http", "breaker_failures")
+HTTP_BREAKER_LATENCY = config.getfloat("http", "breaker_latency")
+HTTP_BREAKER_COOLDOWN = config.getfloat("http", "breaker_cooldown")
+
+# Choice among replicas, when several endpoints are given for a query: by
+# fewest requests in flight (least_outstanding), by response time (ewma, with
+# the given decay) or in the given order (first). Requests that take longer
+# than hedge_after seconds (0 to disable) are also sent to another replica.
+HTTP_BALANCE = config.get("http", "balance")
+HTTP_BALANCE_DECAY = config.getfloat("http", "balance_decay")
+HTTP_HEDGE_AFTER = config.getfloat("http", "hedge_after")
+
+# Compress responses (with gzip or brotli) of at least compress_min_size bytes
+# for clients that accept it
+COMPRESS_RESPONSES = config.getboolean("http", "compress_responses")
+COMPRESS_MIN_SIZE = config.getint("http", "compress_min_size")
+
+# Forward SPARQL results to the client in chunks instead of buffering them
+HTTP_STREAM_RESULTS = config.getboolean("http", "stream_results")
+HTTP_STREAM_CHUNK_SIZE = config.getint("http", "stream_chunk_size")
+
+# Cache of SPARQL query results (size in bytes, 0 disables it; TTL in seconds)
+RESULT_CACHE_SIZE = config.getint("cache", "result_cache_size")
+RESULT_CACHE_TTL = config.getint("cache", "result_cache_ttl")
+
+# Cache of generated swagger specs, keyed on repo and resolved commit (size in
+# bytes, 0 disables it; TTL in seconds). Specs can also be kept in a directory,
+# shared by all worker processes and kept across restarts.
+SPEC_CACHE_SIZE = config.getint("cache", "spec_cache_size")
+SPEC_CACHE_TTL = config.getint("cache", "spec_cache_ttl")
+SPEC_CACHE_DIR = config.get("cache", "spec_cache_dir")
+
+# Cache of spec items, shared between commits in which their query file did not
+# change (size in bytes, 0 disables it; TTL in seconds)
+ITEM_CACHE_SIZE = config.getint("cache", "item_cache_size")
+ITEM_CACHE_TTL = config.getint("cache", "item_cache_ttl")
+
+# Cache of values of enumerated parameters (size in bytes, 0 disables it). Values
+# older than the TTL (in seconds) are refreshed in the background. Enumerations
+# are limited to enumeration_max_values values (0 for no limit).
+ENUMERATION_CACHE_SIZE = config.getint("cache", "enumeration_cache_size")
+ENUMERATION_CACHE_TTL = config.getint("cache", "enumeration_cache_ttl")
+ENUMERATION_MAX_VALUES = config.getint("cache", "enumeration_max_values")
+
+# Parsed decorators and metadata of executed queries, keyed on their text
+QUERY_CACHE_SIZE = config.getint("cache", "query_cache_size")
+QUERY_CACHE_TTL = config.getint("cache", "query_cache_ttl")
+
+# Result counts of paginated queries, keyed on endpoint and query
+COUNT_CACHE_SIZE = config.getint("cache", "count_cache_size")
+COUNT_CACHE_TTL = config.getint("cache", "count_cache_ttl")
+
+# Registry of repository loaders (number of loaders kept; TTL in seconds)
+LOADER_REGISTRY_SIZE = config.getint("cache", "loader_registry_size")
+LOADER_REGISTRY_TTL = config.getint("cache", "loader_registry_ttl")
+
+# Number of repository manifests (index of the files of a commit) kept
+MANIFEST_CACHE_SIZE = config.getint("cache", "manifest_cache_size")
+
+# Seconds for which the commit at the head of a branch, once resolved, is used
+# without asking GitHub / GitLab again
+HEAD_CACHE_TTL = config.getint("cache", "head_cache_ttl")
+
+# Cache of parsed graphs of RDF dumps (estimated size in bytes, 0 disables it).
+# Graphs are revalidated with a conditional GET once older than the TTL (in seconds).
+DUMP_CACHE_SIZE = config.getint("cache", "dump_cache_size")
+DUMP_CACHE_TTL = config.getint("cache", "dump_cache_ttl")
+
+# Convert RDF dumps into on-disk stores (an rdflib store plugin, such as
+# BerkeleyDB) kept in dump_store_dir, shared by all worker processes. Dumps are
+# kept in memory if no directory is set.
+DUMP_STORE = config.get("cache", "dump_store")
+DUMP_STORE_DIR = config.get("cache", "dump_store_dir")
+# Seconds for which the previous store of a dump is kept after it is replaced,
+# for the processes (and queries) still reading it
+DUMP_STORE_GRACE = config.getint("cache", "dump_store_grace")
+
+# Read GitHub repos from a snapshot of each commit, downloaded once as an archive
+# and kept in snapshot_dir, instead of through one API call per file. Only the
+# snapshot_keep most recently used snapshots of each repo are kept (0: all).
+GITHUB_SNAPSHOTS = config.getboolean("cache", "github_snapshots")
+SNAPSHOT_DIR = config.get("cache", "snapshot_dir") or os.path.join(
+    tempfile.gettempdir(), "grlc-snapshots"
+)
+SNAPSHOT_KEEP = config.getint("cache", "snapshot_keep")
+
+# Coalescing of identical queries in flight. If a directory is given, queries
+# are also coalesced across worker processes through lock files stored there.
+SINGLEFLIGHT = config.getboolean("cache", "singleflight")
+SINGLEFLIGHT_DIR = config.get("cache", "singleflight_dir")
+SINGLEFLIGHT_SHARE_TTL = config.getfloat("cache", "singleflight_share_ttl")
+
+# API spec generation: query files processed concurrently, and worker processes
+# for parsing queries (0 to parse them in the building thread), which parse each
+# query within spec_parse_timeout seconds or leave it to the building thread
+SPEC_BUILD_THREADS = config.getint("spec", "spec_build_threads")
+SPEC_BUILD_PROCESSES = config.getint("spec", "spec_build_processes")
+SPEC_PARSE_TIMEOUT = config.getfloat("spec", "spec_parse_timeout")
+
+# Maximum number of commits looked at to find the commit following the one an
+# API spec is generated for
+NEIGHBOUR_SCAN_LIMIT = config.getint("spec", "neighbour_scan_limit")
+
+# Batch API: number of calls run concurrently, and maximum calls per batch
+BATCH_MAX_WORKERS = config.getint("batch", "batch_max_workers")
+BATCH_MAX_CALLS = config.getint("batch", "batch_max_calls")
+
+# Repos whose API specs are built at startup, and secret of the push webhook
+# rebuilding them (the webhook is disabled without a secret)
+PREWARM_REPOS = config.get("prewarm", "prewarm_repos")
+PREWARM_WEBHOOK_SECRET = config.get("prewarm", "webhook_secret")
+
+# Per-endpoint overrides of the [http] settings, from sections named
+# [endpoint:<host>] (e.g. [endpoint:dbpedia.org] or [endpoint:localhost:8890]).
+# These are read without fallbacks, so only explicitly set options are kept.
+endpoint_config = ConfigParser()
+endpoint_config.read(config_filename)
+ENDPOINT_HTTP_CONFIG = {
+    section.split(":", 1)[1]: dict(endpoint_config.items(section))
+    for section in endpoint_config.sections()
+    if section.startswith("endpoint:")
+}
 
 # Pattern for INSERT query call names
 INSERT_PATTERN = "INSERT DATA { GRAPH ?_g_iri { <s> <p> <o> }}"
@@ -2,8 +2,15 @@
 #
 # SPDX-License-Identifier: MIT
 
+import copy
 import json
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, has_request_context
+
 import grlc.utils
+import grlc.static as static
+import grlc.cache as cache
 import grlc.gquery as gquery
 import grlc.pagination as pageUtils
 from grlc.fileLoaders import GithubLoader, LocalLoader, URLLoader, GitlabLoader
@@ -12,6 +19,10 @@ import grlc.glogging as glogging
 
 glogger = glogging.getGrlcLogger(__name__)
 
+# Spec items, keyed on the git blob of their query file and on everything else
+# that determines them (the endpoint), so they are shared between commits
+item_cache = cache.LRUCache(static.ITEM_CACHE_SIZE, static.ITEM_CACHE_TTL)
+
 
 def get_blank_spec():
     """Creates the base (blank) structure of swagger specification."""
@@ -32,21 +43,13 @@ def get_repo_info(loader, sha, prov_g):
     repo_desc = loader.getRepoDescription()
     contact_name = loader.getContactName()
     contact_url = loader.getContactUrl()
-    commit_list = loader.getCommitList()
+    version, prev_commit, next_commit = loader.getNeighbourCommits(sha)
     licence_url = loader.getLicenceURL()  # This will be None if there is no license
 
     # Add the API URI as a used entity by the activity
     if prov_g:
         prov_g.add_used_entity(loader.getRepoURI())
 
-    prev_commit = None
-    next_commit = None
-    version = sha if sha else commit_list[0]
-    if commit_list.index(version) < len(commit_list) - 1:
-        prev_commit = commit_list[commit_list.index(version) + 1]
-    if commit_list.index(version) > 0:
-        next_commit = commit_list[commit_list.index(version) - 1]
-
     info = {
         "version": version,
         "title": repo_title,
@@ -137,20 +140,25 @@ def build_spec(
     extraMetadata=[],
     git_type=None,
     branch=None,
+    loader=None,
 ):
-    """Build grlc specification for the given github user / repo."""
-    loader = grlc.utils.getLoader(
-        user,
-        repo,
-        subdir,
-        query_url,
-        sha=sha,
-        prov=prov,
-        git_type=git_type,
-        branch=branch,
-    )
+    """Build grlc specification for the given github user / repo. An existing
+    loader for the repo can be given, instead of getting one from the registry."""
+    if loader is None:
+        loader = grlc.utils.getLoader(
+            user,
+            repo,
+            subdir,
+            query_url,
+            sha=sha,
+            prov=prov,
+            git_type=git_type,
+            branch=branch,
+        )
 
-    files = loader.fetchFiles()
+    # Files of repos with a manifest are listed once per commit
+    manifest = loader.getManifest()
+    files = list(manifest.files.values()) if manifest else loader.fetchFiles()
     raw_repo_uri = loader.getRawRepoUri()
 
     # Fetch all .rq files
@@ -158,16 +166,36 @@ def build_spec(
     warnings = []
 
     allowed_ext = ["rq", "sparql", "json", "tpf"]
+    candidates = []
     for c in files:
         glogger.debug(">>>>>>>>>>>>>>>>>>>>>>>>>c_name: {}".format(c["name"]))
         extension = c["name"].split(".")[-1]
         if (
             extension in allowed_ext or query_url
         ):  # parameter provided queries may not have extension
-
-            item, warning = _buildItem(
-                c, extension, query_url, raw_repo_uri, loader, extraMetadata
+            candidates.append((c, extension))
+
+    item_context = _getItemContext(files, query_url, extraMetadata)
+
+    # Files are processed concurrently (each in a copy of the current context,
+    # so they see the same Flask request), but results are kept in file order
+    with ThreadPoolExecutor(max_workers=static.SPEC_BUILD_THREADS) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                _buildItemMemo,
+                c,
+                extension,
+                query_url,
+                raw_repo_uri,
+                loader,
+                extraMetadata,
+                item_context,
             )
+            for c, extension in candidates
+        ]
+        for future in futures:
+            item, warning = future.result()
             if item:
                 items.append(item)
             if warning:
@@ -182,6 +210,58 @@ def build_spec(
     return items, warnings
 
 
+def get_request_endpoint():
+    """Returns the endpoint given in the current request (?endpoint=), if any."""
+    if has_request_context():
+        return request.args.get("endpoint")
+    return None
+
+
+def _getItemContext(files, query_url, extraMetadata):
+    """Returns what, besides the query file itself, determines the items built
+    from a repo: the endpoint they are sent to (an endpoint given in the
+    request, the endpoint.txt file of the repo, identified by its blob, or the
+    default endpoint) and the extra metadata they are built with."""
+    request_endpoint = get_request_endpoint()
+    endpoint_file = next(
+        (c.get("sha") for c in files if c["name"] == "endpoint.txt"), None
+    )
+    return (
+        request_endpoint,
+        endpoint_file,
+        static.DEFAULT_ENDPOINT,
+        query_url,
+        repr(extraMetadata),
+    )
+
+
+def _buildItemMemo(
+    c, extension, query_url, raw_repo_uri, loader, extraMetadata, item_context
+):
+    """Build the item of a file in a repository, or reuse the item built earlier
+    from the same git blob (the file is then not even downloaded)."""
+    if not c.get("sha") or not item_cache.enabled:
+        return _buildItem(c, extension, query_url, raw_repo_uri, loader, extraMetadata)
+
+    key = (c["sha"], c["name"], item_context)
+    item = item_cache.get(key)
+    if item is not None:
+        glogger.debug("Reusing spec item of {} ({})".format(c["name"], c["sha"]))
+        prov = getattr(loader, "prov", None)
+        if prov is not None:
+            prov.add_used_entity(c["download_url"])
+        # Items are modified when building the swagger paths
+        return copy.deepcopy(item), None
+
+    item, warning = _buildItem(
+        c, extension, query_url, raw_repo_uri, loader, extraMetadata
+    )
+    # Items with warnings may be the result of a temporary error
+    if item and not warning:
+        item_cache.set(key, copy.deepcopy(item))
+    return item, warning
+
+
 def _buildItem(c, extension, query_url, raw_repo_uri, loader, extraMetadata):
     """Collect all the information required to build an item from a file in a repository."""
     item = None
@@ -260,8 +340,9 @@ def process_tpf_query_text(query_text, raw_repo_uri, call_name, extraMetadata):
     pagination = query_metadata["pagination"] if "pagination" in query_metadata else ""
     glogger.debug("Read query pagination: " + str(pagination))
 
-    endpoint = query_metadata["endpoint"] if "endpoint" in query_metadata else ""
-    glogger.debug("Read query endpoint: " + endpoint)
+    # One or more replicas, among which calls are balanced (see dispatchTPFQuery)
+    endpoints = gquery._split_endpoints(query_metadata.get("endpoint", ""))
+    glogger.debug("Read query endpoints: {}".format(endpoints))
 
     # If this query allows pagination, add page number as parameter
     params = []
@@ -300,8 +381,10 @@ def process_sparql_query_text(query_text, loader, call_name, extraMetadata):
     # Processing of the parameters
     params = []
 
-    # If this query allows pagination, add page number as parameter
-    if pagination:
+    # If this query allows pagination, add page number (or cursor) as parameter
+    if pagination and query_metadata.get("pagination_key"):
+        params.append(pageUtils.getSwaggerCursorDef(pagination))
+    elif pagination:
         params.append(pageUtils.getSwaggerPaginationDef(pagination))
 
     if endpoint_in_url:
@@ -6,16 +6,29 @@ import grlc.static as static
 import grlc.gquery as gquery
 import grlc.pagination as pageUtils
 import grlc.swagger as swagger
+import grlc.connections as connections
+import grlc.cache as cache
+import grlc.dumpstore as dumpstore
+import grlc.fileLoaders as fileLoaders
 from grlc.prov import grlcPROV
 from grlc.fileLoaders import GithubLoader, LocalLoader, URLLoader, GitlabLoader
 from grlc.queryTypes import qType
 from grlc import __version__ as grlc_version
 
 import re
-import requests
+import copy
 import json
+import time
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from urllib.parse import urlencode
 
 from rdflib import Graph
+from rdflib.plugins.sparql import prepareQuery
+from werkzeug.http import quote_etag, http_date, parse_accept_header
 
 import SPARQLTransformer
 
@@ -23,6 +36,48 @@ import grlc.glogging as glogging
 
 glogger = glogging.getGrlcLogger(__name__)
 
+# Results of SPARQL queries, keyed on endpoint, final query and requested format
+result_cache = cache.LRUCache(static.RESULT_CACHE_SIZE, static.RESULT_CACHE_TTL)
+# Generated swagger specs, keyed on loader type, repo, subdir, branch and commit
+spec_cache = cache.LRUCache(static.SPEC_CACHE_SIZE, static.SPEC_CACHE_TTL)
+spec_disk_cache = (
+    cache.DiskCache(static.SPEC_CACHE_DIR, static.SPEC_CACHE_TTL)
+    if static.SPEC_CACHE_DIR
+    else None
+)
+# Loaders (and their API clients), reused across spec generation and query calls
+loader_registry = cache.LRUCache(
+    static.LOADER_REGISTRY_SIZE,
+    static.LOADER_REGISTRY_TTL,
+    max_items=static.LOADER_REGISTRY_SIZE,
+)
+loader_flights = cache.SingleFlight()
+# Result counts of paginated queries, fetched along with the page
+count_executor = ThreadPoolExecutor(thread_name_prefix="grlc-count")
+# Identical queries in flight, which are sent to the endpoint only once
+query_flights = cache.SingleFlight(
+    static.SINGLEFLIGHT_DIR, static.SINGLEFLIGHT_SHARE_TTL
+)
+# Parsed graphs of RDF dumps (#+ mime queries), keyed on dump URL and format
+dump_cache = cache.LRUCache(
+    static.DUMP_CACHE_SIZE, on_evict=lambda key, entry: _retireStoreGraph(key)
+)
+dump_flights = cache.SingleFlight()
+# Rough estimate of the memory used by each triple of an in-memory graph
+DUMP_TRIPLE_SIZE = 1024
+# A cached dump graph, with the validators of the response it was parsed from
+# (or the directory of its on-disk store, which keeps the validators itself)
+DumpGraph = namedtuple("DumpGraph", "graph etag last_modified validated store")
+_dump_stats = {"parses": 0, "parse_seconds": 0.0, "revalidations": 0, "unchanged": 0}
+_dump_stats_lock = threading.Lock()
+# Graphs of the on-disk stores of dumps open in this process (with the store
+# directory), keyed on dump URL and format, and graphs of the stores replaced
+# since (with the time they were replaced), which are closed once no query can
+# be using them anymore
+_store_graphs = {}
+_retired_graphs = []
+_store_graphs_lock = threading.Lock()
+
 
 def getLoader(
     user,
@@ -34,7 +89,40 @@ def getLoader(
     git_type=None,
     branch=None,
 ):
-    """Build a fileLoader (LocalLoader, GithubLoader, URLLoader) for the given parameters."""
+    """Returns a fileLoader (LocalLoader, GithubLoader, URLLoader) for the given
+    parameters. Loaders are kept in a process-wide registry for a while, so
+    repeated calls for the same repository reuse the same API client."""
+    key = (git_type, user, repo, subdir, spec_url, sha, branch)
+    loader = loader_registry.get(key)
+    if loader is None:
+
+        def build():
+            loader = _buildLoader(user, repo, subdir, spec_url, sha, git_type, branch)
+            loader_registry.set(key, loader, size=1)
+            return loader
+
+        loader = loader_flights.do(key, build)
+
+    # Provenance is recorded per call, on a copy sharing the API client
+    if prov is not None:
+        loader = copy.copy(loader)
+        loader.prov = prov
+    return loader
+
+
+def dropLoader(
+    user, repo, subdir=None, spec_url=None, sha=None, git_type=None, branch=None
+):
+    """Removes a loader from the registry, so the next getLoader call for the
+    same repository builds a new one (e.g. after a push to the repository),
+    which resolves the head of its branch again."""
+    loader_registry.delete((git_type, user, repo, subdir, spec_url, sha, branch))
+    if not sha:
+        fileLoaders.dropHeads()
+
+
+def _buildLoader(user, repo, subdir, spec_url, sha, git_type, branch):
+    """Build a new fileLoader (LocalLoader, GithubLoader, URLLoader) for the given parameters."""
     if user is None and repo is None and not spec_url:
         loader = LocalLoader()
     elif spec_url:
@@ -42,10 +130,10 @@ def getLoader(
     else:
         if git_type == static.TYPE_GITHUB:
             glogger.debug("Building GithubLoader....")
-            loader = GithubLoader(user, repo, subdir, sha, prov)
+            loader = GithubLoader(user, repo, subdir, sha)
         else:
             glogger.debug("Building GitlabLoader....")
-            loader = GitlabLoader(user, repo, subdir, sha, prov, branch)
+            loader = GitlabLoader(user, repo, subdir, sha, None, branch)
     return loader
 
 
@@ -82,6 +170,18 @@ def build_swagger_spec(
         swag["paths"] = {}
         return swag
 
+    version = _specVersion(loader, user, repo)
+    if sha and version:
+        # Abbreviated and full hashes of a commit get the same spec
+        sha = version
+    cache_key = _specCacheKey(
+        loader, user, repo, subdir, sha, branch, serverName, version
+    )
+    cached = _getCachedSpec(cache_key)
+    if cached:
+        glogger.debug("Serving API spec from cache")
+        return cached
+
     prev_commit, next_commit, info, basePath = swagger.get_repo_info(
         loader, sha, prov_g
     )
@@ -90,9 +190,8 @@ def build_swagger_spec(
     swag["info"] = info
     swag["basePath"] = basePath
 
-    # TODO: can we pass loader to build_spec ? --> Ideally yes!
     spec, warnings = swagger.build_spec(
-        user, repo, subdir, spec_url, sha, prov_g, [], git_type, branch
+        user, repo, subdir, spec_url, sha, prov_g, [], git_type, branch, loader
     )
     # Use items to build API paths
     for item in spec:
@@ -108,9 +207,65 @@ def build_swagger_spec(
     if prov_g:
         prov_g.end_prov_graph()
         swag["prov"] = prov_g.serialize(format="turtle")
+
+    if cache_key:
+        _setCachedSpec(cache_key, swag)
     return swag
 
 
+def _specVersion(loader, user, repo):
+    """Returns the version (e.g. the full commit hash) of the files the given
+    loader reads, or None if they are not versioned or specs are not cached."""
+    if not spec_cache.enabled and not spec_disk_cache:
+        return None
+    try:
+        return loader.getCommitSha()
+    except Exception as e:
+        glogger.debug("Could not resolve commit of {}/{}: {}".format(user, repo, e))
+        return None
+
+
+def _specCacheKey(loader, user, repo, subdir, sha, branch, serverName, version):
+    """Returns the key identifying the spec generated from the given loader, or
+    None if its files are not versioned (and so the spec cannot be cached).
+    Specs of a pinned commit and of the head of a branch differ in their base
+    path, and the endpoint given in the request changes their parameters."""
+    if version is None:
+        return None
+    return (
+        type(loader).__name__,
+        user,
+        repo,
+        subdir,
+        branch,
+        version,
+        bool(sha),
+        swagger.get_request_endpoint(),
+        serverName,
+    )
+
+
+def _getCachedSpec(cache_key):
+    """Returns a copy of the spec cached under the given key, from memory or else
+    from disk, or None if it is not cached."""
+    if not cache_key:
+        return None
+    swag = spec_cache.get(cache_key)
+    if swag is None and spec_disk_cache:
+        swag = spec_disk_cache.get(cache_key)
+        if swag is not None:
+            spec_cache.set(cache_key, swag)
+    # Callers may modify the spec they get
+    return copy.deepcopy(swag) if swag is not None else None
+
+
+def _setCachedSpec(cache_key, swag):
+    swag = copy.deepcopy(swag)
+    spec_cache.set(cache_key, swag)
+    if spec_disk_cache:
+        spec_disk_cache.set(cache_key, swag)
+
+
 def dispatch_query(
     user,
     repo,
@@ -126,19 +281,23 @@ def dispatch_query(
     method="POST",
     git_type=None,
     branch=None,
+    acceptEncoding="",
+    loader=None,
 ):
     """Executes the specified SPARQL or TPF query."""
-    loader = getLoader(
-        user,
-        repo,
-        subdir,
-        spec_url,
-        sha=sha,
-        prov=None,
-        git_type=git_type,
-        branch=branch,
-    )
+    if loader is None:
+        loader = getLoader(
+            user,
+            repo,
+            subdir,
+            spec_url,
+            sha=sha,
+            prov=None,
+            git_type=git_type,
+            branch=branch,
+        )
     query, q_type = loader.getTextForName(query_name)
+    connections.check_deadline()
 
     # Call name implemented with SPARQL query
     if q_type == qType["SPARQL"] or q_type == qType["JSON"]:
@@ -151,6 +310,7 @@ def dispatch_query(
             formData,
             requestUrl,
             method,
+            acceptEncoding,
         )
 
         if acceptHeader == "application/json":
@@ -170,6 +330,220 @@ def dispatch_query(
         )
 
 
+def dispatch_batch(
+    user,
+    repo,
+    calls,
+    subdir=None,
+    spec_url=None,
+    sha=None,
+    acceptHeader="application/json",
+    baseUrl="http://",
+    git_type=None,
+    branch=None,
+):
+    """Executes several call names (or parameter sets) of the same API. `calls`
+    is a list of {"call_name", "params", "format"} entries, which are run
+    concurrently against a single loader. Returns one result per call, in order."""
+
+    def run(call):
+        call_name = call.get("call_name")
+        params = call.get("params") or {}
+        content = call.get("format")
+        result = {"call_name": call_name}
+        if (
+            not isinstance(call_name, str)
+            or not call_name
+            or "/" in call_name
+            or not isinstance(params, dict)
+            or (content and content not in static.mimetypes)
+        ):
+            result.update(status=400, error="Invalid call name or format")
+            return result
+        # Parameter values are given as JSON, but used as query string values
+        if not all(
+            isinstance(v, (str, int, float, bool)) or v is None for v in params.values()
+        ):
+            result.update(status=400, error="Parameter values must be scalars")
+            return result
+        params = {
+            k: json.dumps(v) if isinstance(v, bool) else str(v)
+            for k, v in params.items()
+            if v is not None
+        }
+
+        requestUrl = baseUrl + call_name
+        if content:
+            requestUrl += "." + content
+        if params:
+            requestUrl += "?" + urlencode(params)
+        try:
+            # The loader is shared by all calls (through the loader registry)
+            loader = getLoader(
+                user,
+                repo,
+                subdir,
+                spec_url,
+                sha=sha,
+                prov=None,
+                git_type=git_type,
+                branch=branch,
+            )
+            resp, status, headers = dispatch_query(
+                user,
+                repo,
+                call_name,
+                subdir,
+                spec_url,
+                sha=sha,
+                content=content,
+                requestArgs=params,
+                acceptHeader=acceptHeader,
+                requestUrl=requestUrl,
+                method="GET",
+                git_type=git_type,
+                branch=branch,
+                loader=loader,
+            )
+        except connections.CircuitOpenError as e:
+            resp, status, headers = {"error": str(e)}, 503, {}
+        except connections.DeadlineExceeded as e:
+            resp, status, headers = {"error": str(e)}, 504, {}
+        except Exception as e:
+            glogger.error("Batch call {} failed: {}".format(call_name, e))
+            resp, status, headers = {"error": str(e)}, 500, {}
+
+        if not isinstance(resp, (str, list, dict)):  # streamed response
+            resp = b"".join(resp).decode("utf-8")
+        result.update(status=status, headers=dict(headers), body=resp)
+        return result
+
+    # Each call runs in a copy of the current context, so it keeps the
+    # request deadline and the Flask request (e.g. an ?endpoint= override)
+    with ThreadPoolExecutor(max_workers=static.BATCH_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, run, call) for call in calls
+        ]
+        return [f.result() for f in futures]
+
+
+def getDumpGraph(endpoint, mime_type):
+    """Returns the graph of the RDF dump at endpoint, parsed in the given format.
+    Graphs are cached and, once validated more than dump_cache_ttl seconds ago,
+    revalidated with a conditional GET, so unchanged dumps are not parsed again."""
+    key = (endpoint, mime_type)
+    cached = dump_cache.get(key)
+    if cached is not None and time.time() - cached.validated < static.DUMP_CACHE_TTL:
+        return cached.graph
+    return dump_flights.do(key, lambda: _loadDumpGraph(key, cached))
+
+
+def _loadDumpGraph(key, cached):
+    """Downloads and parses a dump, unless it did not change since cached was parsed."""
+    if dumpstore.enabled():
+        return _loadDumpStore(key, cached)
+    endpoint, mime_type = key
+    headers = {"User-Agent": static.USER_AGENT}
+    if cached is not None:
+        with _dump_stats_lock:
+            _dump_stats["revalidations"] += 1
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+    try:
+        response = connections.get(endpoint, headers=headers)
+        if cached is None or response.status_code != 304:
+            response.raise_for_status()
+    except Exception as e:
+        if cached is None:
+            raise
+        glogger.warning("Could not revalidate dump {}: {}".format(endpoint, e))
+        return cached.graph
+
+    if response.status_code == 304:
+        glogger.debug("Dump {} not modified, reusing its graph".format(endpoint))
+        with _dump_stats_lock:
+            _dump_stats["unchanged"] += 1
+        entry = cached._replace(validated=time.time())
+    else:
+        start = time.monotonic()
+        g = Graph()
+        g.parse(data=response.content, format=mime_type, publicID=endpoint)
+        elapsed = time.monotonic() - start
+        glogger.debug(
+            "Dump {} parsed in {:.2f}s, {} triples".format(endpoint, elapsed, len(g))
+        )
+        with _dump_stats_lock:
+            _dump_stats["parses"] += 1
+            _dump_stats["parse_seconds"] += elapsed
+        entry = DumpGraph(
+            g,
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            time.time(),
+            None,
+        )
+    dump_cache.set(key, entry, size=len(entry.graph) * DUMP_TRIPLE_SIZE)
+    return entry.graph
+
+
+def _loadDumpStore(key, cached):
+    """Opens the on-disk store of a dump, which is converted first if the dump
+    changed. Stores live on disk, so only their (small) open graph is cached.
+    The graph of each store is opened once per process, and closed (after
+    dump_store_grace seconds, as queries may still be using it) when the dump
+    changes or its graph is evicted from the cache."""
+    store = dumpstore.update(*key)
+    with _store_graphs_lock:
+        current = _store_graphs.get(key)
+        if current is not None and current[0] == store:
+            graph = current[1]
+        else:
+            graph = dumpstore.open_graph(store, key[0])
+            _store_graphs[key] = (store, graph)
+            if current is not None:
+                _retired_graphs.append((current[1], time.time()))
+        _closeRetiredGraphs()
+    entry = DumpGraph(graph, None, None, time.time(), store)
+    dump_cache.set(key, entry, size=DUMP_TRIPLE_SIZE)
+    return graph
+
+
+def _retireStoreGraph(key):
+    """Closes the graph of the store of a dump, once its grace period is over."""
+    with _store_graphs_lock:
+        current = _store_graphs.pop(key, None)
+        if current is not None:
+            _retired_graphs.append((current[1], time.time()))
+        _closeRetiredGraphs()
+
+
+def _closeRetiredGraphs():
+    """Closes the graphs retired more than dump_store_grace seconds ago."""
+    for retired in list(_retired_graphs):
+        graph, replaced = retired
+        if time.time() - replaced >= static.DUMP_STORE_GRACE:
+            _retired_graphs.remove(retired)
+            try:
+                graph.close()
+            except Exception as e:
+                glogger.warning("Could not close dump store: {}".format(e))
+
+
+def dump_cache_stats():
+    """Returns usage statistics of the cache of dump graphs, including the
+    number of dumps parsed and the time spent parsing them (and, with on-disk
+    stores, converting them)."""
+    stats = dump_cache.stats()
+    with _dump_stats_lock:
+        stats.update(_dump_stats)
+    if dumpstore.enabled():
+        stats["store"] = dumpstore.stats()
+    return stats
+
+
 def _dispatchQueryDump(
     raw_sparql_query, endpoint, mime_type, rewritten_query, acceptHeader, content
 ):
@@ -179,16 +553,18 @@ def _dispatchQueryDump(
         )
     )
 
-    g = Graph()
+    headers = {}
     try:
-        g.parse(endpoint, format=mime_type)
-        glogger.debug(
-            "Local RDF graph loaded successfully with {} triples".format(len(g))
-        )
+        g = getDumpGraph(endpoint, mime_type)
+        glogger.debug("Local RDF graph of dump {} loaded".format(endpoint))
     except Exception as e:
         glogger.error(e)
+        g = Graph()
 
-    results = g.query(rewritten_query, result="sparql")
+    # Cached graphs are shared by all threads, but the query parser is not thread safe
+    with gquery._parse_lock:
+        query = prepareQuery(rewritten_query, initNs=dict(g.namespaces()))
+    results = g.query(query)
 
     # Prepare return format as requested
     if "application/json" in acceptHeader or (
@@ -210,9 +586,7 @@ def _dispatchQueryDump(
     else:
         resp = "Unacceptable requested format"
         code = 415
-        headers = {}
     glogger.debug("Finished processing query against RDF dump, end of use case")
-    del g
     return resp, code, headers
 
 
@@ -235,22 +609,48 @@ def _dispatchQueryInsert(
         "Content-Type": "application/sparql-update",
         "User-Agent": static.USER_AGENT,
     }
-    response = requests.post(
+    response = connections.post(
         endpoint, data=rewritten_query, headers=reqHeaders, auth=auth
     )
     glogger.debug("Response header from endpoint: " + response.headers["Content-Type"])
 
     # Response headers
     resp = response.text
-    code = 200
+    code = response.status_code
     headers["Content-Type"] = response.headers["Content-Type"]
 
     return resp, code, headers
 
 
+def _streamResponse(response, chunk_size, decode_content=True):
+    """Yields the body of the given upstream response in chunks of `chunk_size`
+    bytes. Chunks are only read from the endpoint as the client consumes them,
+    so a slow client slows down the upstream transfer instead of filling memory.
+    With `decode_content=False`, compressed bodies are passed through as sent."""
+    try:
+        if decode_content:
+            chunks = response.iter_content(chunk_size=chunk_size)
+        else:
+            chunks = response.raw.stream(chunk_size, decode_content=False)
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+
 def _dispatchQuerySelect(
-    acceptHeader, content, rewritten_query, endpoint, auth, headers, endpoint_method
+    acceptHeader,
+    content,
+    rewritten_query,
+    endpoints,
+    auth,
+    headers,
+    endpoint_method,
+    stream=False,
+    acceptEncoding="",
 ):
+    """Sends a SELECT (or CONSTRUCT) query to one of the given endpoint replicas."""
     reqHeaders = {
         "Accept": acceptHeader,
         "Content-Type": "application/sparql-query",
@@ -264,34 +664,95 @@ def _dispatchQuerySelect(
     glogger.debug("... w/headers: {}".format(reqHeaders))
     glogger.debug("... w/auth: {}".format(auth))
     glogger.debug("... via: {}".format(endpoint_method))
+    glogger.debug("... streaming: {}".format(stream))
 
     try:
         if endpoint_method == "GET":
             data = {"query": rewritten_query}
-            response = requests.get(
-                endpoint, params=data, headers=reqHeaders, auth=auth
+            response = connections.balanced_request(
+                "GET",
+                endpoints,
+                params=data,
+                headers=reqHeaders,
+                auth=auth,
+                stream=stream,
             )
         else:
-            response = requests.post(
-                endpoint, data=rewritten_query, headers=reqHeaders, auth=auth
+            response = connections.balanced_request(
+                "POST",
+                endpoints,
+                data=rewritten_query,
+                headers=reqHeaders,
+                auth=auth,
+                stream=stream,
             )
         # Response headers
-        resp = response.text
-        code = 200
+        if stream:
+            # Compressed bodies the client can decode are forwarded as they are
+            encoding = response.headers.get("Content-Encoding")
+            passthrough = (
+                encoding is not None
+                and parse_accept_header(acceptEncoding).quality(encoding) > 0
+            )
+            if passthrough:
+                headers["Content-Encoding"] = encoding
+            resp = _streamResponse(
+                response, static.HTTP_STREAM_CHUNK_SIZE, not passthrough
+            )
+        else:
+            resp = response.text
+        # Errors of the endpoint are passed on as such (and never cached)
+        code = response.status_code
         glogger.debug(
             "Response header from endpoint: " + response.headers["Content-Type"]
         )
+    except connections.CircuitOpenError as e:
+        glogger.debug("SPARQL endpoint is unavailable")
+        return {"error": str(e)}, 503, headers
+    except connections.DeadlineExceeded as e:
+        glogger.debug("Request deadline exceeded before contacting SPARQL endpoint")
+        return {"error": str(e)}, 504, headers
     except Exception as e:
         # Error contacting SPARQL endpoint
         glogger.debug("Exception encountered while connecting to SPARQL endpoint")
         return {"error": str(e)}, 400, headers
 
-    glogger.debug("Got HTTP response from to SPARQL endpoint: {}".format(resp))
+    if not stream:
+        glogger.debug("Got HTTP response from to SPARQL endpoint: {}".format(resp))
     headers["Content-Type"] = response.headers["Content-Type"]
 
     return resp, code, headers
 
 
+def _fingerprint(resp, transform=None):
+    """Returns a strong validator for the given response body, once transformed
+    with the given (serialized) transform."""
+    if isinstance(resp, str):
+        resp = resp.encode("utf-8")
+    fingerprint = hashlib.sha1(resp)
+    if transform:
+        fingerprint.update(transform.encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def _transformOf(query_metadata, acceptHeader):
+    """Returns the post-processing applied to the results of a query, serialized
+    (None if results are returned as they come from the endpoint)."""
+    if not _needsTransformerPostprocess(query_metadata, acceptHeader):
+        return None
+    if "proto" in query_metadata:
+        transform = [query_metadata["proto"], query_metadata.get("opt")]
+    else:
+        transform = query_metadata["transform"]
+    return json.dumps(transform, sort_keys=True, default=str)
+
+
+def _needsTransformerPostprocess(query_metadata, acceptHeader):
+    return "proto" in query_metadata or (
+        "transform" in query_metadata and acceptHeader == "application/json"
+    )
+
+
 def _dispatchTransformerPostprocess(query_metadata, resp):
     if "proto" in query_metadata:
         resp = SPARQLTransformer.post_process(
@@ -320,18 +781,22 @@ def dispatchSPARQLQuery(
     formData,
     requestUrl,
     method="GET",
+    acceptEncoding="",
 ):
     """Executes the specified SPARQL query."""
-    endpoint, auth = gquery.guess_endpoint_uri(raw_sparql_query, loader)
+    endpoints, auth = gquery.guess_endpoint_uris(raw_sparql_query, loader)
+    endpoint = endpoints[0]
     if endpoint == "":
         return "No SPARQL endpoint indicated", 407, {}
 
     glogger.debug("=====================================================")
-    glogger.debug("Sending query to SPARQL endpoint: {}".format(endpoint))
+    glogger.debug("Sending query to SPARQL endpoint: {}".format(endpoints))
     glogger.debug("=====================================================")
 
     try:
-        query_metadata = gquery.get_metadata(raw_sparql_query, endpoint)
+        query_metadata = gquery.compile_query(raw_sparql_query, endpoint)
+    except (connections.CircuitOpenError, connections.DeadlineExceeded):
+        raise
     except Exception as e:
         # extracting metadata
         return {"error": str(e)}, 400, {}
@@ -340,6 +805,8 @@ def dispatchSPARQLQuery(
         "application/json" if isinstance(raw_sparql_query, dict) else acceptHeader
     )
     pagination = query_metadata["pagination"] if "pagination" in query_metadata else ""
+    # Key of queries paginated in keyset mode (None for LIMIT/OFFSET pagination)
+    pagination_key = query_metadata.get("pagination_key") if pagination else None
     endpoint_method = (
         query_metadata["endpoint-method"]
         if "endpoint-method" in query_metadata
@@ -353,11 +820,39 @@ def dispatchSPARQLQuery(
         or query_metadata["type"] == "ConstructQuery"
     ):
         rewritten_query = gquery.rewrite_query(
-            query_metadata["original_query"], query_metadata["parameters"], requestArgs
+            query_metadata["original_query"],
+            query_metadata["parameters"],
+            requestArgs,
+            query_metadata.get("rewrite_template"),
+        )
+
+    # Count the results of paginated queries while the page is fetched
+    count_future = None
+    if (
+        pagination
+        and query_metadata["type"] == "SelectQuery"
+        and query_metadata.get("count", True) is not False
+        and not query_metadata.get("mime")
+        and not pagination_key
+    ):
+        count_future = count_executor.submit(
+            contextvars.copy_context().run,
+            gquery.count_query_results,
+            rewritten_query,
+            endpoints,
+            auth,
+            endpoint_method,
         )
 
     # Rewrite query using pagination
-    if query_metadata["type"] == "SelectQuery" and "pagination" in query_metadata:
+    if pagination_key:
+        try:
+            rewritten_query = gquery.paginate_query_keyset(
+                rewritten_query, pagination, pagination_key, requestArgs.get("cursor")
+            )
+        except ValueError as e:
+            return {"error": str(e)}, 400, {}
+    elif query_metadata["type"] == "SelectQuery" and "pagination" in query_metadata:
         rewritten_query = gquery.paginate_query(
             rewritten_query, query_metadata["pagination"], requestArgs
         )
@@ -385,29 +880,77 @@ def dispatchSPARQLQuery(
 
     # If there's no mime type, the endpoint is an actual SPARQL endpoint
     else:
-        resp, code, headers = _dispatchQuerySelect(
-            acceptHeader,
-            content,
+        # Results that need no post-processing can be passed through as they arrive
+        # (but the last result of keyset paginated pages is needed for the cursor)
+        stream = (
+            static.HTTP_STREAM_RESULTS
+            and not _needsTransformerPostprocess(query_metadata, acceptHeader)
+            and not pagination_key
+        )
+        # Results are cached before post-processing, so their key and validators
+        # depend on the transform applied to them afterwards
+        transform = _transformOf(query_metadata, acceptHeader)
+        cache_key = (
+            tuple(endpoints),
             rewritten_query,
-            endpoint,
-            auth,
-            headers,
+            static.mimetypes[content] if content else acceptHeader,
             endpoint_method,
+            transform,
         )
+        cached = result_cache.get(cache_key) if result_cache.enabled else None
+        if cached:
+            glogger.debug("Serving query results from cache")
+            resp, code, cached_headers = cached
+            headers.update(cached_headers)
+        else:
+
+            def select():
+                return _dispatchQuerySelect(
+                    acceptHeader,
+                    content,
+                    rewritten_query,
+                    endpoints,
+                    auth,
+                    {},
+                    endpoint_method,
+                    stream,
+                    acceptEncoding,
+                )
+
+            if static.SINGLEFLIGHT and not stream:
+                resp, code, flight_headers = query_flights.do(cache_key, select)
+            else:
+                resp, code, flight_headers = select()
+            headers.update(flight_headers)
+            if result_cache.enabled and code == 200 and not stream:
+                # Cached results carry their own validators, so conditional
+                # requests can be answered without hashing the body again
+                headers["ETag"] = quote_etag(_fingerprint(resp, transform))
+                headers["Last-Modified"] = http_date()
+                result_cache.set(cache_key, (resp, code, dict(headers)))
 
     # If the query is paginated, set link HTTP headers
-    if pagination:
-        # Get number of total results
-        count = gquery.count_query_results(rewritten_query, endpoint)
+    if pagination_key:
+        cursor = None
+        if code == 200:
+            cursor = gquery.get_next_cursor(
+                resp,
+                headers.get("Content-Type"),
+                pagination_key,
+                pagination,
+                requestArgs.get("cursor"),
+            )
+        headers["Link"] = pageUtils.buildCursorPaginationHeader(cursor, requestUrl)
+    elif pagination:
+        # Get number of total results (None if unknown)
+        count = count_future.result() if count_future is not None else None
         pageArg = requestArgs.get("page", None)
         headerLink = pageUtils.buildPaginationHeader(
             count, pagination, pageArg, requestUrl
         )
         headers["Link"] = headerLink
 
-    if "proto" in query_metadata or (
-        "transform" in query_metadata and acceptHeader == "application/json"
-    ):
+    if code == 200 and _needsTransformerPostprocess(query_metadata, acceptHeader):
         resp = _dispatchTransformerPostprocess(query_metadata, resp)
 
     headers["Server"] = "grlc/" + grlc_version
@@ -416,9 +959,9 @@ def dispatchSPARQLQuery(
 
 def dispatchTPFQuery(raw_tpf_query, loader, acceptHeader, content):
     """Executes the specified TPF query."""
-    endpoint, auth = gquery.guess_endpoint_uri(raw_tpf_query, loader)
+    endpoints, auth = gquery.guess_endpoint_uris(raw_tpf_query, loader)
     glogger.debug("=====================================================")
-    glogger.debug("Sending query to TPF endpoint: {}".format(endpoint))
+    glogger.debug("Sending query to TPF endpoint: {}".format(endpoints))
     glogger.debug("=====================================================")
 
     # TODO: pagination for TPF
@@ -441,7 +984,9 @@ def dispatchTPFQuery(raw_tpf_query, loader, acceptHeader, content):
     object = tpf_list[tpf_list.index("object") + 1]
     data = {"subject": subject, "predicate": predicate, "object": object}
 
-    response = requests.get(endpoint, params=data, headers=reqHeaders, auth=auth)
+    response = connections.balanced_request(
+        "GET", endpoints, params=data, headers=reqHeaders, auth=auth
+    )
     glogger.debug("Response header from endpoint: " + response.headers["Content-Type"])
 
     # Response headers
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+# Compares rewriting queries with one str.replace per parameter (as grlc used
+# to) against the compiled rewrite template, on large queries with many
+# parameters. Not collected by pytest; run it with:
+#
+#   python -m tests.benchmark_rewrite
+
+import timeit
+
+import grlc.gquery as gquery
+
+
+def rewrite_replace(query, parameters, get_args):
+    """Rewrites query with one str.replace per parameter."""
+    for pname, p in parameters.items():
+        v = get_args.get(pname, None)
+        if not v:
+            continue
+        if p["type"] == "number":
+            query = query.replace(p["original"], v)
+        elif "format" in p and p["format"] == "iri":
+            query = query.replace(p["original"], "<{}>".format(v))
+        else:
+            query = query.replace(p["original"], '"{}"'.format(v))
+    return query
+
+
+def build_query(n_params, n_patterns):
+    """Builds a SELECT query using n_params parameters in n_patterns triple patterns."""
+    patterns = [
+        "  ?s{i} <http://example.org/p{i}> ?_p{j}_iri .\n"
+        "  ?s{i} <http://example.org/q{i}> ?_v{j} .\n"
+        "  FILTER(?n{i} > ?_n{j}_number)".format(i=i, j=i % n_params)
+        for i in range(n_patterns)
+    ]
+    return "SELECT * WHERE {\n" + "\n".join(patterns) + "\n}"
+
+
+def main():
+    for n_params, n_patterns in [(10, 100), (50, 1000), (200, 5000)]:
+        query = build_query(n_params, n_patterns)
+        parameters = gquery.get_parameters(query, "", {})
+        get_args = {}
+        for name, p in parameters.items():
+            get_args[name] = "http://example.org/{}".format(name)
+            if p["type"] == "number":
+                get_args[name] = "42"
+        template = gquery.compile_rewrite_template(query, parameters)
+
+        number = 20
+        replace_time = timeit.timeit(
+            lambda: rewrite_replace(query, parameters, get_args), number=number
+        )
+        template_time = timeit.timeit(
+            lambda: gquery.rewrite_query_standard(
+                query, parameters, get_args, template
+            ),
+            number=number,
+        )
+        compile_time = timeit.timeit(
+            lambda: gquery.compile_rewrite_template(query, parameters), number=number
+        )
+        print(
+            "{:>4} parameters, {:>7} bytes: replace {:8.3f} ms, "
+            "template {:8.3f} ms (compiling it once {:8.3f} ms)".format(
+                len(parameters),
+                len(query),
+                1000 * replace_time / number,
+                1000 * template_time / number,
+                1000 * compile_time / number,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
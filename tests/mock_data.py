@@ -39,7 +39,7 @@ def buildGHEntry(entryName):
 
 
 def buildGLEntry(entryName):
-    entryName = entryName.replace(base_url, "")
+    entryName = entryName.replace(base_url, "").strip(path.sep)
 
     return {"type": "blob", "name": entryName}
 
@@ -78,7 +78,7 @@ class MockGitlabModule:
     def gl_files_content(self, file_path, ref):
         """Returns none if the file is not in the known repo"""
         for glf in mock_gl_files:
-            if file_path in glf["name"]:  # filenames contain extra /
+            if file_path in glf["name"]:
                 f = Mock()
                 f_content = "The text of a file"
                 f.content = base64.b64encode(f_content.encode("utf-8"))
@@ -86,7 +86,7 @@ class MockGitlabModule:
         return None
 
 
-def mock_requestsUrl(url, headers={}, params={}):
+def mock_requestsUrl(url, headers={}, params={}, **kwargs):
     url = url.replace("http://example.org/", "tests/repo/")
     f = open(url, "r")
     lines = f.readlines()
@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import unittest
+import time
+import tempfile
+import threading
+from mock import patch
+
+from grlc.cache import LRUCache, DiskCache, SingleFlight, file_lock
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self):
+        c = LRUCache(max_bytes=100)
+        c.set("a", "xxxx")
+
+        self.assertEqual(c.get("a"), "xxxx", "Should return stored value")
+        self.assertIsNone(c.get("b"), "Should return None for missing keys")
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 1)
+
+    def test_byte_budget(self):
+        c = LRUCache(max_bytes=10)
+        c.set("a", "x" * 4)
+        c.set("b", "x" * 4)
+        c.get("a")  # a is now most recently used
+        c.set("c", "x" * 4)
+
+        self.assertIn("a", c, "Recently used entry should be kept")
+        self.assertNotIn("b", c, "Least recently used entry should be evicted")
+        self.assertIn("c", c)
+        self.assertLessEqual(c.stats()["bytes"], 10)
+
+        c.set("d", "x" * 11)
+        self.assertNotIn("d", c, "Values larger than the budget are not stored")
+
+    def test_ttl(self):
+        c = LRUCache(max_bytes=100, ttl=10)
+        with patch("grlc.cache.time.time", return_value=1000):
+            c.set("a", "x")
+            c.set("b", "x", ttl=100)
+        with patch("grlc.cache.time.time", return_value=1050):
+            self.assertIsNone(c.get("a"), "Expired entry should not be returned")
+            self.assertEqual(c.get("b"), "x", "Entry TTL should override default")
+
+    def test_disabled(self):
+        c = LRUCache(max_bytes=0)
+        c.set("a", "x")
+        self.assertFalse(c.enabled)
+        self.assertIsNone(c.get("a"))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesce_threads(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flights.do("k", slow_call)))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for _ in range(500):  # Wait until all followers joined the leader
+            if flights.stats()["shared"] == 4:
+                break
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1, "Only the leader should run the call")
+        self.assertEqual(results, ["result"] * 5, "All callers share the result")
+
+        flights.do("k", slow_call)
+        self.assertEqual(len(calls), 2, "Finished calls should not be reused")
+
+    def test_coalesce_processes(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            worker1 = SingleFlight(lock_dir, share_ttl=60)
+            worker2 = SingleFlight(lock_dir, share_ttl=60)
+
+            self.assertEqual(worker1.do(("a", 1), lambda: "first"), "first")
+            self.assertEqual(
+                worker2.do(("a", 1), lambda: "second"),
+                "first",
+                "Should share result through lock directory",
+            )
+            self.assertEqual(worker2.do(("b", 1), lambda: "second"), "second")
+            self.assertEqual(
+                sorted(name for name in os.listdir(lock_dir) if "lock" in name),
+                [],
+                "Lock files are removed once released",
+            )
+
+            # Expired results (and long abandoned locks) are swept away
+            with open(os.path.join(lock_dir, "abandoned.lock"), "w"):
+                pass
+            for name in os.listdir(lock_dir):
+                past = time.time() - 3600
+                os.utime(os.path.join(lock_dir, name), (past, past))
+            worker2._swept = 0
+            worker2.do(("c", 1), lambda: "third")
+            self.assertEqual(len(os.listdir(lock_dir)), 1, "Only the last result")
+
+    def test_file_lock(self):
+        """Test that a busy file lock is polled with (cooperative) sleeps."""
+        with tempfile.TemporaryDirectory() as lock_dir:
+            path = os.path.join(lock_dir, "k.lock")
+            locked, release = threading.Event(), threading.Event()
+
+            def hold():
+                with file_lock(path):
+                    locked.set()
+                    release.wait(5)
+
+            holder = threading.Thread(target=hold)
+            holder.start()
+            locked.wait(5)
+            with patch("grlc.cache.time.sleep", side_effect=time.sleep) as sleep:
+                threading.Timer(0.05, release.set).start()
+                with file_lock(path):
+                    self.assertTrue(release.is_set())
+            self.assertGreater(sleep.call_count, 0, "Should poll, not block")
+            holder.join()
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_get_set(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            DiskCache(cache_dir).set(("spec", "sha"), {"paths": {}})
+
+            # A cache in another process reads the same directory
+            c = DiskCache(cache_dir)
+            self.assertEqual(c.get(("spec", "sha")), {"paths": {}})
+            self.assertIsNone(c.get(("spec", "other")))
+
+            c.delete(("spec", "sha"))
+            self.assertIsNone(c.get(("spec", "sha")))
+
+    def test_ttl(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            c = DiskCache(cache_dir, ttl=60)
+            c.set("a", "value")
+            self.assertEqual(c.get("a"), "value")
+
+            with patch("time.time", return_value=time.time() + 61):
+                self.assertIsNone(c.get("a"), "Should expire entries")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+import time
+import unittest
+import requests
+from mock import patch, Mock
+
+import grlc.connections as connections
+
+
+class TestConnections(unittest.TestCase):
+    def tearDown(self):
+        connections.reset()
+
+    def test_session_per_endpoint(self):
+        s1 = connections.get_session("http://example.org/sparql")
+        s2 = connections.get_session("http://example.org/other/sparql")
+        s3 = connections.get_session("https://example.com/sparql")
+
+        self.assertIs(s1, s2, "Same host should share a session")
+        self.assertIsNot(s1, s3, "Different hosts should not share a session")
+
+    @patch(
+        "grlc.static.ENDPOINT_HTTP_CONFIG",
+        {"example.org": {"pool_maxsize": "3", "keep_alive": "False"}},
+    )
+    def test_endpoint_config(self):
+        conf = connections.get_endpoint_config("http://example.org:8890/sparql")
+        self.assertEqual(conf["pool_maxsize"], 3, "Should use endpoint pool size")
+        self.assertFalse(conf["keep_alive"], "Should use endpoint keep-alive")
+
+        session = connections.get_session("http://example.org:8890/sparql")
+        self.assertEqual(session.headers["Connection"], "close")
+
+    def test_pool_stats(self):
+        session = connections.get_session("http://example.org/sparql")
+        session.get_adapter("http://example.org").get_connection_with_tls_context(
+            session.prepare_request(
+                connections.requests.Request("GET", "http://example.org/sparql")
+            ),
+            verify=True,
+        )
+
+        stats = connections.pool_stats()
+        self.assertIn("http://example.org", stats)
+        self.assertIn("idle", stats["http://example.org"])
+        self.assertIn("requests", stats["http://example.org"])
+
+    def test_timeout_and_deadline(self):
+        connect, read = connections.get_timeout("http://example.org/sparql")
+        self.assertGreater(read, 0, "Requests should always have a timeout")
+
+        connections.set_deadline(5)
+        connect, read = connections.get_timeout("http://example.org/sparql")
+        self.assertLessEqual(read, 5, "Timeout should be capped by the deadline")
+
+        connections.set_deadline(-1)
+        with self.assertRaises(connections.DeadlineExceeded):
+            connections.get_timeout("http://example.org/sparql")
+        connections.set_deadline(None)
+
+    @patch("grlc.static.HTTP_BREAKER_FAILURES", 2)
+    @patch("grlc.static.HTTP_BREAKER_COOLDOWN", 30)
+    @patch("requests.Session.get")
+    def test_circuit_breaker(self, mock_get):
+        mock_get.side_effect = requests.exceptions.ConnectionError("down")
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                connections.get("http://example.org/sparql")
+
+        with self.assertRaises(connections.CircuitOpenError):
+            connections.get("http://example.org/sparql")
+        self.assertEqual(mock_get.call_count, 2, "Open circuit should fail fast")
+
+        # After the cool-down, a single trial request is let through
+        breaker = connections.get_breaker("http://example.org/sparql")
+        breaker.opened_at -= 30
+        self.assertEqual(breaker.state, "half-open")
+        mock_get.side_effect = None
+        mock_get.return_value = Mock(status_code=200)
+        connections.get("http://example.org/sparql")
+        self.assertEqual(breaker.state, "closed", "Successful trial should close")
+
+        # Errors of single queries do not open the circuit
+        mock_get.return_value = Mock(status_code=500)
+        for _ in range(3):
+            connections.get("http://example.org/sparql")
+        self.assertEqual(breaker.state, "closed")
+        mock_get.return_value = Mock(status_code=503)
+        for _ in range(2):
+            connections.get("http://example.org/sparql")
+        self.assertEqual(breaker.state, "open")
+
+    @patch("grlc.static.HTTP_BALANCE", "least_outstanding")
+    def test_rank_endpoints(self):
+        urls = ["http://a.example.org/sparql", "http://b.example.org/sparql"]
+        connections.get_replica_stats(urls[0]).start()
+        self.assertEqual(
+            connections.rank_endpoints(urls)[0],
+            urls[1],
+            "Should prefer the replica with fewer requests in flight",
+        )
+
+    @patch("grlc.static.HTTP_BALANCE", "ewma")
+    def test_rank_endpoints_ewma(self):
+        urls = ["http://a.example.org/sparql", "http://b.example.org/sparql"]
+        connections.get_replica_stats(urls[0]).start()
+        connections.get_replica_stats(urls[0]).finish(0.1, True)
+        connections.get_replica_stats(urls[1]).start()
+        connections.get_replica_stats(urls[1]).finish(2, True)
+        self.assertEqual(
+            connections.rank_endpoints(urls), urls, "Should prefer the faster replica"
+        )
+
+    @patch("grlc.static.HTTP_BALANCE", "first")
+    @patch("grlc.static.HTTP_HEDGE_AFTER", 0)
+    @patch("requests.Session.get")
+    def test_failover(self, mock_get):
+        def replica(url, **kwargs):
+            if "a.example.org" in url:
+                raise requests.exceptions.ConnectionError("down")
+            return Mock(status_code=200, url=url)
+
+        mock_get.side_effect = replica
+        response = connections.balanced_request(
+            "GET", ["http://a.example.org/sparql", "http://b.example.org/sparql"]
+        )
+        self.assertIn("b.example.org", response.url, "Should fail over to replica")
+        self.assertEqual(mock_get.call_count, 2)
+
+        mock_get.side_effect = requests.exceptions.ConnectionError("down")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            connections.balanced_request(
+                "GET", ["http://a.example.org/sparql", "http://b.example.org/sparql"]
+            )
+
+    @patch("grlc.static.HTTP_BALANCE", "first")
+    @patch("grlc.static.HTTP_HEDGE_AFTER", 0.05)
+    @patch("requests.Session.get")
+    def test_hedging(self, mock_get):
+        def replica(url, **kwargs):
+            if "a.example.org" in url:
+                time.sleep(0.5)
+            return Mock(status_code=200, url=url)
+
+        mock_get.side_effect = replica
+        start = time.monotonic()
+        response = connections.balanced_request(
+            "GET", ["http://a.example.org/sparql", "http://b.example.org/sparql"]
+        )
+        self.assertIn("b.example.org", response.url, "Should use the hedged request")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch, Mock
+
+from rdflib.plugins.stores.berkeleydb import has_bsddb
+
+import grlc.dumpstore as dumpstore
+
+DUMP = b"<http://ex.org/s> <http://ex.org/p> <http://ex.org/o> ."
+
+
+class TestDumpStore(unittest.TestCase):
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        patcher = patch("grlc.static.DUMP_STORE_DIR", self.store_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.store_dir, ignore_errors=True)
+
+    def mockDump(self, status_code=200, etag='"v1"'):
+        response = Mock(ok=True, status_code=status_code)
+        response.headers = {"ETag": etag}
+        response.iter_content.return_value = [DUMP]
+        return response
+
+    @patch("grlc.dumpstore._convert")
+    @patch("requests.Session.get")
+    def test_update(self, mock_get, mock_convert):
+        """Test that dumps are converted once, and again only when they change."""
+
+        def convert(base, response, mime_type, endpoint):
+            name = "store-{}".format(mock_convert.call_count)
+            os.mkdir(os.path.join(self.store_dir, name))
+            return name
+
+        mock_convert.side_effect = convert
+        mock_get.side_effect = [
+            self.mockDump(),
+            self.mockDump(304),
+            self.mockDump(etag='"v2"'),
+        ]
+
+        first = dumpstore.update("http://mock-endpoint/dump.nt", "nt")
+        self.assertEqual(first, os.path.join(self.store_dir, "store-1"))
+        self.assertEqual(dumpstore.update("http://mock-endpoint/dump.nt", "nt"), first)
+        _, kwargs = mock_get.call_args
+        self.assertEqual(kwargs["headers"]["If-None-Match"], '"v1"')
+        self.assertEqual(mock_convert.call_count, 1, "Should not convert again")
+
+        second = dumpstore.update("http://mock-endpoint/dump.nt", "nt")
+        self.assertEqual(second, os.path.join(self.store_dir, "store-2"))
+        self.assertTrue(os.path.exists(first), "Should keep the previous store a while")
+
+    @patch("grlc.static.DUMP_STORE_GRACE", 60)
+    @patch("grlc.dumpstore.time.time")
+    @patch("grlc.dumpstore._convert")
+    @patch("requests.Session.get")
+    def test_update_grace(self, mock_get, mock_convert, mock_time):
+        """Test that replaced stores are removed once their grace period is over."""
+
+        def convert(base, response, mime_type, endpoint):
+            name = "store-{}".format(mock_convert.call_count)
+            os.mkdir(os.path.join(self.store_dir, name))
+            return name
+
+        mock_convert.side_effect = convert
+        mock_get.side_effect = [
+            self.mockDump(),
+            self.mockDump(etag='"v2"'),
+            self.mockDump(304),
+            self.mockDump(304),
+        ]
+        mock_time.return_value = 1000
+
+        first = dumpstore.update("http://mock-endpoint/dump.nt", "nt")
+        second = dumpstore.update("http://mock-endpoint/dump.nt", "nt")
+        mock_time.return_value = 1059
+        self.assertEqual(dumpstore.update("http://mock-endpoint/dump.nt", "nt"), second)
+        self.assertTrue(os.path.exists(first), "Still in its grace period")
+        mock_time.return_value = 1061
+        self.assertEqual(dumpstore.update("http://mock-endpoint/dump.nt", "nt"), second)
+        self.assertFalse(os.path.exists(first), "Should remove the previous store")
+        self.assertTrue(os.path.exists(second))
+
+    @unittest.skipUnless(has_bsddb, "berkeleydb not installed")
+    @patch("requests.Session.get")
+    def test_open_graph(self, mock_get):
+        mock_get.return_value = self.mockDump()
+
+        path = dumpstore.update("http://mock-endpoint/dump.nt", "nt")
+        g = dumpstore.open_graph(path, "http://mock-endpoint/dump.nt")
+        self.assertEqual(len(g), 1)
+        g.close()
+
+    @patch("grlc.static.DUMP_STORE", "NoSuchStore")
+    def test_enabled(self):
+        self.assertFalse(dumpstore.enabled(), "Should fall back to memory")
+        with patch("grlc.static.DUMP_STORE_DIR", ""):
+            self.assertFalse(dumpstore.enabled())
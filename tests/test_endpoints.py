@@ -2,6 +2,10 @@
 #
 # SPDX-License-Identifier: MIT
 
+import hmac
+import gzip
+import hashlib
+import json
 import pytest
 from mock import patch
 from tests.mock_data import mockLoader, mock_requestsUrl
@@ -203,6 +207,107 @@ class TestGrlcExec:
         rv = client.get("/api-local/query_name", headers={"accept": "application/json"})
         self.validate(rv)
 
+    @patch("grlc.utils.dispatch_query")
+    def test_etag(self, mock_dispatch, client):
+        """..."""
+        mock_dispatch.return_value = self.mock_response
+
+        rv = client.get("/api-local/query_name", headers={"accept": "application/json"})
+        self.validate(rv)
+        etag = rv.headers["ETag"]
+        assert etag
+
+        rv = client.get(
+            "/api-local/query_name",
+            headers={"accept": "application/json", "If-None-Match": etag},
+        )
+        assert rv.status_code == 304
+        assert rv.data == b""
+
+        rv = client.get(
+            "/api-local/query_name",
+            headers={"accept": "application/json", "If-None-Match": '"other"'},
+        )
+        self.validate(rv)
+
+    @patch("grlc.server.brotli", None)
+    @patch("grlc.utils.dispatch_query")
+    def test_compression(self, mock_dispatch, client):
+        """..."""
+        large_response = [{"result": "mock"}] * 200
+        mock_dispatch.return_value = large_response, 200, {}
+
+        rv = client.get(
+            "/api-local/query_name",
+            headers={"accept": "application/json", "Accept-Encoding": "gzip"},
+        )
+        assert rv.status_code == 200
+        assert rv.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in rv.headers["Vary"]
+        assert b"mock" in gzip.decompress(rv.data)
+
+        rv = client.get(
+            "/api-local/query_name",
+            headers={
+                "accept": "application/json",
+                "Accept-Encoding": "gzip",
+                "If-None-Match": rv.headers["ETag"],
+            },
+        )
+        assert rv.status_code == 304
+
+        rv = client.get("/api-local/query_name", headers={"accept": "application/json"})
+        assert "Content-Encoding" not in rv.headers
+        assert rv.json == large_response
+
+        # Compressed results of the endpoint, streamed as they are
+        body = gzip.compress(b"s\nhttp://example.org/s\n")
+        headers = {"Content-Type": "text/csv", "Content-Encoding": "gzip"}
+        mock_dispatch.return_value = iter([body]), 200, headers
+        rv = client.get(
+            "/api-local/query_name",
+            headers={"accept": "text/csv", "Accept-Encoding": "gzip"},
+        )
+        assert rv.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in rv.headers["Vary"]
+
+    @patch("grlc.utils.dispatch_query")
+    def test_batch(self, mock_dispatch, client):
+        """..."""
+        mock_dispatch.return_value = self.mock_response
+
+        rv = client.post(
+            "/api-local/_batch",
+            json=[
+                {"call_name": "query_name", "params": {"id": "1"}},
+                {"call_name": "query_name", "format": "csv"},
+                {"call_name": "../other"},
+                {"call_name": "query_name", "params": {"m": 10, "all": True}},
+                {"call_name": "query_name", "params": {"m": [10]}},
+            ],
+        )
+        assert rv.status_code == 200
+        assert rv.content_type == "application/x-ndjson"
+        results = [json.loads(line) for line in rv.data.splitlines()]
+        assert len(results) == 5
+        assert results[0]["status"] == 200
+        assert results[0]["body"][0]["result"] == "mock"
+        assert results[2]["status"] == 400
+        assert results[3]["status"] == 200
+        assert results[4]["status"] == 400
+        calls = [kwargs for _, kwargs in mock_dispatch.call_args_list]
+        assert any(kwargs["content"] == "csv" for kwargs in calls)
+        assert {"m": "10", "all": "true"} in [kwargs["requestArgs"] for kwargs in calls]
+
+        rv = client.post("/api-local/_batch", json={"not": "a list"})
+        assert rv.status_code == 400
+
+        # A repository which cannot be loaded fails each call, not the batch
+        with patch("grlc.utils.getLoader", side_effect=Exception("No such repo")):
+            rv = client.post("/api-local/_batch", json=[{"call_name": "query_name"}])
+        assert rv.status_code == 200
+        assert json.loads(rv.data)["status"] == 500
+
     @patch("requests.get", side_effect=mock_requestsUrl)
     @patch("grlc.utils.dispatch_query")
     def test_url(self, mock_dispatch, mock_get, client):
@@ -214,3 +319,46 @@ class TestGrlcExec:
             headers={"accept": "application/json"},
         )
         self.validate(rv)
+
+
+class TestGrlcWebhook:
+    """Test the push webhook rebuilding API specs."""
+
+    event = {
+        "ref": "refs/heads/main",
+        "repository": {"full_name": "testuser/testrepo", "default_branch": "main"},
+    }
+
+    def sign(self, body, secret="s3cret"):
+        digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        return {"X-Hub-Signature-256": "sha256=" + digest}
+
+    @patch("grlc.static.PREWARM_WEBHOOK_SECRET", "")
+    def test_webhook_disabled(self, client):
+        rv = client.post("/webhook/push", json=self.event)
+        assert rv.status_code == 404
+
+    @patch("grlc.static.PREWARM_WEBHOOK_SECRET", "s3cret")
+    @patch("grlc.prewarm.schedule")
+    def test_webhook_push(self, mock_schedule, client):
+        body = json.dumps(self.event).encode("utf-8")
+        rv = client.post(
+            "/webhook/push",
+            data=body,
+            content_type="application/json",
+            headers=self.sign(body, "wrong"),
+        )
+        assert rv.status_code == 403
+        assert not mock_schedule.called
+
+        rv = client.post(
+            "/webhook/push",
+            data=body,
+            content_type="application/json",
+            headers=self.sign(body),
+        )
+        assert rv.status_code == 202
+        assert rv.json["rebuilding"] == ["github:testuser/testrepo"]
+        (targets,), _ = mock_schedule.call_args
+        assert targets[0].user == "testuser"
+        assert targets[0].sha is None
@@ -2,12 +2,14 @@
 #
 # SPDX-License-Identifier: MIT
 
+import time
 import unittest
 import six
 import rdflib
 from mock import patch, Mock
 
 from tests.mock_data import mockLoader
+from grlc.cache import LRUCache
 
 import grlc.gquery as gquery
 
@@ -39,6 +41,24 @@ class TestGQuery(unittest.TestCase):
                 "from-decorator", endpoint, "Should match endpoint in test-rq.rq"
             )
 
+    @patch("grlc.static.DEFAULT_ENDPOINT", "http://a/sparql http://b/sparql")
+    def test_guess_endpoint_replicas(self):
+        with self.app.test_request_context("/"):
+            rq = "#+ endpoint:\n#+   - http://a/sparql\n#+   - http://b/sparql\n"
+            endpoints, _ = gquery.guess_endpoint_uris(rq, self.loader)
+            self.assertEqual(endpoints, ["http://a/sparql", "http://b/sparql"])
+
+            loader = Mock()
+            loader.getEndpointText.return_value = "http://a/sparql\nhttp://b/sparql\n"
+            endpoints, _ = gquery.guess_endpoint_uris("", loader)
+            self.assertEqual(endpoints, ["http://a/sparql", "http://b/sparql"])
+
+            loader.getEndpointText.side_effect = Exception("No endpoint.txt")
+            endpoints, _ = gquery.guess_endpoint_uris("", loader)
+            self.assertEqual(endpoints, ["http://a/sparql", "http://b/sparql"])
+            endpoint, _ = gquery.guess_endpoint_uri("", loader)
+            self.assertEqual(endpoint, "http://a/sparql")
+
     def test_get_parameters(self):
         rq, _ = self.loader.getTextForName("test-rq")
 
@@ -80,9 +100,9 @@ class TestGQuery(unittest.TestCase):
         )
         self.assertEqual(params["o7"]["datatype"], "xsd:date", "o7 should be a date")
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_get_enumeration(self, mock_get):
-        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value = Mock(ok=True, status_code=200)
         mock_get.return_value.json.return_value = {
             "results": {"bindings": [{"o1": {"value": "v1"}}, {"o1": {"value": "v2"}}]}
         }
@@ -95,6 +115,45 @@ class TestGQuery(unittest.TestCase):
         self.assertIsInstance(enumeration, list, "Should return a list of values")
         self.assertEqual(len(enumeration), 2, "Should have two elements")
 
+    @patch("grlc.gquery.enumeration_cache", LRUCache(max_bytes=10000))
+    @patch("grlc.static.ENUMERATION_CACHE_TTL", 60)
+    @patch("grlc.static.ENUMERATION_MAX_VALUES", 10)
+    @patch("requests.Session.get")
+    def test_get_enumeration_cache(self, mock_get):
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = {
+            "results": {"bindings": [{"o1": {"value": "v1"}}]}
+        }
+        rq, _ = self.loader.getTextForName("test-rq")
+        metadata = {"enumerate": "o1"}
+
+        for _ in range(2):
+            enumeration = gquery.get_enumeration(
+                rq, "o1", "http://mock-endpoint/sparql", metadata
+            )
+        self.assertEqual(enumeration, ["v1"])
+        self.assertEqual(mock_get.call_count, 1, "Should reuse cached values")
+        self.assertIn("LIMIT 10", mock_get.call_args[1]["params"]["query"])
+
+        # Stale values are served while they are refreshed
+        mock_get.return_value.json.return_value = {
+            "results": {"bindings": [{"o1": {"value": "v2"}}]}
+        }
+        with patch("time.time", return_value=time.time() + 61):
+            enumeration = gquery.get_enumeration(
+                rq, "o1", "http://mock-endpoint/sparql", metadata
+            )
+        self.assertEqual(enumeration, ["v1"], "Should serve stale values")
+        for _ in range(100):
+            if not gquery._enumeration_refreshing:
+                break
+            time.sleep(0.01)
+        enumeration = gquery.get_enumeration(
+            rq, "o1", "http://mock-endpoint/sparql", metadata
+        )
+        self.assertEqual(enumeration, ["v2"], "Should serve refreshed values")
+        self.assertEqual(mock_get.call_count, 2)
+
     def test_get_static_enumeration(self):
         rq, _ = self.loader.getTextForName("test-enum")
 
@@ -164,6 +223,42 @@ class TestGQuery(unittest.TestCase):
                 var, rdflib.term.Variable, "Should be of type Variable"
             )
 
+    def test_compile_query(self):
+        rq, _ = self.loader.getTextForName("test-sparql")
+        gquery.query_cache.clear()
+
+        with patch("grlc.gquery.parse_query", wraps=gquery.parse_query) as mock_parse:
+            metadata = gquery.compile_query(rq, "http://mock-endpoint/sparql")
+            metadata["type"] = "Modified"
+            again = gquery.compile_query(rq, "http://mock-endpoint/sparql")
+        self.assertEqual(mock_parse.call_count, 1, "Should parse the query once")
+        self.assertEqual(again["type"], "SelectQuery", "Should return a copy")
+        self.assertEqual(again["parameters"].keys(), metadata["parameters"].keys())
+
+    @patch("grlc.static.SPEC_BUILD_PROCESSES", 1)
+    def test_parse_query_process(self):
+        rq, _ = self.loader.getTextForName("test-sparql")
+
+        query_type, variables = gquery.parse_query(rq)
+        self.assertEqual(query_type, "SelectQuery", "Should parse in worker process")
+        self.assertEqual(variables, gquery.get_metadata(rq, "")["variables"])
+
+        with self.assertRaises(gquery.ParseException):
+            gquery.parse_query("SELECT WHERE")
+
+    @patch("grlc.static.SPEC_BUILD_PROCESSES", 1)
+    @patch("grlc.gquery._get_parse_executor")
+    def test_parse_query_process_timeout(self, mock_executor):
+        """Test that queries are parsed in process if the pool does not answer."""
+        future = mock_executor.return_value.submit.return_value
+        future.result.side_effect = gquery.FutureTimeoutError()
+        rq, _ = self.loader.getTextForName("test-sparql")
+
+        query_type, _ = gquery.parse_query(rq)
+        self.assertEqual(query_type, "SelectQuery")
+        _, kwargs = future.result.call_args
+        self.assertIsNotNone(kwargs["timeout"], "Should not wait forever")
+
     def test_paginate_query(self):
         rq, _ = self.loader.getTextForName("test-sparql")
 
@@ -176,6 +271,135 @@ class TestGQuery(unittest.TestCase):
         )
         self.assertIn("OFFSET", rq_pag, "Paginated query should contain OFFSET keyword")
 
+    @patch("grlc.gquery.count_cache", LRUCache(max_bytes=10000))
+    @patch("requests.Session.get")
+    def test_count_query_results(self, mock_get):
+        rq = "PREFIX ex: <http://example.org/>\nSELECT DISTINCT ?s WHERE { ?s ex:p ?o }"
+        counting_query = gquery.count_query(rq)
+        self.assertTrue(counting_query.startswith("PREFIX ex:"), "Should keep prefixes")
+        self.assertIn("COUNT(*)", counting_query)
+        self.assertIn("SELECT DISTINCT ?s", counting_query, "Should count a subquery")
+        self.assertIsNone(gquery.count_query("ASK { ?s ?p ?o }"))
+
+        rq_from = rq.replace(
+            "WHERE",
+            "FROM <http://example.org/g1>\nFROM NAMED <http://example.org/g2>\nWHERE",
+        )
+        counting_query = gquery.count_query(rq_from)
+        self.assertIsNotNone(counting_query, "Should count queries with a dataset")
+        self.assertIn(
+            "COUNT(*) AS ?grlc_count)\nFROM <http://example.org/g1>\n"
+            "FROM NAMED <http://example.org/g2> WHERE",
+            counting_query,
+            "Should keep the dataset outside the subquery",
+        )
+
+        mock_get.return_value = Mock(ok=True, status_code=200)
+        mock_get.return_value.json.return_value = {
+            "results": {"bindings": [{"grlc_count": {"value": "250"}}]}
+        }
+        for page in range(1, 3):
+            paginated = gquery.paginate_query(rq, 100, {"page": page})
+            count = gquery.count_query_results(paginated, "http://mock-endpoint/sparql")
+            self.assertEqual(count, 250)
+        self.assertEqual(mock_get.call_count, 1, "Should count once for all pages")
+
+        mock_get.side_effect = Exception("Timeout")
+        count = gquery.count_query_results(rq + " ", "http://mock-endpoint/sparql")
+        self.assertIsNone(count, "Should not fail if the count is unknown")
+
+    def test_get_pagination_key(self):
+        rq = "PREFIX ex: <http://example.org/>\nSELECT ?s ?o WHERE { ?s ex:p ?o }"
+        key = gquery.get_pagination_key(rq)
+        self.assertEqual(
+            key,
+            {
+                "variables": ["s", "o"],
+                "descending": [False, False],
+                "projection": ["s", "o"],
+            },
+        )
+        key_desc = gquery.get_pagination_key(rq + " ORDER BY DESC(?o)")
+        self.assertEqual(key_desc["variables"], ["o", "s"], "Should break ties")
+        self.assertEqual(key_desc["descending"], [True, False])
+        self.assertIsNone(gquery.get_pagination_key(rq + " ORDER BY STR(?o)"))
+        self.assertIsNone(
+            gquery.get_pagination_key(rq + " ORDER BY ?p"), "Not a projected variable"
+        )
+
+        rq = "SELECT * WHERE { ?o ?p ?s . ?s ?q ?a } VALUES ?p { <http://ex.org/p> }"
+        key = gquery.get_pagination_key(rq)
+        self.assertEqual(
+            key["projection"], ["o", "p", "s", "q", "a"], "In the query text order"
+        )
+
+    def test_paginate_query_keyset(self):
+        """Test that all the results of a query are returned, page after page."""
+        g = rdflib.Graph()
+        g.parse(
+            format="turtle",
+            data="""
+            @prefix ex: <http://example.org/> .
+            ex:a ex:p 1, 2 ; ex:label "a" .
+            ex:b ex:p 3 .
+            ex:c ex:p 1 ; ex:label "c" .
+            ex:d ex:p 2, 3, 4 .
+            """,
+        )
+        prefix = "PREFIX ex: <http://example.org/>\n"
+        queries = [
+            # Paged on IRIs
+            "SELECT ?s ?o WHERE { ?s ex:p ?o }",
+            # On an aggregate, with ties
+            "SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ex:p ?o } GROUP BY ?s"
+            " ORDER BY DESC(?n)",
+            # On unbound values
+            "SELECT * WHERE { ?s ex:p ?o OPTIONAL { ?s ex:label ?l } } ORDER BY ?l",
+            # With duplicate rows
+            "SELECT ?o WHERE { ?s ex:p ?o } ORDER BY DESC(?o)",
+            # With a VALUES clause
+            "SELECT ?s WHERE { ?s ex:p ?o } VALUES ?o { 1 2 }",
+        ]
+        for rq in queries:
+            rq = prefix + rq
+            key = gquery.get_pagination_key(rq)
+            expected = sorted(g.query(rq).bindings, key=repr)
+            for results_per_page in [1, 2, 3]:
+                rows, cursor = [], None
+                while True:
+                    paginated = gquery.paginate_query_keyset(
+                        rq, results_per_page, key, cursor
+                    )
+                    page = g.query(paginated).serialize(format="json")
+                    rows += rdflib.query.Result.parse(
+                        six.BytesIO(page), format="json"
+                    ).bindings
+                    cursor = gquery.get_next_cursor(
+                        page,
+                        "application/sparql-results+json",
+                        key,
+                        results_per_page,
+                        cursor,
+                    )
+                    if cursor is None:
+                        break
+                self.assertEqual(sorted(rows, key=repr), expected, paginated)
+
+        rq = prefix + queries[0]
+        key = gquery.get_pagination_key(rq)
+        with self.assertRaises(ValueError):
+            gquery.paginate_query_keyset(rq, 2, key, "not-a-cursor")
+        forged = gquery.encode_cursor(
+            [{"type": "uri", "value": 'a" || true) #'}, None], ["s", "o"]
+        )
+        paginated = gquery.paginate_query_keyset(rq, 2, key, forged)
+        self.assertIn('"a\\" || true) #"', paginated, "Should escape")
+        self.assertEqual(len(g.query(paginated)), 2)
+        with self.assertRaises(ValueError, msg="Cursor of another key"):
+            gquery.paginate_query_keyset(
+                rq, 2, {**key, "variables": ["o", "s"]}, forged
+            )
+
     @staticmethod
     def build_get_parameter(origName, rwName):
         """Builds parameter description in the format returned by gquery.get_parameters"""
@@ -235,6 +459,24 @@ class TestGQuery(unittest.TestCase):
                 "Rewritten query should contain replacement parameter value",
             )
 
+    def test_rewrite_query_standard(self):
+        rq = "SELECT * WHERE { ?s ?p ?_id . ?s ?q ?_identifier . ?s ?r ?_n_number }"
+        parameters = gquery.get_parameters(rq, "", {})
+        template = gquery.compile_rewrite_template(rq, parameters)
+        self.assertEqual(len(template), 7, "Should find each whole variable")
+
+        rq_rw = gquery.rewrite_query(
+            rq, parameters, {"id": 'a"b', "identifier": "x", "n": "5"}, template
+        )
+        self.assertIn('?p "a\\"b" .', rq_rw, "Values should be escaped")
+        self.assertIn('?q "x" .', rq_rw, "?_id should not match ?_identifier")
+        self.assertIn("?r 5 }", rq_rw)
+
+        rq_rw = gquery.rewrite_query(
+            rq, parameters, {"id": "a", "identifier": "x", "n": "5 } DROP ALL"}
+        )
+        self.assertIn('?r "5 } DROP ALL" }', rq_rw, "Numbers should be checked")
+
 
 if __name__ == "__main__":
     unittest.main()
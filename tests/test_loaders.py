@@ -2,11 +2,18 @@
 #
 # SPDX-License-Identifier: MIT
 
+import io
+import os
+import shutil
+import tarfile
+import tempfile
 import unittest
 import six
-from mock import patch
+from mock import patch, Mock
 from os import path
 
+import grlc.fileLoaders as fileLoaders
+from grlc.cache import LRUCache
 from grlc.fileLoaders import LocalLoader, GithubLoader, GitlabLoader, URLLoader
 from grlc.queryTypes import qType
 
@@ -107,6 +114,177 @@ class TestGithubLoaderSubdir(unittest.TestCase):
         self.assertIsNot(licenceURL, None, "License should not None")
 
 
+class TestGithubLoaderSnapshot(unittest.TestCase):
+    sha = "0123456789abcdef0123456789abcdef01234567"
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+        patches = [
+            patch("grlc.static.GITHUB_SNAPSHOTS", True),
+            patch("grlc.static.SNAPSHOT_DIR", self.snapshot_dir.name),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.snapshot_dir.cleanup)
+
+        self.gh_repo = Mock(full_name="fakeuser/fakerepo")
+        self.gh_repo.get_archive_link.return_value = "http://example.org/tarball"
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=self.gh_repo):
+            self.loader = GithubLoader("fakeuser", "fakerepo", sha=self.sha)
+
+    def archive(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w:gz") as archive:
+            archive.add(path.join("tests", "repo"), arcname="fakeuser-fakerepo-0123")
+        data.seek(0)
+        return Mock(status_code=200, raw=data)
+
+    @patch("requests.Session.get")
+    def test_snapshot(self, mock_get):
+        mock_get.return_value = self.archive()
+
+        files = self.loader.fetchFiles()
+        self.assertEqual(len(files), 11, "Should return correct number of files")
+        for fItem in files:
+            self.assertIn(self.sha, fItem["download_url"])
+            self.assertGreater(len(self.loader.getTextFor(fItem)), 0)
+
+        text, _ = self.loader.getTextForName("test-rq")
+        self.assertIn("from-decorator", text, "Should read files from snapshot")
+        self.assertIsNotNone(self.loader.getLicenceURL())
+        self.assertEqual(self.loader.getCommitSha(), self.sha)
+
+        # The archive is downloaded once, and no file goes through the API
+        self.assertEqual(self.gh_repo.get_archive_link.call_count, 1)
+        self.assertEqual(mock_get.call_count, 1)
+        self.gh_repo.get_contents.assert_not_called()
+
+    @patch("requests.Session.get")
+    def test_snapshot_confined(self, mock_get):
+        """Test that files outside the snapshot cannot be listed or read."""
+        mock_get.return_value = self.archive()
+        secret = path.join(self.snapshot_dir.name, "secret")
+        with open(secret, "w") as f:
+            f.write("secret")
+
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=self.gh_repo):
+            loader = GithubLoader("fakeuser", "fakerepo", subdir="../..", sha=self.sha)
+            missing = GithubLoader("fakeuser", "fakerepo", subdir="none", sha=self.sha)
+        self.assertEqual(loader.fetchFiles(), [])
+        self.assertIsNone(self.loader._getText("../../../secret"))
+        self.assertEqual(missing.fetchFiles(), [], "Missing subdir has no files")
+
+    @patch("grlc.static.SNAPSHOT_KEEP", 2)
+    @patch("requests.Session.get")
+    def test_snapshot_eviction(self, mock_get):
+        """Test that only the most recently used snapshots of a repo are kept."""
+        mock_get.side_effect = lambda *args, **kwargs: self.archive()
+        snapshots = path.join(self.snapshot_dir.name, "fakeuser", "fakerepo")
+        for age, name in enumerate(["recent", "old", "oldest"], start=1):
+            os.makedirs(path.join(snapshots, name))
+            os.utime(path.join(snapshots, name), (1000 - age, 1000 - age))
+
+        self.loader.fetchFiles()
+        self.assertEqual(sorted(os.listdir(snapshots)), sorted([self.sha, "recent"]))
+
+        # A loader whose snapshot was evicted downloads it again
+        shutil.rmtree(path.join(snapshots, self.sha))
+        self.assertEqual(len(self.loader.fetchFiles()), 11)
+        self.assertEqual(mock_get.call_count, 2)
+
+
+class TestRepoManifest(unittest.TestCase):
+    sha = "89abcdef0123456789abcdef0123456789abcdef"
+
+    def setUp(self):
+        self.gh_repo = Mock(full_name="fakeuser/fakerepo")
+        self.gh_repo.get_contents.side_effect = MockGithubRepo().get_contents
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=self.gh_repo):
+            self.loader = GithubLoader("fakeuser", "fakerepo", sha=self.sha)
+
+    def test_manifest(self):
+        for name in ["test-rq", "test-sparql", "test-tpf"]:
+            text, _ = self.loader.getTextForName(name)
+            self.assertEqual(text, "FAKE FILE CONTENT")
+        self.assertEqual(self.loader.getEndpointText(), "FAKE FILE CONTENT")
+        self.assertIsNotNone(self.loader.getLicenceURL())
+        self.assertEqual(
+            self.gh_repo.get_contents.call_count, 1, "Should list the files once"
+        )
+
+        # Loaders of the same commit share the manifest
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=self.gh_repo):
+            loader = GithubLoader("fakeuser", "fakerepo", sha=self.sha)
+        self.assertIs(loader.getManifest(), self.loader.getManifest())
+        self.assertEqual(self.gh_repo.get_contents.call_count, 1)
+
+    @patch("grlc.fileLoaders._heads", LRUCache(2**20, 60))
+    def test_manifest_branch(self):
+        """Test that the head of a branch is not resolved on every lookup."""
+        self.gh_repo.default_branch = "main"
+        self.gh_repo.get_commit.return_value = Mock(sha=self.sha)
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=self.gh_repo):
+            loader = GithubLoader("fakeuser", "fakerepo")
+
+        for name in ["test-rq", "test-sparql", "test-tpf"]:
+            loader.getTextForName(name)
+        loader.getEndpointText()
+        self.assertEqual(self.gh_repo.get_commit.call_count, 1)
+
+        fileLoaders.dropHeads()  # After a push
+        loader.getTextForName("test-rq")
+        self.assertEqual(self.gh_repo.get_commit.call_count, 2)
+
+
+class TestNeighbourCommits(unittest.TestCase):
+    @staticmethod
+    def gh_commit(sha, parent=None):
+        parents = [Mock(sha=parent)] if parent else []
+        return Mock(sha=sha, parents=parents)
+
+    def test_github(self):
+        history = [
+            self.gh_commit("c{}".format(i), "c{}".format(i - 1)) for i in range(1, 5)
+        ]
+        history.reverse()  # newest first
+        gh_repo = Mock(full_name="fakeuser/fakerepo")
+        gh_repo.get_commit.side_effect = lambda ref: next(
+            c for c in history if c.sha == ref
+        )
+        gh_repo.get_commits.return_value = history
+        with patch("grlc.fileLoaders.Github.get_repo", return_value=gh_repo):
+            loader = GithubLoader("fakeuser", "fakerepo")
+
+        version, prev_commit, next_commit = loader.getNeighbourCommits("c2")
+        self.assertEqual((version, prev_commit, next_commit), ("c2", "c1", "c3"))
+        gh_repo.get_commits.assert_called_once()
+        self.assertIn("since", gh_repo.get_commits.call_args[1])
+
+        with patch("grlc.static.NEIGHBOUR_SCAN_LIMIT", 1):
+            _, _, next_commit = loader.getNeighbourCommits("c1")
+        self.assertIsNone(next_commit, "Should give up after the scan limit")
+
+    @patch("grlc.fileLoaders.gitlab.Gitlab", return_value=MockGitlabModule())
+    def test_gitlab(self, mock_gitlab):
+        loader = GitlabLoader("fakeuser", "fakerepo")
+        history = [
+            Mock(id="c{}".format(i), parent_ids=["c{}".format(i - 1)])
+            for i in range(4, 0, -1)
+        ]
+        loader.gl_repo.commits.get.side_effect = lambda ref: next(
+            c for c in history if c.id == ref
+        )
+        loader.gl_repo.commits.list.return_value = iter(history)
+
+        version, prev_commit, next_commit = loader.getNeighbourCommits("c3")
+        self.assertEqual((version, prev_commit, next_commit), ("c3", "c2", "c4"))
+
+    def test_local(self):
+        loader = LocalLoader(path.join("tests", "repo"))
+        self.assertEqual(loader.getNeighbourCommits(), ("local", None, None))
+
+
 class TestGitlabLoader(unittest.TestCase):
     @classmethod
     @patch("grlc.fileLoaders.gitlab.Gitlab", return_value=MockGitlabModule())
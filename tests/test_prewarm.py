@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: 2022 Albert Meroño, Rinke Hoekstra, Carlos Martínez
+#
+# SPDX-License-Identifier: MIT
+
+import unittest
+from mock import patch
+
+import grlc.prewarm as prewarm
+import grlc.utils as utils
+
+
+class TestPrewarm(unittest.TestCase):
+    def test_parse_targets(self):
+        targets = prewarm.parse_targets("""
+            github:CLARIAH/grlc-queries
+            github:CLARIAH/grlc-queries/sub/dir@abc123
+            gitlab:group/project@develop
+            svn:not/supported
+            """)
+        self.assertEqual(len(targets), 3, "Should skip invalid repos")
+        self.assertEqual(
+            targets[0],
+            prewarm.Target("github", "CLARIAH", "grlc-queries", None, None, None),
+        )
+        self.assertEqual(targets[1].subdir, "sub/dir")
+        self.assertEqual(targets[1].sha, "abc123")
+        self.assertEqual(targets[2].branch, "develop", "GitLab refs are branches")
+
+    @patch(
+        "grlc.static.PREWARM_REPOS",
+        "gitlab:group/project gitlab:group/project@develop gitlab:group/project@v1x",
+    )
+    def test_targets_for_push(self):
+        targets = prewarm.targets_for_push("gitlab", "group/project", "main", "main")
+        self.assertEqual([t.branch for t in targets], [None])
+        targets = prewarm.targets_for_push("gitlab", "group/project", "develop", "main")
+        self.assertEqual([t.branch for t in targets], ["develop"])
+
+        targets = prewarm.targets_for_push("github", "user/repo", "main", "main")
+        self.assertEqual(len(targets), 1, "Should rebuild unlisted repos too")
+        targets = prewarm.targets_for_push("github", "user/repo", "dev", "main")
+        self.assertEqual(targets, [], "Pushes to other branches leave HEAD as is")
+
+    @patch("grlc.utils.build_swagger_spec")
+    def test_build(self, mock_build):
+        target = prewarm.Target("github", "testuser", "testrepo", None, None, None)
+        key = ("github", "testuser", "testrepo", None, None, None, None)
+        utils.loader_registry.set(key, object(), size=1)
+
+        prewarm.schedule([target])[0].result()
+        self.assertNotIn(key, utils.loader_registry, "Should reload the repo")
+        self.assertEqual(mock_build.call_count, 1)
+
+        mock_build.side_effect = Exception("Repo not found")
+        prewarm.build(target)  # Errors are only logged
+
+    @patch("grlc.prewarm._started_pid", None)
+    @patch("grlc.static.PREWARM_REPOS", "github:testuser/testrepo")
+    @patch("grlc.prewarm.schedule")
+    def test_start(self, mock_schedule):
+        """Test that each process starts prewarming once."""
+        prewarm.start()
+        prewarm.start()
+        self.assertEqual(mock_schedule.call_count, 1)
+
+        with patch("os.getpid", return_value=-1):  # A forked worker
+            prewarm.start()
+        self.assertEqual(mock_schedule.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,15 +4,23 @@
 
 # Run using `$ pytest -s`
 
+import time
+import random
 import unittest
 from mock import patch
 
-from grlc.swagger import build_spec
+from grlc.swagger import build_spec, process_tpf_query_text
+from grlc.cache import LRUCache
+import grlc.fileLoaders as fileLoaders
 
 from tests.mock_data import mock_process_sparql_query_text, filesInRepo
 
 
 class TestSwagger(unittest.TestCase):
+    def setUp(self):
+        # Listings are mocked per test, so manifests must not outlive them
+        fileLoaders._manifests.clear()
+
     @patch("github.Github.get_repo")  # Corresponding patch object: mockGithubRepo
     @patch(
         "grlc.utils.GithubLoader.fetchFiles"
@@ -32,6 +40,75 @@ class TestSwagger(unittest.TestCase):
         # Repo contains one JSON file which is not a query, and should be ignored
         self.assertEqual(len(spec), len(filesInRepo) - 1)
 
+    @patch("grlc.static.SPEC_BUILD_THREADS", 4)
+    @patch("github.Github.get_repo")
+    @patch("grlc.utils.GithubLoader.fetchFiles")
+    @patch("grlc.swagger.process_sparql_query_text")
+    def test_parallel_order(self, mockQueryText, mockLoaderFiles, mockGithubRepo):
+        def slow_item(query_text, loader, call_name, extraMetadata):
+            time.sleep(random.random() / 20)
+            if call_name.endswith("3"):
+                raise Exception("Broken query " + call_name)
+            return {"call_name": call_name}
+
+        mockQueryText.side_effect = slow_item
+        mockLoaderFiles.return_value = [
+            {"name": "query{}.rq".format(i), "decoded_content": b"", "download_url": ""}
+            for i in range(10)
+        ]
+
+        spec, warnings = build_spec("testuser", "testrepo", git_type="github")
+
+        self.assertEqual(
+            [item["call_name"] for item in spec],
+            ["query{}".format(i) for i in range(10) if i != 3],
+            "Items should keep the order of the files",
+        )
+        self.assertEqual(warnings[0], "Broken query query3")
+
+    @patch("grlc.swagger.item_cache", LRUCache(max_bytes=10**6, ttl=60))
+    @patch("github.Github.get_repo")
+    @patch("grlc.utils.GithubLoader.fetchFiles")
+    @patch(
+        "grlc.swagger.process_sparql_query_text",
+        side_effect=mock_process_sparql_query_text,
+    )
+    def test_blob_memo(self, mockQueryText, mockLoaderFiles, mockGithubRepo):
+        def commit(changed_blob):
+            return [
+                {
+                    "name": "query{}.rq".format(i),
+                    "sha": "blob{}".format(changed_blob if i == 0 else i),
+                    "decoded_content": b"",
+                    "download_url": "",
+                }
+                for i in range(5)
+            ]
+
+        mockLoaderFiles.return_value = commit("0")
+        spec1, _ = build_spec("testuser", "testrepo", git_type="github")
+        self.assertEqual(mockQueryText.call_count, 5)
+
+        mockLoaderFiles.return_value = commit("0-changed")
+        fileLoaders._manifests.clear()  # As the mocked repo has no new commit
+        spec2, _ = build_spec("testuser", "testrepo", git_type="github")
+        self.assertEqual(
+            mockQueryText.call_count, 6, "Should only rebuild the changed file"
+        )
+        self.assertEqual(spec1, spec2)
+
+    def test_tpf_replicas(self):
+        """Test the spec of TPF queries sent to several endpoint replicas."""
+        query_text = (
+            "#+ summary: TPF replicas\n"
+            "#+ endpoint:\n"
+            "#+   - http://a.example.org/fragments\n"
+            "#+   - http://b.example.org/fragments\n"
+            "subject=\npredicate=\nobject=\n"
+        )
+        item = process_tpf_query_text(query_text, "", "tpf", {})
+        self.assertEqual(item["summary"], "TPF replicas")
+
 
 if __name__ == "__main__":
     unittest.main()
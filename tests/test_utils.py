@@ -4,9 +4,11 @@
 
 import unittest
 from mock import patch, Mock
+import re
 import json
 
 import grlc.utils as utils
+from grlc.cache import LRUCache
 
 from tests.mock_data import mock_simpleSparqlResponse, mockLoader
 
@@ -16,7 +18,7 @@ class TestUtils(unittest.TestCase):
     def setUpClass(self):
         self.loader = mockLoader
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def test_sparql_transformer(self, mock_post):
         mock_json = {
             "head": {},
@@ -56,7 +58,7 @@ class TestUtils(unittest.TestCase):
             },
         }
 
-        mock_post.return_value = Mock(ok=True)
+        mock_post.return_value = Mock(ok=True, status_code=200)
         mock_post.return_value.headers = {"Content-Type": "application/json"}
         mock_post.return_value.text = json.dumps(mock_json)
 
@@ -100,12 +102,12 @@ class TestUtils(unittest.TestCase):
         )
 
     def setMockGetResponse(self):
-        return_value = Mock(ok=True)
+        return_value = Mock(ok=True, status_code=200)
         return_value.headers = {"Content-Type": "application/json"}
         return_value.text = json.dumps(mock_simpleSparqlResponse)
         return return_value
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def test_dispatch_SPARQL_query(self, mock_post):
         mock_post.return_value = self.setMockGetResponse()
 
@@ -128,7 +130,7 @@ class TestUtils(unittest.TestCase):
         sent_headers = kwargs.get("headers", {})
         self.assertIn("User-Agent", sent_headers)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_dispatch_SPARQL_query_get(self, mock_get):
         """Test that communication with SPARQL endpoint goes via GET method
         When the endpoint-method decorator is present and set to GET."""
@@ -153,8 +155,350 @@ class TestUtils(unittest.TestCase):
         sent_headers = kwargs.get("headers", {})
         self.assertIn("User-Agent", sent_headers)
 
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_paginated(self, mock_post):
+        def endpoint(url, data=None, **kwargs):
+            response = Mock(ok=True, status_code=200, text="s,p,o\n")
+            response.headers = {"Content-Type": "text/csv"}
+            response.json.return_value = {
+                "results": {"bindings": [{"grlc_count": {"value": "250"}}]}
+            }
+            return response
+
+        mock_post.side_effect = endpoint
+        rq, _ = self.loader.getTextForName("test-sparql")
+        uncounted = rq.replace("pagination: 100", "pagination: 100\n#+ count: false")
+        for query, last_page in [(uncounted, None), (rq, 3)]:
+            resp, status, headers = utils.dispatchSPARQLQuery(
+                query,
+                self.loader,
+                content="csv",
+                requestArgs={"page": "2"},
+                acceptHeader="text/csv",
+                requestUrl="http://mock-endpoint/api/test-sparql?page=2",
+                formData={},
+            )
+            self.assertEqual(status, 200)
+            self.assertIn("page=3>; rel=next", headers["Link"])
+            self.assertIn("page=1>; rel=first", headers["Link"])
+            if last_page:
+                self.assertIn("page=3>; rel=last", headers["Link"])
+            else:
+                self.assertNotIn("rel=last", headers["Link"], "Count is disabled")
+
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_keyset(self, mock_post):
+        results = {
+            "head": {"vars": ["s"]},
+            "results": {
+                "bindings": [
+                    {"s": {"type": "uri", "value": "http://example.org/{}".format(i)}}
+                    for i in range(2)
+                ]
+            },
+        }
+        mock_post.return_value = Mock(ok=True, status_code=200)
+        mock_post.return_value.headers = {"Content-Type": "application/json"}
+        mock_post.return_value.text = json.dumps(results)
+
+        rq = (
+            "#+ pagination: 2\n#+ pagination_mode: keyset\nSELECT ?s WHERE { ?s ?p ?o }"
+        )
+        args = {
+            "raw_sparql_query": rq,
+            "loader": self.loader,
+            "content": None,
+            "acceptHeader": "application/json",
+            "requestUrl": "http://mock-endpoint/api/test",
+            "formData": {},
+        }
+        resp, status, headers = utils.dispatchSPARQLQuery(requestArgs={}, **args)
+        self.assertEqual(status, 200)
+        self.assertIn("ORDER BY ?s\nLIMIT 2", mock_post.call_args[1]["data"])
+        self.assertNotIn("OFFSET", mock_post.call_args[1]["data"])
+        self.assertEqual(mock_post.call_count, 1, "Keyset pages are not counted")
+        cursor = re.search("cursor=([^>]+)>; rel=next", headers["Link"]).group(1)
+
+        resp, status, headers = utils.dispatchSPARQLQuery(
+            requestArgs={"cursor": cursor}, **args
+        )
+        self.assertIn(
+            'STR(?s) > "http://example.org/1"', mock_post.call_args[1]["data"]
+        )
+
+        resp, status, headers = utils.dispatchSPARQLQuery(
+            requestArgs={"cursor": "garbage"}, **args
+        )
+        self.assertEqual(status, 400)
+
+    @patch("grlc.static.HTTP_STREAM_RESULTS", True)
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_stream(self, mock_post):
+        """Test that results are forwarded in chunks when streaming is enabled."""
+        body = "s,p,o\n" * 10
+        mock_post.return_value = Mock(ok=True, status_code=200)
+        mock_post.return_value.headers = {"Content-Type": "text/csv"}
+        mock_post.return_value.iter_content.return_value = iter(
+            [body[:20].encode(), body[20:].encode()]
+        )
+
+        rq, _ = self.loader.getTextForName("test-sparql")
+        resp, status, headers = utils.dispatchSPARQLQuery(
+            rq,
+            self.loader,
+            content="csv",
+            requestArgs={},
+            acceptHeader="text/csv",
+            requestUrl="http://mock-endpoint/sparql",
+            formData={},
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Content-Type"], "text/csv")
+        self.assertFalse(mock_post.return_value.close.called, "Should not buffer")
+        self.assertEqual(b"".join(resp).decode(), body)
+        self.assertTrue(mock_post.return_value.close.called, "Should release")
+
+        # The query is paginated, so its results are also counted
+        self.assertTrue(
+            any(kwargs.get("stream") for _, kwargs in mock_post.call_args_list),
+            "Should request a streamed response",
+        )
+
+    @patch("grlc.static.HTTP_STREAM_RESULTS", True)
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_stream_compressed(self, mock_post):
+        """Test that compressed results are passed through if the client accepts them."""
+        mock_post.return_value = Mock(ok=True, status_code=200)
+        mock_post.return_value.headers = {
+            "Content-Type": "text/csv",
+            "Content-Encoding": "gzip",
+        }
+        mock_post.return_value.raw.stream.return_value = iter([b"gzipped"])
+
+        rq, _ = self.loader.getTextForName("test-sparql")
+        resp, status, headers = utils.dispatchSPARQLQuery(
+            rq,
+            self.loader,
+            content="csv",
+            requestArgs={},
+            acceptHeader="text/csv",
+            requestUrl="http://mock-endpoint/sparql",
+            formData={},
+            acceptEncoding="gzip, deflate",
+        )
+        self.assertEqual(b"".join(resp), b"gzipped")
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        _, kwargs = mock_post.return_value.raw.stream.call_args
+        self.assertFalse(kwargs["decode_content"], "Should not decompress")
+
+    @patch("grlc.utils.result_cache", LRUCache(max_bytes=10000, ttl=60))
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_cache(self, mock_post):
+        """Test that identical queries are answered from the result cache."""
+        mock_post.return_value = self.setMockGetResponse()
+
+        rq, _ = self.loader.getTextForName("test-projection")
+        for frida in ["Frida_Kahlo", "Frida_Kahlo", "Diego_Rivera"]:
+            resp, status, headers = utils.dispatchSPARQLQuery(
+                rq,
+                self.loader,
+                content=None,
+                requestArgs={"id": "http://dbpedia.org/resource/" + frida},
+                acceptHeader="application/json",
+                requestUrl="http://mock-endpoint/sparql",
+                formData={},
+            )
+            self.validateTestResponse(resp)
+
+        self.assertEqual(mock_post.call_count, 2, "Should reuse cached results")
+        self.assertIn("ETag", headers, "Cached results should carry a validator")
+        self.assertEqual(utils.result_cache.stats()["hits"], 1)
+
+    @patch("grlc.static.HTTP_BREAKER_FAILURES", 0)
+    @patch("grlc.utils.result_cache", LRUCache(max_bytes=10000, ttl=60))
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_cache_error(self, mock_post):
+        """Test that errors of the endpoint are passed on, and not cached."""
+        error = Mock(ok=False, status_code=500, text="Query timeout")
+        error.headers = {"Content-Type": "text/plain"}
+        mock_post.side_effect = [error, self.setMockGetResponse()]
+
+        rq, _ = self.loader.getTextForName("test-projection")
+        for expected in [500, 200]:
+            resp, status, headers = utils.dispatchSPARQLQuery(
+                rq,
+                self.loader,
+                content=None,
+                requestArgs={"id": "http://dbpedia.org/resource/Frida_Kahlo"},
+                acceptHeader="application/json",
+                requestUrl="http://mock-endpoint/sparql",
+                formData={},
+            )
+            self.assertEqual(status, expected)
+        self.validateTestResponse(resp)
+        self.assertEqual(mock_post.call_count, 2, "Should not cache the error")
+
+    @patch("grlc.utils.result_cache", LRUCache(max_bytes=10000, ttl=60))
+    @patch("requests.Session.post")
+    def test_dispatch_SPARQL_query_cache_transform(self, mock_post):
+        """Test that cached results are validated along with their transform."""
+        mock_post.return_value = self.setMockGetResponse()
+
+        rq, _ = self.loader.getTextForName("test-projection")
+        etags = []
+        for query in [rq, rq.replace('"$anchor": "key"', '"$anchor": "value"')]:
+            resp, status, headers = utils.dispatchSPARQLQuery(
+                query,
+                self.loader,
+                content=None,
+                requestArgs={"id": "http://dbpedia.org/resource/Frida_Kahlo"},
+                acceptHeader="application/json",
+                requestUrl="http://mock-endpoint/sparql",
+                formData={},
+            )
+            etags.append(headers["ETag"])
+
+        self.assertNotEqual(etags[0], etags[1], "Transform changed the response")
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("grlc.static.DUMP_CACHE_TTL", 0)
+    @patch("grlc.utils.dump_cache", LRUCache(max_bytes=10**6))
+    @patch.dict("grlc.utils._dump_stats", {"parses": 0, "unchanged": 0})
+    @patch("requests.Session.get")
+    def test_dispatch_query_dump_cache(self, mock_get):
+        """Test that dumps are parsed once, and revalidated with a conditional GET."""
+        dump = Mock(ok=True, status_code=200)
+        dump.content = b"<http://ex.org/s> <http://ex.org/p> <http://ex.org/o> ."
+        dump.headers = {"ETag": '"v1"'}
+        mock_get.side_effect = [dump, Mock(ok=True, status_code=304, headers={})]
+
+        for _ in range(2):
+            resp, status, headers = utils._dispatchQueryDump(
+                None,
+                "http://mock-endpoint/dump.ttl",
+                "turtle",
+                "SELECT ?o WHERE { ?s ?p ?o }",
+                "text/csv",
+                None,
+            )
+            self.assertEqual(status, 200)
+            self.assertIn("http://ex.org/o", resp.decode("utf-8"))
+
+        self.assertEqual(mock_get.call_count, 2)
+        _, kwargs = mock_get.call_args
+        self.assertEqual(kwargs["headers"]["If-None-Match"], '"v1"')
+        stats = utils.dump_cache_stats()
+        self.assertEqual(stats["items"], 1)
+        self.assertEqual(stats["parses"], 1, "Should not parse an unchanged dump")
+        self.assertEqual(stats["unchanged"], 1)
+
+    @patch("grlc.static.DUMP_CACHE_TTL", 0)
+    @patch("grlc.static.DUMP_STORE_GRACE", 60)
+    @patch("grlc.utils._store_graphs", {})
+    @patch("grlc.utils._retired_graphs", [])
+    @patch("grlc.utils.time.time")
+    @patch("grlc.dumpstore.enabled", Mock(return_value=True))
+    @patch("grlc.dumpstore.open_graph")
+    @patch("grlc.dumpstore.update")
+    def test_dump_store_swap(self, mock_update, mock_open_graph, mock_time):
+        """Test that the graph of a replaced store is closed after a while."""
+        first, second = Mock(), Mock()
+        mock_open_graph.side_effect = [first, second]
+        mock_update.side_effect = ["/stores/a", "/stores/a", "/stores/b", "/stores/b"]
+        mock_time.return_value = 1000
+
+        endpoint = "http://mock-endpoint/dump.nt"
+        # Graphs are kept open even when the dump cache is disabled
+        with patch("grlc.utils.dump_cache", LRUCache(max_bytes=0)):
+            self.assertIs(utils.getDumpGraph(endpoint, "nt"), first)
+            self.assertIs(utils.getDumpGraph(endpoint, "nt"), first)
+            self.assertIs(utils.getDumpGraph(endpoint, "nt"), second)
+        first.close.assert_not_called()
+        mock_time.return_value = 1061
+        self.assertIs(utils.getDumpGraph(endpoint, "nt"), second)
+        first.close.assert_called_once_with()
+        second.close.assert_not_called()
+        self.assertEqual(mock_open_graph.call_count, 2)
+
+    @patch("grlc.static.DUMP_CACHE_TTL", 60)
+    @patch("grlc.static.DUMP_STORE_GRACE", 0)
+    @patch("grlc.utils._store_graphs", {})
+    @patch("grlc.utils._retired_graphs", [])
+    @patch("grlc.dumpstore.enabled", Mock(return_value=True))
+    @patch("grlc.dumpstore.open_graph")
+    @patch("grlc.dumpstore.update")
+    def test_dump_store_evict(self, mock_update, mock_open_graph):
+        """Test that the graphs of dumps evicted from the cache are closed."""
+        graphs = {"/stores/a": Mock(), "/stores/b": Mock()}
+        mock_update.side_effect = lambda endpoint, mime_type: endpoint
+        mock_open_graph.side_effect = lambda store, endpoint: graphs[store]
+
+        dump_cache = LRUCache(
+            max_bytes=utils.DUMP_TRIPLE_SIZE, on_evict=utils.dump_cache.on_evict
+        )
+        with patch("grlc.utils.dump_cache", dump_cache):
+            utils.getDumpGraph("/stores/a", "nt")
+            graphs["/stores/a"].close.assert_not_called()
+            utils.getDumpGraph("/stores/b", "nt")
+        graphs["/stores/a"].close.assert_called_once_with()
+        graphs["/stores/b"].close.assert_not_called()
+
+    @patch("grlc.utils.spec_cache", LRUCache(max_bytes=10**7, ttl=60))
+    @patch("grlc.utils.getLoader")
+    def test_build_swagger_spec_cache(self, mock_loader):
+        """Test that specs are only built once per repository version."""
+        mock_loader.return_value = self.loader
+
+        with patch("grlc.swagger.build_spec", wraps=utils.swagger.build_spec) as build:
+            swag1 = utils.build_swagger_spec(
+                None, None, None, None, None, "grlc.io", None
+            )
+            swag2 = utils.build_swagger_spec(
+                None, None, None, None, None, "grlc.io", None
+            )
+
+        self.assertEqual(build.call_count, 1, "Should reuse the cached spec")
+        self.assertEqual(swag1, swag2)
+        self.assertIsNot(swag1, swag2, "Callers should get their own copy")
+
+        with patch.object(self.loader, "getCommitSha", return_value="other"):
+            with patch("grlc.swagger.build_spec", return_value=([], [])) as build:
+                utils.build_swagger_spec(None, None, None, None, None, "grlc.io", None)
+        self.assertEqual(build.call_count, 1, "New versions should be rebuilt")
+
+        endpoint = "http://other-endpoint/sparql"
+        with patch("grlc.swagger.get_request_endpoint", return_value=endpoint):
+            with patch("grlc.swagger.build_spec", return_value=([], [])) as build:
+                utils.build_swagger_spec(None, None, None, None, None, "grlc.io", None)
+        self.assertEqual(build.call_count, 1, "Other endpoints should be rebuilt")
+
+        full_sha = "0123456789abcdef0123456789abcdef01234567"
+        with patch.object(self.loader, "getCommitSha", return_value=full_sha):
+            with patch("grlc.swagger.build_spec", return_value=([], [])) as build:
+                for sha in ["0123456", full_sha]:
+                    utils.build_swagger_spec(
+                        None, None, None, None, sha, "grlc.io", None
+                    )
+        self.assertEqual(build.call_count, 1, "Commits should be cached once")
+        self.assertEqual(build.call_args[0][4], full_sha, "Should use the full hash")
+
+    @patch("grlc.utils.loader_registry", LRUCache(max_bytes=10, ttl=60, max_items=10))
+    @patch("grlc.utils.LocalLoader", side_effect=lambda: mockLoader)
+    def test_get_loader_registry(self, mock_local_loader):
+        """Test that loaders are reused, with per-call provenance."""
+        loader1 = utils.getLoader(None, None)
+        loader2 = utils.getLoader(None, None)
+        self.assertIs(loader1, loader2, "Should reuse the registered loader")
+        self.assertEqual(mock_local_loader.call_count, 1)
+
+        prov = Mock()
+        loader3 = utils.getLoader(None, None, prov=prov)
+        self.assertIs(loader3.prov, prov, "Should record provenance for this call")
+        self.assertFalse(hasattr(loader1, "prov"), "Should not share provenance")
+        self.assertEqual(mock_local_loader.call_count, 1)
+
     @patch("grlc.utils.getLoader")
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def test_dispatch_query(self, mock_post, mock_loader):
         mock_post.return_value = self.setMockGetResponse()
         mock_loader.return_value = self.loader